@@ -0,0 +1,291 @@
+"""
+Snapshot analítico em Parquet de 'notas_fiscais', consultado com DuckDB embutido.
+
+As análises pesadas (agrupamentos por dimensão, consultas ad-hoc) deixam de ler a
+base de dados transacional: as notas são copiadas para ficheiros Parquet
+particionados por mês de emissão (diretório 'mes=AAAA-MM') e o DuckDB agrega-os de
+forma colunar e vetorizada.
+
+A cópia é incremental, com paginação por chave e marca d'água (gravado_em, hash),
+como na exportação de treino: 'gravado_em' muda em cada escrita no MySQL, pelo que
+as notas corrigidas depois de copiadas voltam a entrar na atualização seguinte. A
+leitura recua ANALITICA_MARGEM_SEGUNDOS antes da marca, para apanhar as transações
+confirmadas depois da atualização anterior; as linhas dessa margem já copiadas
+(guardadas na marca) são ignoradas. Uma nota regravada aparece em mais de um
+ficheiro; a vista 'notas' fica só com a versão mais recente (maior gravado_em) de
+cada hash, e compactar_snapshot reescreve as partições sem as versões antigas.
+
+Os valores monetários são guardados como decimal128(15, 2) e as alíquotas como
+decimal128(7, 4), os mesmos tipos das colunas DECIMAL do MySQL (somas exatas).
+
+Uso (a partir da raiz do projeto):
+    python -m Backend.analitica atualizar
+    python -m Backend.analitica sql "SELECT ocr_prestador_uf, SUM(ocr_valor_total) FROM notas GROUP BY 1"
+"""
+import os
+import json
+import shutil
+import argparse
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Optional, Tuple
+
+import pandas as pd
+from sqlalchemy import text
+
+from .database import obter_conexao_leitura, estado_tabelas, TABELA_ARQUIVO, COLUNA_GRAVADO_EM
+from .esquema import HEADERS_DB, COLUNAS_DATA, COLUNAS_VALOR, CAMPOS_MONETARIOS, sql_select
+
+# DuckDB e pyarrow (opcionais): sem eles o resto da aplicação funciona normalmente
+try:
+    import duckdb
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    ANALITICA_DISPONIVEL = True
+except ImportError:
+    ANALITICA_DISPONIVEL = False
+
+DIRETORIO_SNAPSHOT = os.getenv('ANALITICA_DIRETORIO', 'snapshot_notas')
+MARGEM_SEGUNDOS = int(os.getenv('ANALITICA_MARGEM_SEGUNDOS', '60'))
+TAMANHO_BLOCO_PADRAO = 5000
+ARQUIVO_MARCA = '_marca.json'
+PARTICAO_SEM_DATA = 'sem_data'
+_FORMATO_GRAVADO_EM = '%Y-%m-%d %H:%M:%S.%f'
+_COLUNAS_SNAPSHOT = tuple(HEADERS_DB) + (COLUNA_GRAVADO_EM,)
+
+# Dimensões oferecidas às análises predefinidas (coluna -> rótulo)
+DIMENSOES_ANALISE = {
+    'ocr_prestador_uf': 'UF do Prestador', 'ocr_prestador_municipio': 'Município do Prestador',
+    'ocr_tomador_nome': 'Tomador', 'ocr_prestador_nome': 'Prestador',
+    'ocr_municipio_prestacao_servico': 'Município da Prestação', 'categoria': 'Categoria',
+}
+
+_snapshot_lock = threading.Lock()
+
+
+def _verificar_dependencias():
+    if not ANALITICA_DISPONIVEL:
+        raise RuntimeError("O snapshot analítico requer 'duckdb' e 'pyarrow'. Instale com: pip install duckdb pyarrow")
+
+
+def _tipo_decimal(col: str):
+    """Tipo Arrow da coluna DECIMAL: valores monetários DECIMAL(15, 2), alíquotas DECIMAL(7, 4)."""
+    return pa.decimal128(15, 2) if col in CAMPOS_MONETARIOS else pa.decimal128(7, 4)
+
+
+def _esquema():
+    """Esquema fixo dos ficheiros (todas as partições e lotes têm de ser compatíveis)."""
+    campos = []
+    for col in _COLUNAS_SNAPSHOT:
+        if col in COLUNAS_DATA or col == COLUNA_GRAVADO_EM: tipo = pa.timestamp('us')
+        elif col in COLUNAS_VALOR: tipo = _tipo_decimal(col)
+        else: tipo = pa.string()
+        campos.append((col, tipo))
+    return pa.schema(campos + [('mes', pa.string())])
+
+
+# ==============================================================================
+# MARCA D'ÁGUA
+# ==============================================================================
+def ler_marca(diretorio: str = DIRETORIO_SNAPSHOT) -> Optional[dict]:
+    """
+    Lê {'gravado_em', 'hash', 'recentes' ([hash, gravado_em] copiados na margem), 'lote'} da
+    última atualização, se existir.
+    """
+    try:
+        with open(os.path.join(diretorio, ARQUIVO_MARCA), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _gravar_marca(diretorio: str, marca: dict):
+    caminho = os.path.join(diretorio, ARQUIVO_MARCA)
+    with open(caminho + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(marca, f)
+    os.replace(caminho + '.tmp', caminho) # Escrita atómica
+
+
+# ==============================================================================
+# ATUALIZAÇÃO DO SNAPSHOT
+# ==============================================================================
+def _ler_bloco(posicao: Optional[Tuple[datetime, str]], inicio: Optional[datetime], tamanho_bloco: int) -> pd.DataFrame:
+    """Bloco seguinte por (gravado_em, hash): depois de 'posicao' ou, na primeira leitura, desde 'inicio'."""
+    filtro, params = "", {'limite': tamanho_bloco}
+    if posicao:
+        filtro = f"WHERE ({COLUNA_GRAVADO_EM}, hash) > (:gravado_em, :hash)"
+        params.update({'gravado_em': posicao[0], 'hash': posicao[1]})
+    elif inicio:
+        filtro = f"WHERE {COLUNA_GRAVADO_EM} >= :inicio"
+        params['inicio'] = inicio
+    ordenacao = f"ORDER BY {COLUNA_GRAVADO_EM}, hash LIMIT :limite"
+    query = f"{sql_select(_COLUNAS_SNAPSHOT, 'notas_fiscais')} {filtro} {ordenacao}"
+    if estado_tabelas()['arquivo_emissao_max'] is not None: # Anos arquivados também entram no snapshot
+        query = (f"({query}) UNION ALL ({sql_select(_COLUNAS_SNAPSHOT, TABELA_ARQUIVO)} {filtro} {ordenacao}) "
+                 f"{ordenacao}")
+    query = text(query)
+    with obter_conexao_leitura() as connection:
+        return pd.read_sql(query, connection, params=params)
+
+
+def _para_tabela_arrow(df: pd.DataFrame):
+    for col in COLUNAS_DATA + [COLUNA_GRAVADO_EM]: df[col] = pd.to_datetime(df[col], errors='coerce')
+    for col in COLUNAS_VALOR:
+        quantum = Decimal(1).scaleb(-_tipo_decimal(col).scale) # Decimal('0.01') ou Decimal('0.0001')
+        df[col] = df[col].map(lambda v, q=quantum: None if pd.isna(v) else Decimal(str(v)).quantize(q))
+    for col in HEADERS_DB:
+        if col not in COLUNAS_DATA and col not in COLUNAS_VALOR:
+            df[col] = df[col].astype(object).where(df[col].notna(), None).map(lambda v: v if v is None else str(v))
+    df['mes'] = df['ocr_emissao_datahora'].dt.strftime('%Y-%m').fillna(PARTICAO_SEM_DATA)
+    return pa.Table.from_pandas(df[list(_COLUNAS_SNAPSHOT) + ['mes']], schema=_esquema(), preserve_index=False)
+
+
+def atualizar_snapshot(diretorio: str = DIRETORIO_SNAPSHOT, completo: bool = False,
+                       tamanho_bloco: int = TAMANHO_BLOCO_PADRAO) -> int:
+    """
+    Copia para o snapshot as notas gravadas depois da marca d'água (ou todas, com 'completo').
+    Retorna o número de linhas escritas.
+    """
+    _verificar_dependencias()
+    with _snapshot_lock:
+        marca = None if completo else ler_marca(diretorio)
+        if marca and 'gravado_em' not in marca: # Marca antiga (por data_processamento): ficheiros sem gravado_em
+            print("Marca d'água do snapshot em formato antigo: o snapshot é reconstruído.")
+            completo, marca = True, None
+        if completo and os.path.isdir(diretorio): shutil.rmtree(diretorio)
+        os.makedirs(diretorio, exist_ok=True)
+        lote = (marca or {}).get('lote', 0) + 1
+        margem = timedelta(seconds=MARGEM_SEGUNDOS)
+        inicio = datetime.strptime(marca['gravado_em'], _FORMATO_GRAVADO_EM) - margem if marca else None
+        # (hash, gravado_em) copiados dentro da margem da última posição, por ordem de gravação
+        recentes = deque(sorted((tuple(r) for r in (marca or {}).get('recentes', [])), key=lambda r: r[1]))
+        ja_copiados = set(recentes)
+
+        total, parte, posicao = 0, 0, None
+        while True:
+            df = _ler_bloco(posicao, inicio, tamanho_bloco)
+            if df.empty: break
+            gravado_em = pd.to_datetime(df[COLUNA_GRAVADO_EM])
+            posicao = (gravado_em.iloc[-1].to_pydatetime(), df['hash'].iloc[-1])
+            novos = []
+            for h, g in zip(df['hash'], gravado_em):
+                chave = (h, g.strftime(_FORMATO_GRAVADO_EM))
+                while recentes and recentes[0][1] < (g - margem).strftime(_FORMATO_GRAVADO_EM):
+                    ja_copiados.discard(recentes.popleft())
+                novo = chave not in ja_copiados
+                novos.append(novo)
+                if novo:
+                    recentes.append(chave)
+                    ja_copiados.add(chave)
+            novos = pd.Series(novos, index=df.index)
+            if novos.any():
+                pq.write_to_dataset(
+                    _para_tabela_arrow(df[novos].copy()), diretorio, partition_cols=['mes'],
+                    basename_template=f"lote-{lote:06d}-{parte:04d}-{{i}}.parquet",
+                    existing_data_behavior='overwrite_or_ignore', compression='zstd',
+                )
+                parte += 1
+                total += int(novos.sum())
+            if len(df) < tamanho_bloco: break
+
+        if posicao:
+            _gravar_marca(diretorio, {'gravado_em': posicao[0].strftime(_FORMATO_GRAVADO_EM), 'hash': posicao[1],
+                                      'recentes': [list(r) for r in recentes], 'lote': lote})
+        print(f"Snapshot analítico atualizado: {total} linhas novas em '{diretorio}'.")
+        return total
+
+
+def compactar_snapshot(diretorio: str = DIRETORIO_SNAPSHOT) -> int:
+    """Reescreve o snapshot com uma única versão (a mais recente) de cada nota. Retorna o número de notas."""
+    _verificar_dependencias()
+    with _snapshot_lock:
+        if not _tem_ficheiros(diretorio): return 0
+        con = duckdb.connect()
+        try:
+            tabela = con.execute(f"SELECT * FROM ({_sql_vista(diretorio)})").fetch_arrow_table()
+        finally:
+            con.close()
+        marca = ler_marca(diretorio)
+        temporario = diretorio.rstrip('/\\') + '.compactar'
+        if os.path.isdir(temporario): shutil.rmtree(temporario)
+        pq.write_to_dataset(tabela.cast(_esquema()), temporario, partition_cols=['mes'],
+                            basename_template="lote-000000-0000-{i}.parquet", compression='zstd')
+        if marca: _gravar_marca(temporario, marca)
+        shutil.rmtree(diretorio)
+        os.replace(temporario, diretorio)
+        print(f"Snapshot analítico compactado: {tabela.num_rows} notas.")
+        return tabela.num_rows
+
+
+# ==============================================================================
+# CONSULTAS (DuckDB)
+# ==============================================================================
+def _tem_ficheiros(diretorio: str) -> bool:
+    return os.path.isdir(diretorio) and any(f.endswith('.parquet') for _, _, fs in os.walk(diretorio) for f in fs)
+
+
+def _fonte_parquet(diretorio: str) -> str:
+    padrao = os.path.join(diretorio, '**', '*.parquet').replace("'", "''")
+    return f"read_parquet('{padrao}', hive_partitioning = true, filename = true)"
+
+
+def _sql_vista(diretorio: str) -> str:
+    """Versão mais recente de cada hash (pela última gravação no MySQL e, em empate, pelo lote mais novo)."""
+    return f"""
+        SELECT * EXCLUDE (filename, _lote, _versao) FROM (
+            SELECT *, row_number() OVER (PARTITION BY hash ORDER BY {COLUNA_GRAVADO_EM} DESC NULLS LAST, _lote DESC) AS _versao
+            FROM (SELECT *, CAST(regexp_extract(filename, 'lote-(\\d+)', 1) AS BIGINT) AS _lote FROM {_fonte_parquet(diretorio)})
+        ) WHERE _versao = 1
+    """
+
+
+def consultar_analitica(sql: str, params=None, diretorio: str = DIRETORIO_SNAPSHOT) -> pd.DataFrame:
+    """Executa 'sql' no DuckDB, onde a vista 'notas' expõe o snapshot. Retorna um DataFrame (vazio sem snapshot)."""
+    _verificar_dependencias()
+    if not _tem_ficheiros(diretorio): return pd.DataFrame()
+    con = duckdb.connect()
+    try:
+        con.execute(f"CREATE VIEW notas AS {_sql_vista(diretorio)}")
+        return con.execute(sql, params or []).df()
+    finally:
+        con.close()
+
+
+def resumo_por_dimensao(coluna: str, mes_de: Optional[str] = None, mes_ate: Optional[str] = None,
+                        limite: int = 20, diretorio: str = DIRETORIO_SNAPSHOT) -> pd.DataFrame:
+    """Número de notas, valor total e impostos retidos por 'coluna' (uma de DIMENSOES_ANALISE), meses 'AAAA-MM' inclusivos."""
+    if coluna not in DIMENSOES_ANALISE: raise ValueError(f"Dimensão de análise inválida '{coluna}'.")
+    condicoes, params = ["mes <> ?"], [PARTICAO_SEM_DATA]
+    if mes_de: condicoes.append("mes >= ?"); params.append(mes_de)
+    if mes_ate: condicoes.append("mes <= ?"); params.append(mes_ate)
+    retidos = " + ".join(f"COALESCE({c}, 0)" for c in ['ocr_valor_iss', 'ocr_valor_inss', 'ocr_valor_pis_pasep',
+                                                       'ocr_valor_cofins', 'ocr_valor_csll', 'ocr_valor_irrf'])
+    sql = f"""
+        SELECT COALESCE(NULLIF(TRIM({coluna}), ''), 'N/A') AS {coluna}, COUNT(*) AS num_notas,
+               SUM(ocr_valor_total) AS valor_total, SUM({retidos}) AS total_retido
+        FROM notas WHERE {' AND '.join(condicoes)} AND ocr_valor_total > 0
+        GROUP BY 1 ORDER BY valor_total DESC LIMIT {int(limite)}
+    """
+    return consultar_analitica(sql, params, diretorio)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Snapshot analítico (Parquet + DuckDB) das notas fiscais.")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    p_atualizar = sub.add_parser("atualizar", help="Copia as notas novas ou corrigidas para o snapshot.")
+    p_atualizar.add_argument("--completo", action="store_true", help="Reconstrói o snapshot do zero.")
+    sub.add_parser("compactar", help="Remove as versões antigas das notas regravadas.")
+    p_sql = sub.add_parser("sql", help="Executa uma consulta SQL sobre a vista 'notas'.")
+    p_sql.add_argument("consulta")
+    parser.add_argument("--diretorio", default=DIRETORIO_SNAPSHOT, help="Diretório do snapshot.")
+    args = parser.parse_args(argv)
+
+    if args.comando == "atualizar": atualizar_snapshot(args.diretorio, completo=args.completo)
+    elif args.comando == "compactar": compactar_snapshot(args.diretorio)
+    else: print(consultar_analitica(args.consulta, diretorio=args.diretorio).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,28 @@
 import mysql.connector
 import pandas as pd
 import os
+import re
+import sys
+import copy
+import time
+import threading
+import functools
+from collections import OrderedDict
+from decimal import Decimal
+from contextlib import contextmanager
 from dotenv import load_dotenv
 # NOVAS IMPORTAÇÕES para corrigir o UserWarning do Pandas
 from sqlalchemy import create_engine, text
+from sqlalchemy.engine import URL
+from sqlalchemy.exc import TimeoutError as SATimeoutError
 import traceback # Para depuração
 
+from .pesquisa import planear_pesquisa
+from .esquema import (
+    HEADERS_DB, CAMPOS_CONTROLO, DEFINICOES_SQL, COLUNAS_DATA, COLUNAS_VALOR, SQL_SELECT_NOTAS,
+    SQL_UPSERT_NOTA, Nota, linhas_de_dataframe, _nulo, sql_select, sql_upsert
+)
+
 # Carrega as variáveis de ambiente do ficheiro .env
 load_dotenv()
 
@@ -20,77 +37,415 @@ DB_CONFIG = {
 }
 
 # ==============================================================================
-# MOTOR SQLAlchemy (para Pandas)
+# POOL DE CONEXÕES PARTILHADO (SQLAlchemy + mysql.connector)
 # ==============================================================================
+# Um único pool por processo serve as duas formas de acesso: as funções que usam
+# cursores mysql.connector recebem uma conexão emprestada do pool (create_connection,
+# cujo close() devolve a conexão ao pool) e as leituras com Pandas usam o mesmo motor.
+DB_POOL_CONFIG = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+    'max_overflow': int(os.getenv('DB_POOL_MAX_OVERFLOW', '10')),
+    'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '30')), # Segundos à espera de uma conexão livre
+    'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')), # Renova conexões antes do wait_timeout do MySQL
+    'pool_pre_ping': True, # Verifica a conexão antes de a emprestar
+}
+# Cursores preparados (server-side) guardados por conexão do pool para as instruções de escrita
+MAX_CURSORES_PREPARADOS = int(os.getenv('DB_MAX_CURSORES_PREPARADOS', '16'))
+
 _engine = None
+_engine_lock = threading.Lock()
+_metricas_pool = {'checkouts': 0, 'espera_total_s': 0.0, 'espera_maxima_s': 0.0, 'timeouts': 0}
+_metricas_lock = threading.Lock()
+
+
+def _garantir_base_de_dados():
+    """Cria a base de dados se não existir (uma vez por processo, antes de criar o pool)."""
+    conn = mysql.connector.connect(host=DB_CONFIG['host'], user=DB_CONFIG['user'], password=DB_CONFIG['password'])
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{DB_CONFIG['database']}`")
+    finally:
+        conn.close()
+
 
 def get_sqlalchemy_engine():
-    """Cria e retorna um motor SQLAlchemy para a conexão com a base de dados."""
+    """Cria (uma vez) e retorna o motor SQLAlchemy com o pool de conexões partilhado."""
     global _engine
-    if _engine is None:
-        if not all([DB_CONFIG['user'], DB_CONFIG['password'], DB_CONFIG['database'], DB_CONFIG['host']]):
-            print("Erro: Credenciais da base de dados não definidas no .env para SQLAlchemy.")
-            return None
-        try:
-            # pymysql é recomendado para SQLAlchemy com MySQL
-            db_uri = f"mysql+pymysql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}/{DB_CONFIG['database']}"
-            _engine = create_engine(db_uri)
-            # Testa a conexão
-            with _engine.connect() as connection:
-                print("Conexão SQLAlchemy estabelecida com sucesso.")
-        except ImportError:
-             print("Erro: A biblioteca 'pymysql' não está instalada. Execute: pip install pymysql")
-             return None
-        except Exception as e:
-            print(f"Erro ao criar o motor SQLAlchemy: {e}")
-            _engine = None # Garante que não tentaremos usar um motor inválido
+    if _engine is not None: return _engine
+    with _engine_lock:
+        if _engine is None:
+            if not all([DB_CONFIG['user'], DB_CONFIG['password'], DB_CONFIG['database'], DB_CONFIG['host']]):
+                print("Erro: Credenciais da base de dados não definidas no .env para SQLAlchemy.")
+                return None
+            try:
+                _garantir_base_de_dados()
+                db_url = URL.create(
+                    "mysql+mysqlconnector", username=DB_CONFIG['user'], password=DB_CONFIG['password'],
+                    host=DB_CONFIG['host'], database=DB_CONFIG['database']
+                )
+                _engine = create_engine(db_url, **DB_POOL_CONFIG)
+                # Testa a conexão
+                with _engine.connect() as connection:
+                    print(f"Pool de conexões criado com sucesso (tamanho {DB_POOL_CONFIG['pool_size']}, overflow {DB_POOL_CONFIG['max_overflow']}).")
+            except Exception as e:
+                print(f"Erro ao criar o motor SQLAlchemy: {e}")
+                _engine = None # Garante que não tentaremos usar um motor inválido
     return _engine
 
+
+def _registar_espera(espera):
+    with _metricas_lock:
+        _metricas_pool['checkouts'] += 1
+        _metricas_pool['espera_total_s'] += espera
+        _metricas_pool['espera_maxima_s'] = max(_metricas_pool['espera_maxima_s'], espera)
+
+
+@contextmanager
+def obter_conexao_leitura():
+    """Conexão SQLAlchemy emprestada do pool (para pd.read_sql), com medição do tempo de espera."""
+    engine = get_sqlalchemy_engine()
+    if engine is None: raise RuntimeError("Motor SQLAlchemy indisponível.")
+    inicio = time.monotonic()
+    try:
+        connection = engine.connect()
+    except SATimeoutError:
+        with _metricas_lock: _metricas_pool['timeouts'] += 1
+        raise
+    _registar_espera(time.monotonic() - inicio)
+    try:
+        yield connection
+    finally:
+        connection.close()
+
+
+def obter_metricas_pool():
+    """Estado do pool e tempos de espera no checkout (para monitorização)."""
+    with _metricas_lock:
+        metricas = dict(_metricas_pool)
+    metricas['espera_media_s'] = metricas['espera_total_s'] / metricas['checkouts'] if metricas['checkouts'] else 0.0
+    if _engine is not None:
+        pool = _engine.pool
+        metricas.update({
+            'tamanho': pool.size(), 'emprestadas': pool.checkedout(),
+            'livres': pool.checkedin(), 'overflow': pool.overflow(),
+        })
+    return metricas
+
+# ==============================================================================
+# ESTADO REAL DAS TABELAS DE NOTAS (information_schema)
+# ==============================================================================
+# O particionamento, os índices FULLTEXT e o arquivo dos anos fechados (Backend/particoes.py) são
+# lidos do information_schema e não da configuração: NOTAS_PARTICIONAMENTO só diz à migração o que
+# fazer, e a tabela pode ser particionada ou arquivada por outro processo (linha de comandos).
+TABELA_ARQUIVO = 'notas_fiscais_arquivo'
+ESTADO_TABELAS_TTL_SEGUNDOS = float(os.getenv('DB_ESTADO_TTL_SEGUNDOS', '60'))
+_ESTADO_NEUTRO = {'particionada': False, 'fulltext': {}, 'arquivo_emissao_max': None}
+
+_estado_tabelas = None # (instante da leitura, estado)
+_estado_lock = threading.Lock()
+
+
+def _ler_estado_tabelas(executar):
+    """Lê o estado com 'executar(sql) -> linhas' (cursor mysql.connector ou conexão SQLAlchemy)."""
+    particoes = executar("SELECT COUNT(*) FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() "
+                         "AND TABLE_NAME = 'notas_fiscais' AND PARTITION_NAME IS NOT NULL")[0][0]
+    fulltext = {}
+    for tabela, coluna in executar("SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.STATISTICS "
+                                   "WHERE TABLE_SCHEMA = DATABASE() AND INDEX_TYPE = 'FULLTEXT' "
+                                   f"AND TABLE_NAME IN ('notas_fiscais', '{TABELA_ARQUIVO}')"):
+        fulltext.setdefault(tabela, set()).add(coluna)
+    arquivo_existe = executar("SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() "
+                              f"AND TABLE_NAME = '{TABELA_ARQUIVO}'")[0][0]
+    emissao_max = executar(f"SELECT MAX(ocr_emissao_datahora) FROM {TABELA_ARQUIVO}")[0][0] if arquivo_existe else None
+    return {'particionada': particoes > 0, 'fulltext': {t: frozenset(c) for t, c in fulltext.items()},
+            'arquivo_emissao_max': emissao_max}
+
+
+def estado_tabelas(cursor=None, refrescar: bool = False):
+    """
+    {'particionada': 'notas_fiscais' tem partições (e a coluna ano_mes), 'fulltext': {tabela: colunas
+    com índice FULLTEXT}, 'arquivo_emissao_max': última emissão arquivada (None sem notas arquivadas)}.
+    Relido a cada ESTADO_TABELAS_TTL_SEGUNDOS (com 'cursor', na conexão desse cursor). Se a leitura
+    falhar, devolve um estado neutro (sem partições, FULLTEXT nem arquivo), que não é guardado.
+    """
+    global _estado_tabelas
+    with _estado_lock:
+        if not refrescar and _estado_tabelas and time.monotonic() - _estado_tabelas[0] < ESTADO_TABELAS_TTL_SEGUNDOS:
+            return _estado_tabelas[1]
+    try:
+        if cursor is not None:
+            def executar(sql):
+                cursor.execute(sql)
+                return cursor.fetchall()
+            estado = _ler_estado_tabelas(executar)
+        else:
+            with obter_conexao_leitura() as connection:
+                estado = _ler_estado_tabelas(lambda sql: connection.execute(text(sql)).fetchall())
+    except Exception as e:
+        print(f"Erro ao ler o estado das tabelas de notas: {e}")
+        return _ESTADO_NEUTRO
+    with _estado_lock:
+        _estado_tabelas = (time.monotonic(), estado)
+    return estado
+
+
+def invalidar_estado_tabelas():
+    """Força a releitura do estado (após particionar ou arquivar neste processo)."""
+    global _estado_tabelas
+    with _estado_lock:
+        _estado_tabelas = None
+
 # ==============================================================================
-# DEFINIÇÃO DOS CABEÇALHOS DA TABELA (para uso interno neste módulo)
+# CACHE DE CONSULTAS (LRU com orçamento de memória e invalidação por versão de tabela)
 # ==============================================================================
-# CORREÇÃO: Definindo HEADERS_DB aqui para que as funções tenham acesso
-HEADERS_DB = [
-    'hash', 'arquivo', 'data_processamento',
-    'ocr_numero', 'ocr_emissao_datahora', 'ocr_codigo_verificacao',
-    'ocr_prestador_nome', 'ocr_prestador_cpf_cnpj', 'ocr_prestador_inscricao_municipal',
-    'ocr_prestador_endereco', 'ocr_prestador_municipio', 'ocr_prestador_uf',
-    'ocr_tomador_nome', 'ocr_tomador_cpf_cnpj', 'ocr_tomador_endereco',
-    'ocr_tomador_inscricao_municipal', 'ocr_tomador_municipio', 'ocr_tomador_uf', 'ocr_tomador_email',
-    'ocr_discriminacao', 'ocr_codigo_servico',
-    'ocr_valor_total', 'ocr_valor_base_calculo', 'ocr_valor_aliquota', 'ocr_valor_iss',
-    'ocr_valor_deducoes', 'ocr_valor_pis_pasep', 'ocr_valor_cofins', 'ocr_valor_csll',
-    'ocr_valor_irrf', 'ocr_valor_inss', 'ocr_valor_credito',
-    'ocr_valor_tributos_fonte', 'ocr_valor_tributos_fonte_percentual',
-    'ocr_municipio_prestacao_servico', 'ocr_intermediario_nome', 'ocr_intermediario_cpf_cnpj',
-    'ocr_outras_informacoes', 'ocr_numero_inscricao_obra', 'alogo_visivel',
-    'categoria' # Adicionado 'categoria' se fizer parte do schema final
+# Cada entrada é indexada pela função, pelos parâmetros e pelas versões das tabelas
+# que lê. Cada gravação bem-sucedida incrementa a versão das tabelas que alterou e
+# remove as entradas que dependiam delas, pelo que uma leitura repetida sem escritas
+# entretanto não chega ao resultado completo no MySQL.
+#
+# Para que as gravações de outros processos (ex: monitor de pastas) também invalidem,
+# cada gravação incrementa ainda um contador por tabela em 'versoes_tabelas', na mesma
+# transação (incrementar_versoes). Antes de devolver uma entrada, o cache lê esses
+# contadores (uma consulta pela chave primária) e descarta a entrada se mudaram desde
+# a leitura que a produziu. A tabela 'users' (credenciais e permissões) não é lida
+# através do cache.
+CACHE_CONFIG = {
+    'ativo': os.getenv('DB_CACHE_ATIVO', '1').lower() in ('1', 'true', 'sim'),
+    'max_bytes': int(float(os.getenv('DB_CACHE_MAX_MB', '64')) * 1024 * 1024),
+    'ttl_s': float(os.getenv('DB_CACHE_TTL', '300')),
+}
+
+TABELA_VERSOES = 'versoes_tabelas'
+ER_NO_SUCH_TABLE = 1146 # Tabela inexistente (antes da migração que a cria)
+
+_versoes_tabelas = {}
+_cache_entradas = OrderedDict() # chave -> (valor, tamanho, tabelas, criada_em, versões partilhadas)
+_cache_lock = threading.Lock()
+_metricas_cache = {'hits': 0, 'misses': 0, 'expulsoes': 0, 'invalidacoes': 0, 'bytes': 0}
+_estado_leitura = threading.local()
+
+
+def _marcar_erro_leitura():
+    """Chamada pelas leituras no caminho de erro: o resultado (vazio) não deve ficar em cache."""
+    _estado_leitura.erro = True
+
+
+def _tamanho_valor(valor) -> int:
+    if isinstance(valor, pd.DataFrame): return int(valor.memory_usage(index=True, deep=True).sum())
+    if isinstance(valor, (list, tuple, set)): return 64 + sum(_tamanho_valor(v) for v in valor)
+    if isinstance(valor, dict): return 64 + sum(_tamanho_valor(k) + _tamanho_valor(v) for k, v in valor.items())
+    return sys.getsizeof(valor)
+
+
+def _copiar_valor(valor):
+    """Os chamadores alteram os DataFrames devolvidos; o cache entrega sempre cópias."""
+    if isinstance(valor, pd.DataFrame): return valor.copy()
+    if isinstance(valor, tuple): return tuple(_copiar_valor(v) for v in valor)
+    return copy.deepcopy(valor)
+
+
+def _chave_parametros(valor):
+    if isinstance(valor, dict): return tuple(sorted((k, _chave_parametros(v)) for k, v in valor.items()))
+    if isinstance(valor, (list, tuple)): return tuple(_chave_parametros(v) for v in valor)
+    return repr(valor)
+
+
+def invalidar_tabelas(*tabelas):
+    """Incrementa a versão das tabelas e remove do cache as entradas que as leem."""
+    with _cache_lock:
+        for tabela in tabelas:
+            _versoes_tabelas[tabela] = _versoes_tabelas.get(tabela, 0) + 1
+        for chave in [c for c, e in _cache_entradas.items() if e[2] & set(tabelas)]:
+            _metricas_cache['bytes'] -= _cache_entradas.pop(chave)[1]
+            _metricas_cache['invalidacoes'] += 1
+
+
+def create_versoes_table_if_not_exists(conn):
+    """Cria a tabela 'versoes_tabelas' (contador de gravações por tabela, partilhado pelos processos)."""
+    if not conn or not conn.is_connected():
+        print("Erro: Conexão inválida para criar a tabela versoes_tabelas.")
+        return
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABELA_VERSOES} (
+            tabela VARCHAR(64) PRIMARY KEY,
+            versao BIGINT UNSIGNED NOT NULL DEFAULT 0
+        );
+    """)
+    conn.commit()
+
+
+def incrementar_versoes(cursor, *tabelas):
+    """
+    Incrementa a versão partilhada de 'tabelas' na transação do cursor: fica visível aos outros
+    processos com o commit da própria gravação (e desaparece com o seu rollback).
+    """
+    try:
+        cursor.execute(f"INSERT INTO {TABELA_VERSOES} (tabela, versao) VALUES {', '.join(['(%s, 1)'] * len(tabelas))} "
+                       "ON DUPLICATE KEY UPDATE versao = versao + 1", tuple(tabelas))
+    except mysql.connector.Error as e:
+        if e.errno != ER_NO_SUCH_TABLE: raise # Migrações anteriores à tabela: só o cache local é invalidado
+
+
+def _versoes_partilhadas(tabelas):
+    """Versões de 'tabelas' em 'versoes_tabelas', por ordem do nome; None se não foi possível lê-las."""
+    tabelas = sorted(tabelas)
+    try:
+        with conexao_emprestada() as conn:
+            if conn is None: return None
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT tabela, versao FROM {TABELA_VERSOES} WHERE tabela IN ({', '.join(['%s'] * len(tabelas))})",
+                           tuple(tabelas))
+            versoes = dict(cursor.fetchall())
+    except mysql.connector.Error as e:
+        if e.errno != ER_NO_SUCH_TABLE:
+            print(f"Erro ao ler as versões das tabelas (a leitura não usa o cache): {e}")
+            return None
+        versoes = {}
+    return tuple(versoes.get(t, 0) for t in tabelas)
+
+
+def cache_consulta(*tabelas, com_conexao=False):
+    """
+    Decorador para funções de leitura que dependem de 'tabelas'. Com 'com_conexao', o
+    primeiro argumento (a conexão) não faz parte da chave. Resultados None e leituras
+    que falharam (_marcar_erro_leitura) não são guardados. Uma entrada só é devolvida se as
+    versões partilhadas das tabelas (gravações de qualquer processo) não mudaram.
+    """
+    tabelas_dependentes = frozenset(tabelas)
+
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def envolvida(*args, **kwargs):
+            if not CACHE_CONFIG['ativo']: return funcao(*args, **kwargs)
+            args_chave = args[1:] if com_conexao else args
+            partilhadas = _versoes_partilhadas(tabelas_dependentes) # Lidas antes da consulta que vier a ser guardada
+            if partilhadas is None: return funcao(*args, **kwargs)
+            with _cache_lock:
+                versoes = tuple(sorted((t, _versoes_tabelas.get(t, 0)) for t in tabelas_dependentes))
+                chave = (funcao.__qualname__, _chave_parametros(args_chave), _chave_parametros(kwargs), versoes)
+                entrada = _cache_entradas.get(chave)
+                if (entrada is not None and entrada[4] == partilhadas
+                        and time.monotonic() - entrada[3] <= CACHE_CONFIG['ttl_s']):
+                    _cache_entradas.move_to_end(chave)
+                    _metricas_cache['hits'] += 1
+                    return _copiar_valor(entrada[0])
+                if entrada is not None: # Expirada ou gravada noutro processo
+                    _metricas_cache['bytes'] -= _cache_entradas.pop(chave)[1]
+                    if entrada[4] != partilhadas: _metricas_cache['invalidacoes'] += 1
+                _metricas_cache['misses'] += 1
+
+            _estado_leitura.erro = False
+            valor = funcao(*args, **kwargs)
+            if valor is None or _estado_leitura.erro: return valor
+            tamanho = _tamanho_valor(valor)
+            if tamanho > CACHE_CONFIG['max_bytes']: return valor
+            with _cache_lock:
+                if versoes != tuple(sorted((t, _versoes_tabelas.get(t, 0)) for t in tabelas_dependentes)):
+                    return valor # Houve uma gravação durante a leitura: o resultado pode já estar desatualizado
+                antiga = _cache_entradas.pop(chave, None)
+                if antiga is not None: _metricas_cache['bytes'] -= antiga[1]
+                _cache_entradas[chave] = (_copiar_valor(valor), tamanho, tabelas_dependentes, time.monotonic(), partilhadas)
+                _metricas_cache['bytes'] += tamanho
+                while _metricas_cache['bytes'] > CACHE_CONFIG['max_bytes'] and _cache_entradas:
+                    _metricas_cache['bytes'] -= _cache_entradas.popitem(last=False)[1][1]
+                    _metricas_cache['expulsoes'] += 1
+            return valor
+        return envolvida
+    return decorador
+
+
+def obter_metricas_cache():
+    """Contadores do cache de consultas (hits, misses, taxa de acerto, memória usada)."""
+    with _cache_lock:
+        metricas = dict(_metricas_cache)
+        metricas['entradas'] = len(_cache_entradas)
+    total = metricas['hits'] + metricas['misses']
+    metricas['taxa_acerto'] = metricas['hits'] / total if total else 0.0
+    metricas['max_bytes'] = CACHE_CONFIG['max_bytes']
+    return metricas
+
+
+# ==============================================================================
+# TIPOS DAS COLUNAS NOS DATAFRAMES (leituras tipadas)
+# ==============================================================================
+# Sem mapa de tipos, o read_sql devolve 'object' para quase tudo (Decimal, str) e
+# cada aba convertia as colunas de novo. As leituras de notas aplicam este mapa uma
+# vez: float64 para os valores, datetime64 para as datas e category para as colunas
+# com poucos valores distintos. O float64 é só para as grelhas (mostrar e editar; ao
+# gravar, interpretar_valor volta a Decimal): os totais vêm de agregar_notas e dos rollups.
+# Com DB_DTYPES_ARROW=1 (e pyarrow instalado) o texto livre passa a 'string[pyarrow]'.
+# COLUNAS_DATA e COLUNAS_VALOR vêm do registo do schema (Backend/esquema.py)
+COLUNAS_CATEGORICAS = [
+    'ocr_prestador_uf', 'ocr_tomador_uf', 'ocr_prestador_municipio', 'ocr_tomador_municipio',
+    'ocr_municipio_prestacao_servico', 'categoria', 'alogo_visivel',
 ]
+DTYPES_NOTAS = {
+    **{c: 'string' for c in HEADERS_DB},
+    **{c: 'datetime64[ns]' for c in COLUNAS_DATA},
+    **{c: 'float64' for c in COLUNAS_VALOR},
+    **{c: 'category' for c in COLUNAS_CATEGORICAS},
+}
+
+try:
+    import pyarrow # noqa: F401 (só para verificar a disponibilidade)
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+USAR_DTYPES_ARROW = PYARROW_AVAILABLE and os.getenv('DB_DTYPES_ARROW', '0').lower() in ('1', 'true', 'sim')
+
+
+def tipar_dataframe(df, arrow=None):
+    """Aplica DTYPES_NOTAS às colunas presentes em 'df' (no próprio DataFrame, que é devolvido)."""
+    arrow = USAR_DTYPES_ARROW if arrow is None else (arrow and PYARROW_AVAILABLE)
+    for col in df.columns:
+        tipo = DTYPES_NOTAS.get(col)
+        if tipo == 'datetime64[ns]': df[col] = pd.to_datetime(df[col], errors='coerce')
+        elif tipo == 'float64': df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+        elif tipo == 'category': df[col] = df[col].astype('category')
+        elif tipo == 'string' and arrow: df[col] = df[col].astype('string[pyarrow]')
+    return df
 
 
 # ==============================================================================
 # FUNÇÕES DE CONEXÃO E TABELAS (usando mysql.connector para DDL)
 # ==============================================================================
 def create_connection():
-    """Cria e retorna uma conexão mysql.connector."""
+    """
+    Empresta uma conexão mysql.connector do pool partilhado.
+    A interface é a de sempre (cursor, commit, is_connected...); close() devolve-a ao pool.
+    """
     if not all([DB_CONFIG['user'], DB_CONFIG['password'], DB_CONFIG['database']]):
         print("Erro: Credenciais da base de dados não definidas no .env")
         return None
+    engine = get_sqlalchemy_engine()
+    if engine is None: return None
+    inicio = time.monotonic()
     try:
-        conn = mysql.connector.connect(
-            host=DB_CONFIG['host'],
-            user=DB_CONFIG['user'],
-            password=DB_CONFIG['password']
-        )
-        cursor = conn.cursor()
-        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {DB_CONFIG['database']}")
-        conn.database = DB_CONFIG['database']
-        print("Conexão mysql.connector estabelecida com sucesso.")
+        conn = engine.raw_connection()
+        _registar_espera(time.monotonic() - inicio)
         return conn
-    except mysql.connector.Error as e:
+    except SATimeoutError:
+        with _metricas_lock: _metricas_pool['timeouts'] += 1
+        print(f"Erro: Nenhuma conexão livre no pool após {DB_POOL_CONFIG['pool_timeout']}s.")
+        return None
+    except Exception as e:
         print(f"Erro ao conectar ao MySQL via mysql.connector: {e}")
         return None
 
+@contextmanager
+def conexao_emprestada():
+    """
+    create_connection() só durante um bloco 'with': a conexão volta ao pool no fim (mesmo com
+    exceções, incluindo st.stop/st.rerun), o que termina a transação e o seu snapshot.
+    """
+    conn = create_connection()
+    try:
+        yield conn
+    finally:
+        if conn is not None: conn.close()
+
+
 def _add_column_if_not_exists(cursor, table_name, column_name, column_definition):
     """Verifica se uma coluna existe e a adiciona caso contrário."""
     try:
@@ -106,6 +461,22 @@ def _add_column_if_not_exists(cursor, table_name, column_name, column_definition
             print(f"Coluna '{column_name}' adicionada à tabela '{table_name}'.")
     except mysql.connector.Error as e:
         print(f"Erro ao verificar/adicionar coluna '{column_name}' em '{table_name}': {e}")
+        raise
+
+
+ER_DUP_KEYNAME = 1061 # Índice com este nome já existe
+
+def _criar_indice(cursor, sql, ignorar=(ER_DUP_KEYNAME,)) -> bool:
+    """
+    Executa um CREATE INDEX; só os erros em 'ignorar' (por omissão, índice já existente) não se
+    propagam. Retorna True se o índice foi criado.
+    """
+    try:
+        cursor.execute(sql)
+        return True
+    except mysql.connector.Error as e:
+        if e.errno not in ignorar: raise
+        return False
 
 
 def create_notas_fiscais_table_if_not_exists(conn):
@@ -116,49 +487,20 @@ def create_notas_fiscais_table_if_not_exists(conn):
     try:
         cursor = conn.cursor()
         # Query inicial simplificada, colunas serão adicionadas/verificadas abaixo
-        create_table_query = """
-        CREATE TABLE IF NOT EXISTS notas_fiscais (
-            hash VARCHAR(32) PRIMARY KEY,
-            arquivo VARCHAR(255),
-            data_processamento DATETIME
-        );
-        """
+        colunas_basicas = ", ".join(f"{c} {DEFINICOES_SQL[c]}" for c in CAMPOS_CONTROLO)
+        create_table_query = f"CREATE TABLE IF NOT EXISTS notas_fiscais ({colunas_basicas});"
         cursor.execute(create_table_query)
 
-        # Definições das colunas (tipo SQL)
-        colunas_defs = {
-            'ocr_numero': 'VARCHAR(50) NULL', 'ocr_emissao_datahora': 'DATETIME NULL', 'ocr_codigo_verificacao': 'VARCHAR(50) NULL',
-            'ocr_prestador_nome': 'VARCHAR(255) NULL', 'ocr_prestador_cpf_cnpj': 'VARCHAR(20) NULL', 'ocr_prestador_inscricao_municipal': 'VARCHAR(50) NULL',
-            'ocr_prestador_endereco': 'TEXT NULL', 'ocr_prestador_municipio': 'VARCHAR(100) NULL', 'ocr_prestador_uf': 'VARCHAR(2) NULL',
-            'ocr_tomador_nome': 'VARCHAR(255) NULL', 'ocr_tomador_cpf_cnpj': 'VARCHAR(20) NULL', 'ocr_tomador_endereco': 'TEXT NULL',
-            'ocr_tomador_inscricao_municipal': 'VARCHAR(50) NULL', 'ocr_tomador_municipio': 'VARCHAR(100) NULL', 'ocr_tomador_uf': 'VARCHAR(2) NULL', 'ocr_tomador_email': 'VARCHAR(255) NULL',
-            'ocr_discriminacao': 'TEXT NULL', 'ocr_codigo_servico': 'VARCHAR(50) NULL',
-            'ocr_valor_total': 'DECIMAL(15, 2) NULL', 'ocr_valor_base_calculo': 'DECIMAL(15, 2) NULL', 'ocr_valor_aliquota': 'DECIMAL(7, 4) NULL', 'ocr_valor_iss': 'DECIMAL(15, 2) NULL',
-            'ocr_valor_deducoes': 'DECIMAL(15, 2) NULL', 'ocr_valor_pis_pasep': 'DECIMAL(15, 2) NULL', 'ocr_valor_cofins': 'DECIMAL(15, 2) NULL', 'ocr_valor_csll': 'DECIMAL(15, 2) NULL',
-            'ocr_valor_irrf': 'DECIMAL(15, 2) NULL', 'ocr_valor_inss': 'DECIMAL(15, 2) NULL', 'ocr_valor_credito': 'DECIMAL(15, 2) NULL',
-            'ocr_valor_tributos_fonte': 'DECIMAL(15, 2) NULL', 'ocr_valor_tributos_fonte_percentual': 'VARCHAR(10) NULL',
-            'ocr_municipio_prestacao_servico': 'VARCHAR(100) NULL', 'ocr_intermediario_nome': 'VARCHAR(255) NULL', 'ocr_intermediario_cpf_cnpj': 'VARCHAR(20) NULL',
-            'ocr_outras_informacoes': 'TEXT NULL', 'ocr_numero_inscricao_obra': 'VARCHAR(50) NULL', 'alogo_visivel': 'VARCHAR(10) NULL',
-            'categoria': 'VARCHAR(100) NULL' # Inclui categoria
-        }
-
-        # Adiciona/Verifica todas as colunas definidas em HEADERS_DB (exceto as básicas)
+        # Adiciona/Verifica todas as colunas do schema (exceto as básicas), com as definições de Backend/esquema.py
         for col_name in HEADERS_DB:
-             if col_name not in ['hash', 'arquivo', 'data_processamento']:
-                 col_def = colunas_defs.get(col_name)
-                 if col_def:
-                     _add_column_if_not_exists(cursor, "notas_fiscais", col_name, col_def)
-                 else:
-                      print(f"AVISO: Definição SQL não encontrada para a coluna '{col_name}' em HEADERS_DB.")
+             if col_name not in CAMPOS_CONTROLO:
+                 _add_column_if_not_exists(cursor, "notas_fiscais", col_name, DEFINICOES_SQL[col_name])
 
 
         # Adiciona índices se não existirem (Opcional, mas recomendado)
-        try: cursor.execute("CREATE INDEX idx_prestador_cnpj ON notas_fiscais (ocr_prestador_cpf_cnpj);")
-        except mysql.connector.Error: pass # Ignora erro se índice já existir
-        try: cursor.execute("CREATE INDEX idx_numero_nota ON notas_fiscais (ocr_numero);")
-        except mysql.connector.Error: pass
-        try: cursor.execute("CREATE INDEX idx_emissao_datahora ON notas_fiscais (ocr_emissao_datahora);")
-        except mysql.connector.Error: pass
+        _criar_indice(cursor, "CREATE INDEX idx_prestador_cnpj ON notas_fiscais (ocr_prestador_cpf_cnpj);")
+        _criar_indice(cursor, "CREATE INDEX idx_numero_nota ON notas_fiscais (ocr_numero);")
+        _criar_indice(cursor, "CREATE INDEX idx_emissao_datahora ON notas_fiscais (ocr_emissao_datahora);")
 
         conn.commit()
         print("Tabela 'notas_fiscais' verificada/atualizada com sucesso.")
@@ -168,6 +510,7 @@ def create_notas_fiscais_table_if_not_exists(conn):
             conn.rollback() # Tenta reverter alterações em caso de erro
         except Exception as rb_e:
             print(f"Erro durante o rollback: {rb_e}")
+        raise # A migração não pode ficar registada como aplicada
 
 
 def create_users_table_if_not_exists(conn):
@@ -190,6 +533,7 @@ def create_users_table_if_not_exists(conn):
         print("Tabela 'users' verificada/atualizada com sucesso.")
     except mysql.connector.Error as e:
         print(f"Erro ao criar/alterar a tabela de utilizadores: {e}")
+        raise
 
 # ==============================================================================
 # FUNÇÕES CRUD PARA UTILIZADORES (usando mysql.connector)
@@ -197,6 +541,8 @@ def create_users_table_if_not_exists(conn):
 # ... (Funções add_user, delete_user, get_user_details, get_all_usernames,
 #      update_user_password, check_force_password_change, set_password_change_flag
 #      permanecem iguais) ...
+# As leituras de 'users' não passam pelo cache de consultas: as credenciais e as permissões
+# alteradas noutro processo (outra réplica, create_admin.py) têm de valer logo.
 def fetch_all_users(conn):
     """Busca todos os utilizadores para o streamlit-authenticator."""
     if not conn or not conn.is_connected(): return None
@@ -298,7 +644,7 @@ def fetch_all_users_for_admin_view(conn):
     if engine is None: return pd.DataFrame() # Retorna DF vazio se o engine falhar
     try:
         query = text("SELECT username, name, email, is_admin, force_password_change FROM users")
-        with engine.connect() as connection:
+        with obter_conexao_leitura() as connection:
             df = pd.read_sql(query, connection)
         # Converte booleanos para texto mais legível
         if 'is_admin' in df.columns:
@@ -311,6 +657,170 @@ def fetch_all_users_for_admin_view(conn):
         return pd.DataFrame() # Retorna DF vazio em caso de erro
 
 
+# ==============================================================================
+# OUVINTES DE INSERÇÃO (ex: filtro de Bloom de deduplicação)
+# ==============================================================================
+_ouvintes_insercao = []
+
+def registar_ouvinte_insercao(funcao):
+    """Regista uma função chamada com a lista de hashes após cada gravação bem-sucedida em 'notas_fiscais'."""
+    if funcao not in _ouvintes_insercao:
+        _ouvintes_insercao.append(funcao)
+
+def _notificar_insercao(hashes):
+    invalidar_tabelas('notas_fiscais', 'rollup_mensal')
+    for funcao in _ouvintes_insercao:
+        try:
+            funcao(hashes)
+        except Exception as e:
+            print(f"Erro num ouvinte de inserção: {e}")
+
+
+# ==============================================================================
+# ROLLUPS MENSAIS (mês x prestador x categoria) PARA O DASHBOARD
+# ==============================================================================
+# Mantidos na mesma transação que grava as notas: antes do upsert a contribuição
+# antiga das notas afetadas é subtraída e depois do upsert a nova é somada, pelo
+# que atualizações (ex: correção do valor ou da categoria) também ficam refletidas.
+# Só entram notas com data de emissão e valor total positivo, como no dashboard.
+COLUNAS_ROLLUP = [
+    'ocr_valor_total', 'ocr_valor_base_calculo', 'ocr_valor_deducoes', 'ocr_valor_iss', 'ocr_valor_inss',
+    'ocr_valor_pis_pasep', 'ocr_valor_cofins', 'ocr_valor_csll', 'ocr_valor_irrf',
+    'ocr_valor_credito', 'ocr_valor_tributos_fonte',
+]
+
+_SELECT_ROLLUP = f"""
+    SELECT DATE_SUB(DATE(ocr_emissao_datahora), INTERVAL DAYOFMONTH(ocr_emissao_datahora) - 1 DAY) AS mes,
+           COALESCE(NULLIF(TRIM(ocr_prestador_nome), ''), 'N/A') AS prestador_nome,
+           COALESCE(TRIM(categoria), '') AS categoria,
+           {{sinal}} * COUNT(*),
+           {', '.join(f"{{sinal}} * COALESCE(SUM(`{c}`), 0)" for c in COLUNAS_ROLLUP)}
+    FROM {{tabela}}
+    WHERE ocr_emissao_datahora IS NOT NULL AND ocr_valor_total > 0 {{filtro}}
+    GROUP BY 1, 2, 3
+"""
+_COLUNAS_ROLLUP_SQL = ', '.join(['mes', 'prestador_nome', 'categoria', 'num_notas'] + [f"`{c}`" for c in COLUNAS_ROLLUP])
+_UPDATES_ROLLUP_SQL = ', '.join(f"rollup_mensal.`{c}` = rollup_mensal.`{c}` + VALUES(`{c}`)" for c in ['num_notas'] + COLUNAS_ROLLUP)
+
+
+def create_rollup_table_if_not_exists(conn):
+    """Cria a tabela 'rollup_mensal' e, se estiver vazia, preenche-a a partir de 'notas_fiscais'."""
+    if not conn or not conn.is_connected():
+        print("Erro: Conexão inválida para criar tabela rollup_mensal.")
+        return
+    try:
+        cursor = conn.cursor()
+        colunas_soma = ",\n".join(f"                `{c}` DECIMAL(17, 2) NOT NULL DEFAULT 0" for c in COLUNAS_ROLLUP)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS rollup_mensal (
+                mes DATE NOT NULL,
+                prestador_nome VARCHAR(255) NOT NULL,
+                categoria VARCHAR(100) NOT NULL,
+                num_notas INT NOT NULL DEFAULT 0,
+{colunas_soma},
+                PRIMARY KEY (mes, prestador_nome, categoria)
+            );
+        """)
+        cursor.execute("SELECT COUNT(*) FROM rollup_mensal")
+        if cursor.fetchone()[0] == 0: reconstruir_rollups(conn)
+        conn.commit()
+        print("Tabela 'rollup_mensal' verificada/atualizada com sucesso.")
+    except mysql.connector.Error as e:
+        print(f"Erro ao criar a tabela rollup_mensal: {e}")
+        raise
+
+
+def reconstruir_rollups(conn):
+    """
+    Recalcula toda a tabela de rollups a partir de 'notas_fiscais' e das notas arquivadas
+    (ex: após correções manuais na tabela), para que o dashboard mantenha os anos fechados.
+    """
+    cursor = conn.cursor()
+    tabelas = ['notas_fiscais']
+    if estado_tabelas(cursor, refrescar=True)['arquivo_emissao_max'] is not None: tabelas.append(TABELA_ARQUIVO)
+    cursor.execute("DELETE FROM rollup_mensal")
+    for tabela in tabelas:
+        cursor.execute(f"INSERT INTO rollup_mensal ({_COLUNAS_ROLLUP_SQL}) " + _SELECT_ROLLUP.format(tabela=tabela, sinal=1, filtro="")
+                       + f" ON DUPLICATE KEY UPDATE {_UPDATES_ROLLUP_SQL}")
+    incrementar_versoes(cursor, 'rollup_mensal')
+    conn.commit()
+    invalidar_tabelas('rollup_mensal')
+    print(f"Rollups mensais reconstruídos a partir de {' e '.join(tabelas)}.")
+
+
+def _aplicar_delta_rollup(cursor, hashes, sinal):
+    """Soma (sinal=1) ou subtrai (sinal=-1) a contribuição atual das notas 'hashes' aos rollups."""
+    if not hashes: return
+    filtro = f"AND hash IN ({', '.join(['%s'] * len(hashes))})"
+    sql = (f"INSERT INTO rollup_mensal ({_COLUNAS_ROLLUP_SQL}) " + _SELECT_ROLLUP.format(tabela='notas_fiscais', sinal=int(sinal), filtro=filtro)
+           + f" ON DUPLICATE KEY UPDATE {_UPDATES_ROLLUP_SQL}")
+    cursor.execute(sql, tuple(hashes))
+    if sinal > 0: cursor.execute("DELETE FROM rollup_mensal WHERE num_notas <= 0")
+
+
+def _cursor_preparado(conn, sql):
+    """
+    Cursor preparado (conn.cursor(prepared=True)) para a instrução 'sql', guardado na conexão do pool:
+    conn.info persiste entre empréstimos e é limpo quando o pool renova a conexão, por isso o MySQL
+    analisa cada instrução uma vez por conexão e as execuções seguintes só enviam os valores.
+    Guarda até MAX_CURSORES_PREPARADOS por conexão (os menos usados são fechados, o que liberta a
+    instrução no servidor). Retorna None se a conexão não for do pool ou não suportar cursores preparados.
+    """
+    cursores = getattr(conn, 'info', None)
+    if not isinstance(cursores, dict) or MAX_CURSORES_PREPARADOS <= 0: return None
+    cursores = cursores.setdefault('cursores_preparados', OrderedDict())
+    cursor = cursores.get(sql)
+    if cursor is not None:
+        cursores.move_to_end(sql)
+        return cursor
+    try:
+        cursor = conn.cursor(prepared=True)
+    except (TypeError, ValueError, mysql.connector.Error):
+        return None
+    cursores[sql] = cursor
+    if len(cursores) > MAX_CURSORES_PREPARADOS:
+        _, antigo = cursores.popitem(last=False)
+        try: antigo.close()
+        except mysql.connector.Error: pass
+    return cursor
+
+
+def _executar_upsert_com_rollup(cursor, hashes, sql, values, emissoes=None, cursor_upsert=None):
+    """
+    Executa o upsert em 'notas_fiscais' mantendo os rollups mensais na mesma transação.
+    Com a tabela particionada, 'emissoes' ([(hash, ocr_emissao_datahora)]) move primeiro as notas
+    existentes para a partição do novo mês de emissão: a chave primária é (hash, ano_mes) e o
+    upsert, sozinho, criaria uma segunda linha para a mesma nota.
+    'cursor_upsert' (cursor preparado da mesma conexão, ver _cursor_preparado) executa só o upsert.
+    """
+    _aplicar_delta_rollup(cursor, hashes, -1)
+    if emissoes and estado_tabelas(cursor)['particionada']:
+        cursor.executemany("UPDATE notas_fiscais SET `ocr_emissao_datahora` = %s "
+                           "WHERE `hash` = %s AND NOT (`ocr_emissao_datahora` <=> %s)",
+                           [(emissao, h, emissao) for h, emissao in emissoes])
+    (cursor_upsert or cursor).execute(sql, values)
+    _aplicar_delta_rollup(cursor, hashes, 1)
+    incrementar_versoes(cursor, 'notas_fiscais', 'rollup_mensal')
+
+
+@cache_consulta('rollup_mensal')
+def fetch_rollup_mensal_as_dataframe():
+    """
+    Lê a tabela de rollups (uma linha por mês x prestador x categoria; não depende do número de notas).
+    As somas ficam em Decimal, como no MySQL: os totais do dashboard batem ao centavo.
+    """
+    try:
+        query = text(f"SELECT {_COLUNAS_ROLLUP_SQL} FROM rollup_mensal WHERE num_notas > 0")
+        with obter_conexao_leitura() as connection:
+            df = pd.read_sql(query, connection, parse_dates=['mes'])
+        for c in COLUNAS_ROLLUP: df[c] = df[c].map(lambda v: Decimal('0') if v is None else Decimal(v))
+        return df
+    except Exception as e:
+        print(f"Erro ao ler os rollups mensais: {e}")
+        traceback.print_exc()
+        return None
+
+
 # ==============================================================================
 # FUNÇÕES DE MANIPULAÇÃO DE NOTAS FISCAIS (usando mysql.connector e SQLAlchemy)
 # ==============================================================================
@@ -325,8 +835,29 @@ def get_all_hashes(conn):
         print(f"Erro ao buscar hashes: {e}")
         return set()
 
+def _hashes_arquivados(cursor, hashes):
+    """
+    Subconjunto de 'hashes' que já está em 'notas_fiscais_arquivo'. Um upsert dessas notas em
+    'notas_fiscais' criaria uma segunda cópia viva (contada duas vezes nas consultas e nos rollups).
+    """
+    hashes = [h for h in dict.fromkeys(hashes) if h]
+    if not hashes: return set()
+    try:
+        cursor.execute(f"SELECT hash FROM {TABELA_ARQUIVO} WHERE hash IN ({', '.join(['%s'] * len(hashes))})", tuple(hashes))
+    except mysql.connector.Error as e:
+        if e.errno == ER_NO_SUCH_TABLE: return set() # Antes da migração que cria o arquivo
+        raise
+    return {linha[0] for linha in cursor.fetchall()}
+
+
+ERRO_NOTA_ARQUIVADA = "A nota já está no arquivo (ano fiscal fechado) e não pode ser regravada em 'notas_fiscais'."
+
+
 def insert_record(conn, data_dict):
-    """Insere ou atualiza um registo na tabela 'notas_fiscais'."""
+    """
+    Insere ou atualiza um registo (dict ou Nota) na tabela 'notas_fiscais'.
+    Notas que já estão no arquivo são recusadas (ver _hashes_arquivados).
+    """
     if not conn or not conn.is_connected():
         print("Erro: Conexão inválida para inserir registo.")
         return False
@@ -336,39 +867,36 @@ def insert_record(conn, data_dict):
 
     try:
         cursor = conn.cursor()
+        if _hashes_arquivados(cursor, [data_dict['hash']]):
+            print(f"Erro ao inserir/atualizar registo (hash: {data_dict['hash']}): {ERRO_NOTA_ARQUIVADA}")
+            return False
+        if isinstance(data_dict, Nota):
+            # Nota completa: a instrução com todas as colunas do schema já está montada (Backend/esquema.py)
+            _executar_upsert_com_rollup(cursor, [data_dict.hash], SQL_UPSERT_NOTA, data_dict.valores(),
+                                        [(data_dict.hash, data_dict.ocr_emissao_datahora)],
+                                        _cursor_preparado(conn, SQL_UPSERT_NOTA))
+            conn.commit()
+            _notificar_insercao([data_dict.hash])
+            return True
+
         # Usa apenas as colunas presentes em data_dict E que existem na tabela (HEADERS_DB)
-        # Garante que None seja tratado corretamente (não incluído ou inserido como NULL)
-        cols_to_insert = [h for h in HEADERS_DB if h in data_dict] # Inclui colunas com None por enquanto
-        cols_str = ', '.join([f"`{h}`" for h in cols_to_insert])
-        placeholders = ', '.join(['%s'] * len(cols_to_insert))
-        updates = ', '.join([f"`{h}`=VALUES(`{h}`)" for h in cols_to_insert if h != 'hash'])
-
-        if not updates: # Se só o hash está presente, não faz sentido atualizar
-             print(f"AVISO: Apenas o hash encontrado para {data_dict['hash']}. Nenhuma atualização realizada.")
-             # Pode optar por não fazer nada ou apenas inserir o hash se ele não existir
-             # Vamos tentar inserir apenas com os dados disponíveis
-             if len(cols_to_insert) == 1 and cols_to_insert[0] == 'hash':
-                  # Tenta inserir só o hash se ele ainda não existir (raro, mas possível)
-                  sql = f"INSERT IGNORE INTO notas_fiscais (`hash`) VALUES (%s)"
-                  values = (data_dict['hash'],)
-                  cursor.execute(sql, values)
-                  conn.commit()
-                  return cursor.rowcount > 0 # Retorna True se inseriu
-             else: # Se tem mais colunas mas nenhuma para update, algo está estranho
-                  print("AVISO: Nenhuma coluna para atualizar além do hash.")
-                  # Mesmo assim, tenta o INSERT .. ON DUPLICATE KEY UPDATE
-                  sql = f"INSERT INTO notas_fiscais ({cols_str}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE `hash`=`hash`" # Update dummy
-                  values = tuple([data_dict.get(h) for h in cols_to_insert]) # None será convertido para NULL pelo driver
-                  cursor.execute(sql, values)
-                  conn.commit()
-                  return True # Assume sucesso se não deu erro
-
-
-        sql = f"INSERT INTO notas_fiscais ({cols_str}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {updates}"
+        cols_to_insert = tuple(h for h in HEADERS_DB if h in data_dict) # Inclui colunas com None (gravadas como NULL)
+
+        if cols_to_insert == ('hash',): # Só o hash: insere-o se ainda não existir (raro, mas possível)
+            print(f"AVISO: Apenas o hash encontrado para {data_dict['hash']}. Nenhuma atualização realizada.")
+            sql = "INSERT IGNORE INTO notas_fiscais (`hash`) VALUES (%s)"
+            _executar_upsert_com_rollup(cursor, [data_dict['hash']], sql, (data_dict['hash'],))
+            conn.commit()
+            _notificar_insercao([data_dict['hash']])
+            return cursor.rowcount > 0 # Retorna True se inseriu
+
+        sql = sql_upsert(cols_to_insert, 1) # Montada uma vez por combinação de colunas
         values = tuple([data_dict.get(h) for h in cols_to_insert]) # None será convertido para NULL pelo driver
+        emissoes = [(data_dict['hash'], data_dict.get('ocr_emissao_datahora'))] if 'ocr_emissao_datahora' in cols_to_insert else None
 
-        cursor.execute(sql, values)
+        _executar_upsert_com_rollup(cursor, [data_dict['hash']], sql, values, emissoes, _cursor_preparado(conn, sql))
         conn.commit()
+        _notificar_insercao([data_dict['hash']])
         return True # Retorna True em caso de sucesso
     except mysql.connector.Error as e:
         print(f"Erro ao inserir/atualizar registo (hash: {data_dict.get('hash', 'N/A')}): {e}")
@@ -387,24 +915,115 @@ def insert_record(conn, data_dict):
          return False
 
 
+TAMANHO_LOTE_UPSERT = 200
+
+def _registos_para_linhas(registos):
+    """
+    Aceita um DataFrame, uma lista de Nota ou uma lista de dicts. Devolve (colunas a gravar, uma tupla
+    de valores por registo nessa ordem): as colunas do DataFrame, todas as do schema se houver alguma
+    Nota, as que aparecem em algum dict. Colunas ausentes num registo e NaN/NaT ficam None.
+    """
+    if isinstance(registos, pd.DataFrame): return linhas_de_dataframe(registos)
+    registos = list(registos)
+    if any(isinstance(r, Nota) for r in registos): colunas = HEADERS_DB
+    else: colunas = [h for h in HEADERS_DB if any(h in r for r in registos)]
+    linhas = [r.valores(colunas) if isinstance(r, Nota)
+              else tuple(None if _nulo(v := r.get(c)) else v for c in colunas) for r in registos]
+    return colunas, linhas
+
+
+def insert_records_bulk(conn, registos, tamanho_lote: int = TAMANHO_LOTE_UPSERT):
+    """
+    Insere ou atualiza vários registos em 'notas_fiscais' numa única transação.
+
+    Os registos (DataFrame, lista de Nota ou lista de dicts) são enviados em INSERT ... ON DUPLICATE KEY
+    UPDATE de várias linhas, em blocos de 'tamanho_lote' (com os rollups mensais atualizados no mesmo bloco). Colunas ausentes num registo
+    são gravadas como NULL. Todos os blocos completos usam a mesma instrução preparada no servidor
+    (só o último bloco, mais curto, e as repetições linha a linha usam outra). Se um bloco falhar, é revertido até ao seu savepoint e as
+    suas linhas são repetidas uma a uma, para isolar as que falham sem perder o lote. Notas que já
+    estão no arquivo são recusadas (ficam em 'falhas').
+
+    Retorna {'salvos': [hashes], 'falhas': [(hash, mensagem de erro)]}.
+    """
+    resultado = {'salvos': [], 'falhas': []}
+    if not conn or not conn.is_connected():
+        print("Erro: Conexão inválida para inserir registos em lote.")
+        return resultado
+
+    cols_to_insert, linhas = _registos_para_linhas(registos)
+    cols_to_insert = tuple(cols_to_insert)
+    i_hash = cols_to_insert.index('hash') if 'hash' in cols_to_insert else None
+    i_arquivo = cols_to_insert.index('arquivo') if 'arquivo' in cols_to_insert else None
+    i_emissao = cols_to_insert.index('ocr_emissao_datahora') if 'ocr_emissao_datahora' in cols_to_insert else None
+    validos = []
+    for linha in linhas:
+        if i_hash is not None and linha[i_hash]: validos.append(linha)
+        else: resultado['falhas'].append(((linha[i_arquivo] if i_arquivo is not None else None) or 'N/A', "Hash ausente/vazio"))
+    if not validos: return resultado
+
+    def _executar(cursor, bloco):
+        sql = sql_upsert(cols_to_insert, len(bloco))
+        emissoes = [(l[i_hash], l[i_emissao]) for l in bloco] if i_emissao is not None else None
+        _executar_upsert_com_rollup(cursor, [l[i_hash] for l in bloco], sql,
+                                    tuple(v for l in bloco for v in l), emissoes,
+                                    _cursor_preparado(conn, sql))
+
+    try:
+        cursor = conn.cursor()
+        arquivados = _hashes_arquivados(cursor, [l[i_hash] for l in validos])
+        if arquivados:
+            resultado['falhas'].extend((h, ERRO_NOTA_ARQUIVADA) for h in dict.fromkeys(l[i_hash] for l in validos if l[i_hash] in arquivados))
+            validos = [l for l in validos if l[i_hash] not in arquivados]
+        for inicio in range(0, len(validos), tamanho_lote):
+            bloco = validos[inicio:inicio + tamanho_lote]
+            cursor.execute("SAVEPOINT lote_upsert")
+            try:
+                _executar(cursor, bloco)
+                resultado['salvos'].extend(l[i_hash] for l in bloco)
+            except mysql.connector.Error as e_bloco:
+                print(f"AVISO: Bloco de {len(bloco)} registos falhou ({e_bloco}). A repetir linha a linha...")
+                cursor.execute("ROLLBACK TO SAVEPOINT lote_upsert")
+                for linha in bloco:
+                    cursor.execute("SAVEPOINT linha_upsert")
+                    try:
+                        _executar(cursor, [linha])
+                        resultado['salvos'].append(linha[i_hash])
+                    except mysql.connector.Error as e_linha:
+                        cursor.execute("ROLLBACK TO SAVEPOINT linha_upsert")
+                        resultado['falhas'].append((linha[i_hash], str(e_linha)))
+        conn.commit()
+        _notificar_insercao(resultado['salvos'])
+    except mysql.connector.Error as e:
+        print(f"Erro ao inserir/atualizar registos em lote: {e}")
+        try:
+            conn.rollback()
+        except Exception as rb_e:
+            print(f"Erro durante o rollback: {rb_e}")
+        ja_falhados = {h for h, _ in resultado['falhas']}
+        resultado['falhas'].extend((l[i_hash], str(e)) for l in validos if l[i_hash] not in ja_falhados)
+        resultado['salvos'] = []
+    return resultado
+
+
+@cache_consulta('notas_fiscais')
 def fetch_all_data_as_dataframe():
     """Busca todos os dados da tabela de notas e retorna como um DataFrame Pandas."""
     engine = get_sqlalchemy_engine()
     if engine is None: return pd.DataFrame()
     try:
-        # Usa a lista HEADERS_DB definida neste módulo
-        cols_select = ", ".join([f"`{h}`" for h in HEADERS_DB])
-        query = text(f"SELECT {cols_select} FROM notas_fiscais")
-        with engine.connect() as connection:
+        query = text(SQL_SELECT_NOTAS) # Todas as colunas do schema (Backend/esquema.py)
+        with obter_conexao_leitura() as connection:
              # Passa explicitamente as colunas esperadas para o read_sql
              # Isso ajuda o Pandas a inferir tipos e lida com colunas potencialmente ausentes no DB
              df = pd.read_sql(query, connection, columns=HEADERS_DB)
-        return df
+        return tipar_dataframe(df)
     except Exception as e:
         print(f"Erro ao buscar todos os dados com SQLAlchemy: {e}")
         traceback.print_exc() # Imprime traceback completo
+        _marcar_erro_leitura()
         return pd.DataFrame()
 
+@cache_consulta('notas_fiscais', com_conexao=True)
 def search_data_as_dataframe(conn, search_term, column_to_search):
     """Busca dados na tabela de notas filtrando por um termo em uma coluna específica (case-insensitive)."""
     engine = get_sqlalchemy_engine()
@@ -414,24 +1033,304 @@ def search_data_as_dataframe(conn, search_term, column_to_search):
         # Chama a versão que não precisa de conn
         return fetch_all_data_as_dataframe()
 
-    # Valida se a coluna de busca está na lista permitida (HEADERS_DB definida neste módulo)
+    # Valida se a coluna de busca está na lista permitida (HEADERS_DB, do registo do schema)
     if column_to_search not in HEADERS_DB:
         print(f"Erro: Coluna de pesquisa inválida '{column_to_search}'.")
         return pd.DataFrame()
 
     try:
-        # Usa a lista HEADERS_DB definida neste módulo
-        cols_select = ", ".join([f"`{h}`" for h in HEADERS_DB])
-        # Usa LOWER() para busca case-insensitive e placeholders seguros
-        query = text(f"SELECT {cols_select} FROM notas_fiscais WHERE LOWER(`{column_to_search}`) LIKE LOWER(:term)")
-        like_term = f"%{search_term}%"
+        # O planeador escolhe igualdade, prefixo ou FULLTEXT conforme a coluna (ver Backend/pesquisa.py)
+        condicao, params, _ = planear_pesquisa(column_to_search, search_term,
+                                               colunas_fulltext=estado_tabelas()['fulltext'].get('notas_fiscais', ()))
+        query = text(f"{SQL_SELECT_NOTAS} WHERE {condicao}")
 
-        with engine.connect() as connection:
+        with obter_conexao_leitura() as connection:
             # Passa explicitamente as colunas esperadas
-            df = pd.read_sql(query, connection, params={"term": like_term}, columns=HEADERS_DB)
-        return df
+            df = pd.read_sql(query, connection, params=params, columns=HEADERS_DB)
+        return tipar_dataframe(df)
     except Exception as e:
         print(f"Erro ao buscar dados filtrados com SQLAlchemy (col: {column_to_search}): {e}")
         traceback.print_exc() # Imprime traceback completo
+        _marcar_erro_leitura()
         return pd.DataFrame()
 
+
+
+# ==============================================================================
+# CONSULTA PAGINADA (paginação por chave, projeção de colunas e filtros)
+# ==============================================================================
+# Colunas TEXT grandes ficam fora da projeção por omissão da listagem
+COLUNAS_TEXTO_LONGO = ['ocr_prestador_endereco', 'ocr_tomador_endereco', 'ocr_discriminacao', 'ocr_outras_informacoes']
+COLUNAS_CONSULTA_PADRAO = [h for h in HEADERS_DB if h not in COLUNAS_TEXTO_LONGO]
+COLUNAS_ORDENAVEIS = ['data_processamento', 'ocr_emissao_datahora', 'ocr_valor_total', 'ocr_numero', 'ocr_prestador_nome', 'categoria']
+TAMANHO_PAGINA_PADRAO = 100
+
+
+def create_consulta_indexes_if_not_exist(conn):
+    """Cria os índices usados pelos filtros e pela ordenação da consulta paginada."""
+    if not conn or not conn.is_connected():
+        print("Erro: Conexão inválida para criar índices de consulta.")
+        return
+    cursor = conn.cursor()
+    for nome, colunas in [('idx_data_processamento', 'data_processamento'), ('idx_categoria', 'categoria'),
+                          ('idx_valor_total', 'ocr_valor_total'), ('idx_tomador_cnpj', 'ocr_tomador_cpf_cnpj')]:
+        _criar_indice(cursor, f"CREATE INDEX {nome} ON notas_fiscais ({colunas});")
+    conn.commit()
+    print("Índices de consulta de 'notas_fiscais' verificados com sucesso.")
+
+
+# Momento (relógio do MySQL) da última escrita de cada nota: marca d'água de quem acompanha as
+# gravações de outros processos (filtro de Bloom da deduplicação, exportação de treino)
+COLUNA_GRAVADO_EM = 'gravado_em'
+
+def create_gravado_em_columns_if_not_exist(conn):
+    """Acrescenta 'gravado_em' (e o seu índice) a 'notas_fiscais' e ao arquivo, se já existir."""
+    if not conn or not conn.is_connected():
+        print("Erro: Conexão inválida para criar a coluna gravado_em.")
+        return
+    cursor = conn.cursor()
+    cursor.execute("SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() "
+                   f"AND TABLE_NAME IN ('notas_fiscais', '{TABELA_ARQUIVO}')")
+    for (tabela,) in cursor.fetchall():
+        _add_column_if_not_exists(cursor, tabela, COLUNA_GRAVADO_EM,
+                                  "DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)")
+        _criar_indice(cursor, f"CREATE INDEX idx_{COLUNA_GRAVADO_EM} ON {tabela} ({COLUNA_GRAVADO_EM});")
+    conn.commit()
+    print("Coluna 'gravado_em' verificada com sucesso.")
+
+
+def _ano_mes(valor) -> int:
+    """AAAAMM de uma data (date, datetime ou texto), como na coluna de partição 'ano_mes'."""
+    data = pd.Timestamp(valor)
+    return data.year * 100 + data.month
+
+
+def _construir_filtros(filtros, tabela='notas_fiscais', estado=None):
+    """
+    Traduz o dict de filtros nas condições WHERE, para 'tabela', com parâmetros nomeados (SQLAlchemy).
+    Chaves suportadas: emissao_de, emissao_ate, prestador_cnpj, tomador_cnpj, categoria,
+    valor_min, valor_max, termo + coluna_termo (pesquisa numa coluna de HEADERS_DB, com a
+    estratégia escolhida por planear_pesquisa) e hashes (lista de hashes, ex: um lote salvo).
+    """
+    condicoes, params = [], {}
+    filtros = filtros or {}
+    estado = estado or estado_tabelas()
+    particionada = tabela == 'notas_fiscais' and estado['particionada']
+    colunas_fulltext = estado['fulltext'].get(tabela, ())
+    if filtros.get('emissao_de'):
+        condicoes.append("`ocr_emissao_datahora` >= :emissao_de")
+        params['emissao_de'] = filtros['emissao_de']
+        if particionada: # Condição equivalente na coluna de partição: o MySQL só lê as partições do intervalo
+            condicoes.append("`ano_mes` >= :ano_mes_de")
+            params['ano_mes_de'] = _ano_mes(filtros['emissao_de'])
+    if filtros.get('emissao_ate'):
+        condicoes.append("`ocr_emissao_datahora` < :emissao_ate + INTERVAL 1 DAY") # Dia final inclusivo
+        params['emissao_ate'] = filtros['emissao_ate']
+        if particionada:
+            condicoes.append("`ano_mes` <= :ano_mes_ate")
+            params['ano_mes_ate'] = _ano_mes(filtros['emissao_ate'])
+    for chave, coluna in [('prestador_cnpj', 'ocr_prestador_cpf_cnpj'), ('tomador_cnpj', 'ocr_tomador_cpf_cnpj')]:
+        if filtros.get(chave):
+            condicao, params_cnpj, _ = planear_pesquisa(coluna, filtros[chave], nome_param=chave, colunas_fulltext=colunas_fulltext) # Só dígitos, indexado
+            condicoes.append(condicao)
+            params.update(params_cnpj)
+    if filtros.get('categoria'):
+        condicoes.append("`categoria` = :categoria")
+        params['categoria'] = filtros['categoria']
+    if filtros.get('valor_min') is not None:
+        condicoes.append("`ocr_valor_total` >= :valor_min")
+        params['valor_min'] = filtros['valor_min']
+    if filtros.get('valor_max') is not None:
+        condicoes.append("`ocr_valor_total` <= :valor_max")
+        params['valor_max'] = filtros['valor_max']
+    coluna_termo = filtros.get('coluna_termo')
+    if filtros.get('termo') and coluna_termo:
+        if coluna_termo not in HEADERS_DB: raise ValueError(f"Coluna de pesquisa inválida '{coluna_termo}'.")
+        condicao, params_termo, _ = planear_pesquisa(coluna_termo, filtros['termo'], colunas_fulltext=colunas_fulltext)
+        condicoes.append(condicao)
+        params.update(params_termo)
+    if filtros.get('hashes') is not None:
+        nomes = [f"hash_{i}" for i in range(len(filtros['hashes']))]
+        condicoes.append(f"`hash` IN ({', '.join(':' + n for n in nomes)})" if nomes else "FALSE")
+        params.update(zip(nomes, filtros['hashes']))
+    return condicoes, params
+
+
+def _tabelas_consulta(filtros, estado):
+    """'notas_fiscais' e, se o intervalo de emissão dos filtros puder conter notas arquivadas, o arquivo."""
+    arquivo_ate = estado['arquivo_emissao_max']
+    if arquivo_ate is None: return ['notas_fiscais']
+    emissao_de = (filtros or {}).get('emissao_de')
+    if emissao_de and pd.Timestamp(emissao_de) > pd.Timestamp(arquivo_ate): return ['notas_fiscais']
+    return ['notas_fiscais', TABELA_ARQUIVO]
+
+
+def _filtros_por_tabela(filtros, apos=None, ordenar_por=None, descendente=True):
+    """
+    [(tabela, condições)] para cada tabela a consultar (ver _tabelas_consulta) e os parâmetros de todas.
+    Os nomes dos parâmetros das tabelas seguintes levam um sufixo: a mesma pesquisa pode ter
+    parâmetros diferentes em cada tabela (FULLTEXT numa, LIKE na outra).
+    """
+    estado = estado_tabelas()
+    partes, params = [], {}
+    for i, tabela in enumerate(_tabelas_consulta(filtros, estado)):
+        condicoes, params_tabela = _construir_filtros(filtros, tabela, estado)
+        if apos is not None: condicoes.append(_condicao_cursor(ordenar_por, descendente, apos, params_tabela))
+        if i:
+            condicoes = [_RE_PARAM_NOMEADO.sub(rf':\1_{i}', c) for c in condicoes]
+            params_tabela = {f"{nome}_{i}": valor for nome, valor in params_tabela.items()}
+        partes.append((tabela, condicoes))
+        params.update(params_tabela)
+    return partes, params
+
+
+def _where(condicoes):
+    return " WHERE " + " AND ".join(condicoes) if condicoes else ""
+
+
+def _condicao_cursor(coluna, descendente, apos, params):
+    """
+    Condição de paginação por chave (coluna, hash) a partir do cursor 'apos' = (valor, hash).
+    Trata valores NULL na coluna de ordenação (o MySQL ordena-os primeiro em ASC e por último em DESC).
+    """
+    valor, ultimo_hash = apos
+    params['cursor_hash'] = ultimo_hash
+    op = '<' if descendente else '>'
+    if valor is None:
+        if descendente: return f"(`{coluna}` IS NULL AND `hash` < :cursor_hash)"
+        return f"((`{coluna}` IS NULL AND `hash` > :cursor_hash) OR `{coluna}` IS NOT NULL)"
+    params['cursor_valor'] = valor
+    condicao = f"(`{coluna}` {op} :cursor_valor OR (`{coluna}` = :cursor_valor AND `hash` {op} :cursor_hash)"
+    return condicao + (f" OR `{coluna}` IS NULL)" if descendente else ")")
+
+
+def _valor_cursor(valor):
+    """Converte o valor lido pelo Pandas num parâmetro que compara exatamente com a coluna no MySQL."""
+    if valor is None or pd.isna(valor): return None
+    if hasattr(valor, 'to_pydatetime'): return valor.to_pydatetime()
+    if isinstance(valor, float): return Decimal(repr(float(valor))) # DECIMAL(15,2) lido como float: repr é exato
+    if hasattr(valor, 'item'): return valor.item() # Escalares NumPy
+    return valor
+
+
+@cache_consulta('notas_fiscais')
+def consultar_notas_paginado(filtros=None, colunas=None, ordenar_por='data_processamento', descendente=True,
+                             limite=TAMANHO_PAGINA_PADRAO, apos=None):
+    """
+    Lê uma página de notas com paginação por chave: o custo não depende da posição da página.
+
+    'colunas' é a projeção (por omissão, sem as colunas TEXT grandes); 'apos' é o cursor
+    (valor da coluna de ordenação, hash) devolvido pela página anterior. Com limite=None
+    devolve todas as linhas do filtro (sem paginação).
+    Retorna (DataFrame, cursor da página seguinte ou None se esta for a última).
+    """
+    if ordenar_por not in COLUNAS_ORDENAVEIS:
+        print(f"Erro: Coluna de ordenação inválida '{ordenar_por}'.")
+        _marcar_erro_leitura()
+        return pd.DataFrame(), None
+    colunas = [c for c in (colunas or COLUNAS_CONSULTA_PADRAO) if c in HEADERS_DB]
+    colunas_select = list(dict.fromkeys(colunas + [ordenar_por, 'hash'])) # O cursor precisa destas duas
+    try:
+        partes, params = _filtros_por_tabela(filtros, apos if limite is not None else None, ordenar_por, descendente)
+        direcao = 'DESC' if descendente else 'ASC'
+        ordenacao = f" ORDER BY `{ordenar_por}` {direcao}, `hash` {direcao}"
+        if limite is not None:
+            ordenacao += " LIMIT :limite"
+            params['limite'] = int(limite) + 1 # Uma linha extra indica se há página seguinte
+        consultas = [sql_select(tuple(colunas_select), tabela) + _where(condicoes) for tabela, condicoes in partes]
+        if len(consultas) == 1: query = consultas[0] + ordenacao
+        else: # Notas arquivadas: cada tabela ordena e limita com os seus índices, e o resultado junto outra vez
+            query = " UNION ALL ".join(f"({consulta}{ordenacao})" for consulta in consultas) + ordenacao
+        with obter_conexao_leitura() as connection:
+            df = tipar_dataframe(pd.read_sql(text(query), connection, params=params))
+    except Exception as e:
+        print(f"Erro ao consultar notas (página): {e}")
+        traceback.print_exc()
+        _marcar_erro_leitura()
+        return pd.DataFrame(), None
+
+    proximo = None
+    if limite is not None and len(df) > limite:
+        df = df.iloc[:limite]
+        ultima = df.iloc[-1]
+        proximo = (_valor_cursor(ultima[ordenar_por]), ultima['hash'])
+    return df[colunas].reset_index(drop=True), proximo
+
+
+@cache_consulta('notas_fiscais')
+def contar_notas(filtros=None):
+    """Número de notas que satisfazem os filtros (COUNT no MySQL). Retorna None em caso de erro."""
+    try:
+        partes, params = _filtros_por_tabela(filtros)
+        query = "SELECT " + " + ".join(f"(SELECT COUNT(*) FROM {tabela}{_where(condicoes)})" for tabela, condicoes in partes)
+        with obter_conexao_leitura() as connection:
+            return connection.execute(text(query), params).scalar()
+    except Exception as e:
+        print(f"Erro ao contar notas: {e}")
+        return None
+
+
+COLUNAS_VALORES_RETIDOS = ['ocr_valor_iss', 'ocr_valor_inss', 'ocr_valor_pis_pasep', 'ocr_valor_cofins', 'ocr_valor_csll', 'ocr_valor_irrf']
+COLUNAS_SOMA_PADRAO = ['ocr_valor_total'] + COLUNAS_VALORES_RETIDOS
+
+@cache_consulta('notas_fiscais')
+def agregar_notas(filtros=None, colunas=None):
+    """
+    COUNT e SUMs das colunas DECIMAL para as notas que satisfazem os filtros, calculados no MySQL.
+    Retorna {'total_notas': int, 'total_retido': Decimal, <coluna>: Decimal, ...} (somas exatas,
+    NULL conta como 0), ou None em caso de erro.
+    """
+    colunas = [c for c in (colunas or COLUNAS_SOMA_PADRAO) if c in HEADERS_DB]
+    try:
+        partes, params = _filtros_por_tabela(filtros)
+        somas = ", ".join(f"COALESCE(SUM(`{c}`), 0) AS `{c}`" for c in colunas)
+        consultas = [f"SELECT COUNT(*) AS total_notas{', ' + somas if somas else ''} FROM {tabela}{_where(condicoes)}"
+                     for tabela, condicoes in partes]
+        query = consultas[0]
+        if len(consultas) > 1: # Agregados de cada tabela somados
+            query = (f"SELECT SUM(total_notas) AS total_notas{''.join(f', SUM(`{c}`) AS `{c}`' for c in colunas)} "
+                     f"FROM ({' UNION ALL '.join(consultas)}) AS partes")
+        with obter_conexao_leitura() as connection:
+            linha = connection.execute(text(query), params).mappings().one()
+    except Exception as e:
+        print(f"Erro ao agregar notas: {e}")
+        return None
+    resultado = {c: Decimal(linha[c]) for c in colunas}
+    resultado['total_notas'] = int(linha['total_notas'])
+    resultado['total_retido'] = sum((resultado[c] for c in COLUNAS_VALORES_RETIDOS if c in resultado), Decimal('0'))
+    return resultado
+
+
+_RE_PARAM_NOMEADO = re.compile(r':(\w+)')
+
+def iterar_notas(filtros=None, colunas=None, tamanho_bloco: int = 2000):
+    """
+    Gera blocos de linhas (listas de tuplos, na ordem de 'colunas') das notas que satisfazem
+    os filtros, lidas com um cursor não bufferizado: o MySQL envia as linhas à medida que são
+    consumidas e só um bloco fica em memória.
+    """
+    colunas = [c for c in (colunas or HEADERS_DB) if c in HEADERS_DB]
+    partes, params = _filtros_por_tabela(filtros)
+    # Uma tabela de cada vez (notas_fiscais e depois o arquivo), cada uma na ordem do seu índice
+    consultas = [_RE_PARAM_NOMEADO.sub(r'%(\1)s', # Parâmetros nomeados (SQLAlchemy) -> pyformat (mysql.connector)
+                                       sql_select(tuple(colunas), tabela) + _where(condicoes) + " ORDER BY `data_processamento`, `hash`")
+                 for tabela, condicoes in partes]
+
+    conn = create_connection()
+    if not conn: raise RuntimeError("Não foi possível obter uma conexão para ler as notas.")
+    cursor = None
+    try:
+        for query in consultas:
+            cursor = conn.cursor(buffered=False)
+            cursor.execute(query, params)
+            while True:
+                linhas = cursor.fetchmany(tamanho_bloco)
+                if not linhas: break
+                yield linhas
+            cursor.close()
+            cursor = None
+    finally:
+        if cursor is not None:
+            try: cursor.close() # Descarta as linhas não lidas (se o consumidor parou a meio)
+            except mysql.connector.Error: pass
+        conn.close()
@@ -0,0 +1,108 @@
+"""
+Normalização da data/hora de emissão extraída pelo OCR/LLM para 'AAAA-MM-DD HH:MM:SS'.
+
+O texto é primeiro limpo (blocos ```json, parênteses, caracteres estranhos; '-' e '.' passam a
+'/'). Os formatos habituais (dd/mm/aaaa e aaaa/mm/dd, com hora opcional) são lidos diretamente
+para inteiros, sem strptime. Os restantes tentam a lista FORMATOS_DATA, começando pelo formato
+que funcionou da última vez para o mesmo "layout" (o texto com os dígitos trocados por '9'),
+em vez de falhar com exceções formato a formato. Não escreve nada no log.
+
+O resultado é o mesmo da versão anterior (tentar FORMATOS_DATA por ordem e, se nenhum servir,
+procurar uma data no texto original com uma expressão regular).
+"""
+import re
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+FORMATOS_DATA = [
+    '%d/%m/%Y %H:%M:%S', '%Y/%m/%d %H:%M:%S',
+    '%d/%m/%Y %H:%M',    '%Y/%m/%d %H:%M',
+    '%d/%m/%Y',          '%Y/%m/%d',
+    '%Y-%m-%dT%H:%M:%SZ', '%Y/%m/%dT%H:%M:%SZ',
+]
+FORMATOS_DATA.extend([f.replace('/', '-') for f in FORMATOS_DATA if '/' in f])
+
+MAX_LAYOUTS_MEMORIZADOS = 1024
+
+_RE_PARENTESES = re.compile(r'\s*\(.*\)\s*')
+_RE_CARACTERES_INVALIDOS = re.compile(r'[^\d/\-:\sTZtz]')
+_RE_PESCA = re.compile(
+    r'(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})[\sT]*(\d{1,2}:\d{1,2}(:\d{1,2})?)?|'
+    r'(\d{4}[/-]\d{1,2}[/-]\d{1,2})[\sT]*(\d{1,2}:\d{1,2}(:\d{1,2})?)?Z?'
+)
+# Formatos lidos diretamente (só dígitos ASCII; a hora, se existir, vem depois de um espaço)
+_RE_DIA_MES_ANO = re.compile(r'([0-9]{1,2})/([0-9]{1,2})/([0-9]{4})(?: ([0-9]{1,2}):([0-9]{1,2})(?::([0-9]{1,2}))?)?')
+_RE_ANO_MES_DIA = re.compile(r'([0-9]{4})/([0-9]{1,2})/([0-9]{1,2})(?: ([0-9]{1,2}):([0-9]{1,2})(?::([0-9]{1,2}))?)?')
+_RE_ANO = re.compile(r'\d{4}') # Todos os formatos têm %Y (4 dígitos): sem isto nenhum serve
+_LAYOUT = str.maketrans('0123456789', '9999999999')
+
+_formato_por_layout: Dict[str, int] = {}
+
+
+def _leitura_direta(texto: str) -> Optional[datetime]:
+    """dd/mm/aaaa [hh:mm[:ss]] ou aaaa/mm/dd [hh:mm[:ss]] (ignorando 'Z', como os formatos sem 'Z')."""
+    texto = texto.replace('Z', '')
+    match = _RE_DIA_MES_ANO.fullmatch(texto)
+    if match:
+        dia, mes, ano, hora, minuto, segundo = match.groups()
+    else:
+        match = _RE_ANO_MES_DIA.fullmatch(texto)
+        if not match: return None
+        ano, mes, dia, hora, minuto, segundo = match.groups()
+    try:
+        return datetime(int(ano), int(mes), int(dia), int(hora or 0), int(minuto or 0), int(segundo or 0))
+    except ValueError:
+        return None # Ex: 31/02; strptime decide (e a pesca no texto original, se falhar)
+
+
+def _tentar_formatos(texto: str, ajustar_separador: bool = False) -> Optional[datetime]:
+    """Primeiro formato de FORMATOS_DATA que aceita o texto (o memorizado para o layout é tentado antes)."""
+    if not _RE_ANO.search(texto): return None
+    layout = texto.translate(_LAYOUT)
+    memorizado = _formato_por_layout.get(layout)
+    ordem = range(len(FORMATOS_DATA))
+    if memorizado is not None: ordem = [memorizado] + [i for i in ordem if i != memorizado]
+    for i in ordem:
+        fmt = FORMATOS_DATA[i]
+        str_to_parse = texto.replace('Z', '') if 'Z' not in fmt else texto
+        if ajustar_separador:
+            if '/' in fmt and '-' in str_to_parse: str_to_parse = str_to_parse.replace('-', '/')
+            if '-' in fmt and '/' in str_to_parse: str_to_parse = str_to_parse.replace('/', '-')
+        try:
+            dt_obj = datetime.strptime(str_to_parse, fmt)
+        except ValueError:
+            continue
+        if memorizado != i:
+            if len(_formato_por_layout) >= MAX_LAYOUTS_MEMORIZADOS: _formato_por_layout.clear()
+            _formato_por_layout[layout] = i
+        return dt_obj
+    return None
+
+
+def interpretar_datahora(valor: Any) -> Optional[datetime]:
+    """Interpreta a data/hora de emissão em texto livre. Retorna None se não for reconhecida."""
+    if not isinstance(valor, str) or not valor or valor.strip() == "...": return None
+    texto = valor.replace("```", "").replace("json", "").strip()
+    texto = _RE_PARENTESES.sub('', texto).strip()
+    texto = _RE_CARACTERES_INVALIDOS.sub('', texto).strip()
+    texto = texto.replace('.', '/').replace('-', '/').replace('//', '/')
+
+    dt_obj = _leitura_direta(texto) or _tentar_formatos(texto)
+    if dt_obj is not None: return dt_obj
+
+    # Nenhum formato serviu: procura uma data (e hora) no texto original
+    match = _RE_PESCA.search(valor)
+    if not match: return None
+    if match.group(1) and match.group(2): data_pescada, hora_pescada = match.group(1), match.group(2)
+    elif match.group(4) and match.group(5): data_pescada, hora_pescada = match.group(4), match.group(5)
+    elif match.group(1): data_pescada, hora_pescada = match.group(1), ""
+    elif match.group(4): data_pescada, hora_pescada = match.group(4), ""
+    else: return None
+    return _tentar_formatos(f"{data_pescada.strip()} {hora_pescada.strip() if hora_pescada else ''}".strip(),
+                            ajustar_separador=True)
+
+
+def normalizar_datahora(valor: Any) -> Optional[str]:
+    """Data/hora de emissão como 'AAAA-MM-DD HH:MM:SS' (meia-noite se só houver data), ou None."""
+    dt_obj = interpretar_datahora(valor)
+    return dt_obj.strftime('%Y-%m-%d %H:%M:%S') if dt_obj is not None else None
@@ -0,0 +1,158 @@
+"""
+Serviço de deduplicação por hash de ficheiro.
+
+Substitui o carregamento de todos os hashes ('get_all_hashes') no início de cada lote:
+apenas os hashes candidatos do lote são consultados, em blocos de 'WHERE hash IN (...)'.
+Opcionalmente (DEDUP_USAR_BLOOM=1), um filtro de Bloom local elimina à partida os hashes
+que de certeza não existem, e só os "talvez existentes" chegam ao MySQL.
+
+O filtro recebe logo as inserções deste processo e, antes de ser usado (no máximo a cada
+DEDUP_BLOOM_SINCRONIZAR_SEGUNDOS), os hashes gravados por outros processos (monitor de pasta,
+outras sessões) desde a última sincronização, pela coluna 'gravado_em' (relógio do MySQL).
+A leitura recua BLOOM_MARGEM_SEGUNDOS, para apanhar as transações confirmadas depois de a marca
+ter sido lida. Se a sincronização falhar, o filtro não é usado nessa consulta.
+"""
+import os
+import math
+import hashlib
+import time
+import threading
+from datetime import timedelta
+from typing import Iterable, Set
+
+import mysql.connector
+
+from .database import registar_ouvinte_insercao, conexao_emprestada, COLUNA_GRAVADO_EM
+
+TAMANHO_LOTE_IN = 500
+USAR_BLOOM = os.getenv('DEDUP_USAR_BLOOM', '0').lower() in ('1', 'true', 'sim')
+BLOOM_TAXA_FALSOS_POSITIVOS = 0.01
+BLOOM_SINCRONIZAR_SEGUNDOS = float(os.getenv('DEDUP_BLOOM_SINCRONIZAR_SEGUNDOS', '0')) # 0: antes de cada consulta
+BLOOM_MARGEM_SEGUNDOS = 60
+TABELAS_NOTAS = ['notas_fiscais', 'notas_fiscais_arquivo'] # Notas de anos fechados também contam (ver Backend/particoes.py)
+
+
+class FiltroBloom:
+    """Filtro de Bloom simples sobre um bytearray; as k posições vêm de um único blake2b."""
+
+    def __init__(self, capacidade: int, taxa_falsos_positivos: float = BLOOM_TAXA_FALSOS_POSITIVOS):
+        capacidade = max(capacidade, 1000)
+        self.num_bits = int(-capacidade * math.log(taxa_falsos_positivos) / (math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacidade * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _posicoes(self, valor: str):
+        digest = hashlib.blake2b(valor.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)] # Double hashing
+
+    def adicionar(self, valor: str):
+        with self._lock:
+            for pos in self._posicoes(valor):
+                self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, valor: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._posicoes(valor))
+
+
+# ==============================================================================
+# FILTRO DE BLOOM DO PROCESSO
+# ==============================================================================
+_bloom = None
+_bloom_marca = None # NOW(6) do MySQL lido antes da última carga/sincronização
+_bloom_sincronizado = 0.0
+_bloom_lock = threading.Lock()
+
+def _carregar_bloom(conn):
+    """Constrói o filtro uma única vez por processo, lendo os hashes por páginas de chave."""
+    global _bloom, _bloom_marca, _bloom_sincronizado
+    with _bloom_lock:
+        if _bloom is not None: return _bloom
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT NOW(6)")
+            marca = cursor.fetchone()[0]
+            total = 0
+            for tabela in TABELAS_NOTAS:
+                cursor.execute(f"SELECT COUNT(*) FROM {tabela}")
+                total += cursor.fetchone()[0]
+            filtro = FiltroBloom(capacidade=total * 2)
+            for tabela in TABELAS_NOTAS:
+                ultimo = ''
+                while True:
+                    cursor.execute(f"SELECT hash FROM {tabela} WHERE hash > %s ORDER BY hash LIMIT 10000", (ultimo,))
+                    linhas = cursor.fetchall()
+                    if not linhas: break
+                    for (h,) in linhas: filtro.adicionar(h)
+                    ultimo = linhas[-1][0]
+            _bloom, _bloom_marca, _bloom_sincronizado = filtro, marca, time.monotonic()
+            print(f"Filtro de Bloom de deduplicação carregado ({total} hashes, {filtro.num_bits // 8 // 1024} KiB).")
+        except mysql.connector.Error as e:
+            print(f"Erro ao carregar o filtro de Bloom de deduplicação: {e}")
+    return _bloom
+
+
+def _sincronizar_bloom() -> bool:
+    """
+    Acrescenta ao filtro os hashes gravados (por qualquer processo) desde a última sincronização.
+    Usa uma conexão própria do pool: a do chamador pode estar numa transação com um snapshot antigo.
+    """
+    global _bloom_marca, _bloom_sincronizado
+    with _bloom_lock:
+        if time.monotonic() - _bloom_sincronizado < BLOOM_SINCRONIZAR_SEGUNDOS: return True
+        try:
+            with conexao_emprestada() as conn:
+                if not conn: return False
+                cursor = conn.cursor()
+                cursor.execute("SELECT NOW(6)")
+                marca = cursor.fetchone()[0]
+                desde = _bloom_marca - timedelta(seconds=BLOOM_MARGEM_SEGUNDOS)
+                for tabela in TABELAS_NOTAS:
+                    cursor.execute(f"SELECT hash FROM {tabela} WHERE {COLUNA_GRAVADO_EM} >= %s", (desde,))
+                    for (h,) in cursor.fetchall(): _bloom.adicionar(h)
+        except mysql.connector.Error as e:
+            print(f"Erro ao sincronizar o filtro de Bloom de deduplicação: {e}")
+            return False
+        _bloom_marca, _bloom_sincronizado = marca, time.monotonic()
+        return True
+
+
+def _ao_inserir(hashes: Iterable[str]):
+    """Ouvinte de inserções: as gravações deste processo entram logo no filtro de Bloom."""
+    if _bloom is not None:
+        for h in hashes: _bloom.adicionar(h)
+
+registar_ouvinte_insercao(_ao_inserir)
+
+
+# ==============================================================================
+# CONSULTA
+# ==============================================================================
+def hashes_existentes(conn, candidatos: Iterable[str], tamanho_lote: int = TAMANHO_LOTE_IN,
+                      propagar_erros: bool = False) -> Set[str]:
+    """
+    Retorna o subconjunto dos hashes candidatos que já existem em 'notas_fiscais' ou no arquivo.
+    Com propagar_erros=True, um erro do MySQL é levantado em vez de devolver o conjunto parcial
+    (quem chama distingue "não existe" de "não foi possível verificar").
+    """
+    candidatos = [h for h in dict.fromkeys(candidatos) if h]
+    if not conn or not conn.is_connected() or not candidatos: return set()
+    if USAR_BLOOM:
+        filtro = _carregar_bloom(conn)
+        if filtro is not None and _sincronizar_bloom():
+            candidatos = [h for h in candidatos if h in filtro] # Negativos do Bloom são definitivos (após sincronizar)
+    existentes = set()
+    try:
+        cursor = conn.cursor()
+        for inicio in range(0, len(candidatos), tamanho_lote):
+            bloco = candidatos[inicio:inicio + tamanho_lote]
+            placeholders = ', '.join(['%s'] * len(bloco))
+            query = " UNION ALL ".join(f"SELECT hash FROM {t} WHERE hash IN ({placeholders})" for t in TABELAS_NOTAS)
+            cursor.execute(query, tuple(bloco) * len(TABELAS_NOTAS))
+            existentes.update(row[0] for row in cursor.fetchall())
+    except mysql.connector.Error as e:
+        if propagar_erros: raise
+        print(f"Erro ao verificar hashes existentes: {e}")
+    return existentes
@@ -0,0 +1,330 @@
+"""
+Deteção de quase-duplicados antes da etapa do LLM.
+
+O hash MD5 do ficheiro não apanha a mesma nota digitalizada duas vezes, um PDF
+reexportado ou uma captura de ecrã de um PDF. Este módulo mantém um índice
+MinHash/LSH sobre o texto OCR normalizado (persistido em 'indice_duplicados') e um
+índice exato sobre a chave fiscal (CNPJ do prestador, número, código de verificação).
+
+A assinatura MinHash é calculada logo após o OCR. A similaridade sozinha não chega para
+descartar uma nota: notas mensais do mesmo prestador para o mesmo tomador têm quase o mesmo
+texto. Uma nota só é tratada como duplicado se a sua chave fiscal for igual à da nota parecida.
+Com similaridade muito alta (DUPLICADOS_LIMIAR_ATALHO) essa chave é procurada primeiro no
+próprio texto OCR, por expressões regulares (confirmar_duplicado_no_texto): se o CNPJ, o número
+e o código de verificação da nota parecida lá estão, é um duplicado e o LLM não é chamado. Caso
+contrário, a chave extraída pelo LLM decide (confirmar_duplicado) e, se for outra, a nota segue
+para revisão com o aviso.
+
+O índice em memória de cada processo é sincronizado com as notas registadas por outros processos
+(monitor de pastas, outras sessões) pela coluna 'gravado_em' de 'indice_duplicados', como o
+filtro de Bloom da deduplicação por hash (ver Backend/deduplicacao.py).
+"""
+import os
+import re
+import zlib
+import time
+import threading
+import unicodedata
+from datetime import timedelta
+from typing import Dict, Any, Optional, Tuple, List
+
+import numpy as np
+import mysql.connector
+
+from .database import conexao_emprestada, _add_column_if_not_exists, _criar_indice, COLUNA_GRAVADO_EM
+
+# ==============================================================================
+# PARÂMETROS MINHASH / LSH
+# ==============================================================================
+NUM_PERMUTACOES = 128
+NUM_BANDAS = 16 # 16 bandas x 8 linhas: candidatos a partir de ~0.7 de similaridade
+LINHAS_POR_BANDA = NUM_PERMUTACOES // NUM_BANDAS
+TAMANHO_SHINGLE = 5 # Shingles de caracteres toleram erros pontuais de OCR
+LIMIAR_SIMILARIDADE = float(os.getenv('DUPLICADOS_LIMIAR_SIMILARIDADE', '0.85'))
+LIMIAR_ATALHO = float(os.getenv('DUPLICADOS_LIMIAR_ATALHO', '0.95')) # Chave procurada no texto OCR, antes do LLM
+SINCRONIZAR_SEGUNDOS = float(os.getenv('DUPLICADOS_SINCRONIZAR_SEGUNDOS', '0')) # 0: a cada obter_indice
+MARGEM_SINCRONIZAR_SEGUNDOS = 60
+
+_PRIMO_MERSENNE = (1 << 31) - 1
+_rng = np.random.RandomState(20240315) # Semente fixa: assinaturas persistidas têm de ser reprodutíveis
+_COEF_A = _rng.randint(1, _PRIMO_MERSENNE, size=NUM_PERMUTACOES, dtype=np.int64)
+_COEF_B = _rng.randint(0, _PRIMO_MERSENNE, size=NUM_PERMUTACOES, dtype=np.int64)
+
+_RE_NAO_ALFANUMERICO = re.compile(r'[^a-z0-9]+')
+_RE_NAO_DIGITO = re.compile(r'\D+')
+_RE_NUMERO_FORMATADO = re.compile(r'\d(?:[\d./-]*\d)?') # "12.345.678/0001-90", "000123", "2024-01"
+
+
+# ==============================================================================
+# NORMALIZAÇÃO E ASSINATURAS
+# ==============================================================================
+def normalizar_texto(texto: str) -> str:
+    """Minúsculas, sem acentos e com pontuação/espaços colapsados num único espaço."""
+    texto = unicodedata.normalize('NFKD', texto or '').encode('ascii', 'ignore').decode('ascii').lower()
+    return _RE_NAO_ALFANUMERICO.sub(' ', texto).strip()
+
+
+def calcular_assinatura(texto: str) -> Optional[np.ndarray]:
+    """Calcula a assinatura MinHash (NUM_PERMUTACOES x uint32) do texto OCR. None se o texto for curto demais."""
+    normalizado = normalizar_texto(texto)
+    if len(normalizado) < TAMANHO_SHINGLE: return None
+    shingles = {normalizado[i:i + TAMANHO_SHINGLE] for i in range(len(normalizado) - TAMANHO_SHINGLE + 1)}
+    hashes = np.fromiter((zlib.crc32(s.encode('ascii')) for s in shingles), dtype=np.int64, count=len(shingles))
+    # (a*h + b) mod p para todas as permutações de uma vez: matriz NUM_PERMUTACOES x n_shingles
+    permutados = (np.outer(_COEF_A, hashes) + _COEF_B[:, None]) % _PRIMO_MERSENNE
+    return permutados.min(axis=1).astype(np.uint32)
+
+
+def similaridade(assinatura_a: np.ndarray, assinatura_b: np.ndarray) -> float:
+    """Estimativa da similaridade de Jaccard entre dois textos a partir das assinaturas."""
+    return float(np.count_nonzero(assinatura_a == assinatura_b)) / NUM_PERMUTACOES
+
+
+def chave_fiscal(dados: Dict[str, Any]) -> Optional[str]:
+    """Chave exata (CNPJ do prestador|número|código de verificação) normalizada, ou None se incompleta."""
+    if not dados: return None
+    cnpj = _RE_NAO_DIGITO.sub('', str(dados.get('ocr_prestador_cpf_cnpj') or ''))
+    numero = _RE_NAO_DIGITO.sub('', str(dados.get('ocr_numero') or '')).lstrip('0')
+    codigo = _RE_NAO_ALFANUMERICO.sub('', str(dados.get('ocr_codigo_verificacao') or '').lower())
+    if not cnpj or not numero: return None
+    return f"{cnpj}|{numero}|{codigo}"
+
+
+def chave_no_texto(chave: Optional[str], texto_ocr: str) -> bool:
+    """
+    True se o texto OCR contém a chave fiscal 'chave' (de chave_fiscal): o CNPJ e o número como
+    sequências de dígitos (com ou sem pontuação e zeros à esquerda) e o código de verificação, se houver.
+    """
+    if not chave or not texto_ocr: return False
+    cnpj, numero, codigo = chave.split('|')
+    numeros = {_RE_NAO_DIGITO.sub('', n) for n in _RE_NUMERO_FORMATADO.findall(texto_ocr)}
+    if cnpj not in numeros or numero not in {n.lstrip('0') for n in numeros}: return False
+    return not codigo or codigo in normalizar_texto(texto_ocr).replace(' ', '')
+
+
+# ==============================================================================
+# TABELA
+# ==============================================================================
+def create_duplicados_table_if_not_exists(conn):
+    """Cria a tabela 'indice_duplicados' se ela não existir."""
+    if not conn or not conn.is_connected():
+        print("Erro: Conexão inválida para criar tabela indice_duplicados.")
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS indice_duplicados (
+                hash VARCHAR(32) PRIMARY KEY,
+                assinatura VARBINARY(512) NULL,
+                chave_fiscal VARCHAR(120) NULL,
+                INDEX idx_chave_fiscal (chave_fiscal)
+            );
+        """)
+        conn.commit()
+        print("Tabela 'indice_duplicados' verificada/atualizada com sucesso.")
+    except mysql.connector.Error as e:
+        print(f"Erro ao criar a tabela indice_duplicados: {e}")
+        raise
+
+
+def create_gravado_em_duplicados_if_not_exists(conn):
+    """Acrescenta 'gravado_em' (e o seu índice) a 'indice_duplicados', para a sincronização entre processos."""
+    if not conn or not conn.is_connected():
+        print("Erro: Conexão inválida para criar a coluna gravado_em em indice_duplicados.")
+        return
+    cursor = conn.cursor()
+    _add_column_if_not_exists(cursor, 'indice_duplicados', COLUNA_GRAVADO_EM,
+                              "DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)")
+    _criar_indice(cursor, f"CREATE INDEX idx_{COLUNA_GRAVADO_EM} ON indice_duplicados ({COLUNA_GRAVADO_EM});")
+    conn.commit()
+
+
+# ==============================================================================
+# ÍNDICE EM MEMÓRIA
+# ==============================================================================
+class IndiceDuplicados:
+    """Índice LSH (bandas da assinatura MinHash) + dicionário de chaves fiscais."""
+
+    def __init__(self):
+        self._assinaturas = {} # hash -> assinatura
+        self._baldes = {} # (banda, bytes da banda) -> [hashes]
+        self._chaves = {} # chave fiscal -> hash
+        self._chave_por_hash = {} # hash -> chave fiscal
+        self._marca = None # NOW(6) do MySQL lido antes da última carga/sincronização
+        self._sincronizado = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._assinaturas)
+
+    def adicionar(self, current_hash: str, assinatura: Optional[np.ndarray], chave: Optional[str] = None):
+        """Adiciona (ou substitui) uma nota no índice em memória."""
+        with self._lock:
+            if assinatura is not None and current_hash not in self._assinaturas:
+                self._assinaturas[current_hash] = assinatura
+                for banda in range(NUM_BANDAS):
+                    trecho = assinatura[banda * LINHAS_POR_BANDA:(banda + 1) * LINHAS_POR_BANDA].tobytes()
+                    self._baldes.setdefault((banda, trecho), []).append(current_hash)
+            if chave:
+                self._chaves[chave] = current_hash
+                self._chave_por_hash[current_hash] = chave
+
+    def procurar(self, assinatura: Optional[np.ndarray], ignorar_hash: Optional[str] = None,
+                 limiar: float = LIMIAR_SIMILARIDADE) -> Optional[Tuple[str, float]]:
+        """Retorna (hash, similaridade) da nota mais parecida acima do limiar, ou None."""
+        if assinatura is None: return None
+        with self._lock:
+            candidatos = set()
+            for banda in range(NUM_BANDAS):
+                trecho = assinatura[banda * LINHAS_POR_BANDA:(banda + 1) * LINHAS_POR_BANDA].tobytes()
+                candidatos.update(self._baldes.get((banda, trecho), ()))
+            candidatos.discard(ignorar_hash)
+            melhor = None
+            for candidato in candidatos:
+                sim = similaridade(assinatura, self._assinaturas[candidato])
+                if sim >= limiar and (melhor is None or sim > melhor[1]):
+                    melhor = (candidato, sim)
+        return melhor
+
+    def procurar_chave(self, chave: Optional[str], ignorar_hash: Optional[str] = None) -> Optional[str]:
+        """Retorna o hash da nota já registada com a mesma chave fiscal, ou None."""
+        if not chave: return None
+        encontrado = self._chaves.get(chave)
+        return encontrado if encontrado != ignorar_hash else None
+
+    def chave_de(self, current_hash: str) -> Optional[str]:
+        """Chave fiscal registada para uma nota, ou None."""
+        return self._chave_por_hash.get(current_hash)
+
+    def _adicionar_linhas(self, linhas):
+        for current_hash, assinatura, chave in linhas:
+            sig = np.frombuffer(bytes(assinatura), dtype=np.uint32) if assinatura else None
+            self.adicionar(current_hash, sig, chave)
+
+    def carregar(self, conn) -> 'IndiceDuplicados':
+        """Carrega todas as entradas persistidas para o índice em memória."""
+        if not conn or not conn.is_connected(): return self
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT NOW(6)")
+            marca = cursor.fetchone()[0]
+            cursor.execute("SELECT hash, assinatura, chave_fiscal FROM indice_duplicados")
+            self._adicionar_linhas(cursor.fetchall())
+            self._marca, self._sincronizado = marca, time.monotonic()
+        except mysql.connector.Error as e:
+            print(f"Erro ao carregar o índice de duplicados: {e}")
+        return self
+
+    def sincronizar(self) -> bool:
+        """
+        Acrescenta as notas registadas (por qualquer processo) desde a carga ou a última sincronização,
+        recuando MARGEM_SINCRONIZAR_SEGUNDOS (transações confirmadas depois de a marca ter sido lida).
+        Usa uma conexão própria do pool: a do chamador pode estar numa transação com um snapshot antigo.
+        """
+        if self._marca is None: return False
+        try:
+            with conexao_emprestada() as conn:
+                if conn is None: return False
+                cursor = conn.cursor()
+                cursor.execute("SELECT NOW(6)")
+                marca = cursor.fetchone()[0]
+                cursor.execute(f"SELECT hash, assinatura, chave_fiscal FROM indice_duplicados WHERE {COLUNA_GRAVADO_EM} >= %s",
+                               (self._marca - timedelta(seconds=MARGEM_SINCRONIZAR_SEGUNDOS),))
+                self._adicionar_linhas(cursor.fetchall())
+        except mysql.connector.Error as e:
+            print(f"Erro ao sincronizar o índice de duplicados: {e}")
+            return False
+        self._marca, self._sincronizado = marca, time.monotonic()
+        return True
+
+
+_indice = None
+_indice_lock = threading.Lock()
+
+def obter_indice(conn) -> IndiceDuplicados:
+    """
+    Índice partilhado pelo processo (carregado da base de dados na primeira chamada e, nas
+    seguintes, sincronizado com as notas registadas por outros processos).
+    """
+    global _indice
+    with _indice_lock:
+        if _indice is None:
+            _indice = IndiceDuplicados().carregar(conn)
+            print(f"Índice de duplicados carregado com {len(_indice)} notas.")
+        elif time.monotonic() - _indice._sincronizado >= SINCRONIZAR_SEGUNDOS:
+            _indice.sincronizar()
+    return _indice
+
+
+def registar_nota(conn, current_hash: str, texto_ocr: Optional[str], dados: Optional[Dict[str, Any]] = None) -> bool:
+    """Regista uma nota salva no índice persistido e no índice em memória do processo."""
+    if not conn or not conn.is_connected() or not current_hash: return False
+    assinatura = calcular_assinatura(texto_ocr) if texto_ocr else None
+    chave = chave_fiscal(dados)
+    if assinatura is None and chave is None: return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "REPLACE INTO indice_duplicados (hash, assinatura, chave_fiscal) VALUES (%s, %s, %s)",
+            (current_hash, assinatura.tobytes() if assinatura is not None else None, chave)
+        )
+        conn.commit()
+    except mysql.connector.Error as e:
+        print(f"Erro ao registar nota no índice de duplicados (hash: {current_hash}): {e}")
+        return False
+    obter_indice(conn).adicionar(current_hash, assinatura, chave)
+    return True
+
+
+def registar_notas(conn, itens: List[Tuple[str, Optional[str], Optional[Dict[str, Any]]]]) -> int:
+    """
+    Versão em lote de registar_nota: 'itens' são tuplos (hash, texto OCR, dados).
+    Grava todas as entradas com um único executemany e um commit. Retorna quantas foram registadas.
+    """
+    if not conn or not conn.is_connected() or not itens: return 0
+    entradas = []
+    for current_hash, texto_ocr, dados in itens:
+        if not current_hash: continue
+        assinatura = calcular_assinatura(texto_ocr) if texto_ocr else None
+        chave = chave_fiscal(dados)
+        if assinatura is None and chave is None: continue
+        entradas.append((current_hash, assinatura, chave))
+    if not entradas: return 0
+    try:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "REPLACE INTO indice_duplicados (hash, assinatura, chave_fiscal) VALUES (%s, %s, %s)",
+            [(h, a.tobytes() if a is not None else None, c) for h, a, c in entradas]
+        )
+        conn.commit()
+    except mysql.connector.Error as e:
+        print(f"Erro ao registar {len(entradas)} notas no índice de duplicados: {e}")
+        return 0
+    indice = obter_indice(conn)
+    for current_hash, assinatura, chave in entradas: indice.adicionar(current_hash, assinatura, chave)
+    return len(entradas)
+
+
+def verificar_texto(indice: Optional[IndiceDuplicados], texto_ocr: str,
+                    ignorar_hash: Optional[str] = None) -> Optional[Tuple[str, float]]:
+    """Atalho para o processador: assinatura + consulta LSH num só passo."""
+    if indice is None or not texto_ocr: return None
+    return indice.procurar(calcular_assinatura(texto_ocr), ignorar_hash=ignorar_hash)
+
+
+def confirmar_duplicado_no_texto(indice: Optional[IndiceDuplicados], quase_duplicado: Optional[Tuple[str, float]],
+                                 texto_ocr: str) -> bool:
+    """
+    Confirmação antes do LLM: True se a similaridade é de pelo menos LIMIAR_ATALHO e a chave fiscal
+    da nota parecida aparece no texto OCR (chave_no_texto).
+    """
+    if indice is None or not quase_duplicado or quase_duplicado[1] < LIMIAR_ATALHO: return False
+    return chave_no_texto(indice.chave_de(quase_duplicado[0]), texto_ocr)
+
+
+def confirmar_duplicado(indice: Optional[IndiceDuplicados], quase_duplicado: Optional[Tuple[str, float]],
+                        dados: Optional[Dict[str, Any]]) -> bool:
+    """True se a nota parecida ('quase_duplicado' de verificar_texto) tem a mesma chave fiscal que 'dados'."""
+    if indice is None or not quase_duplicado: return False
+    chave = chave_fiscal(dados)
+    return chave is not None and chave == indice.chave_de(quase_duplicado[0])
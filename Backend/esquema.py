@@ -0,0 +1,192 @@
+"""
+Registo único do schema de uma nota e o tipo de registo que circula no pipeline.
+
+COLUNAS_NOTAS define, por ordem, cada coluna de 'notas_fiscais' (nome, definição SQL e
+tipo). Todas as listas que antes estavam repetidas (HEADERS_DB em database.py e em app.py,
+CAMPOS_ESPERADOS/HEADERS_OCR na limpeza e na interface, as colunas de valores) derivam daqui,
+tal como as instruções SQL de leitura e de upsert (sql_select / sql_upsert, montadas uma vez
+por combinação de colunas).
+
+Nota é um registo com __slots__ (um atributo por coluna, sem dict por instância) para as notas
+gravadas uma a uma (insert_record). Aceita nota.get(campo) e nota[campo], por isso funciona nas
+funções que recebiam os dicts limpos (chave_fiscal, registar_fornecedores...).
+Os lotes não passam por Nota: linhas_de_dataframe dá as tuplas de parâmetros do upsert
+(itertuples) e registos_de_dataframe os dicts por linha (to_dict('records')).
+"""
+from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import pandas as pd
+
+# (nome, definição SQL, tipo): 'texto', 'data', 'valor' (DECIMAL(15,2)) ou 'aliquota' (DECIMAL(7,4))
+COLUNAS_NOTAS: List[Tuple[str, str, str]] = [
+    ('hash', 'VARCHAR(32) PRIMARY KEY', 'texto'),
+    ('arquivo', 'VARCHAR(255)', 'texto'),
+    ('data_processamento', 'DATETIME', 'data'),
+    ('ocr_numero', 'VARCHAR(50) NULL', 'texto'),
+    ('ocr_emissao_datahora', 'DATETIME NULL', 'data'),
+    ('ocr_codigo_verificacao', 'VARCHAR(50) NULL', 'texto'),
+    ('ocr_prestador_nome', 'VARCHAR(255) NULL', 'texto'),
+    ('ocr_prestador_cpf_cnpj', 'VARCHAR(20) NULL', 'texto'),
+    ('ocr_prestador_inscricao_municipal', 'VARCHAR(50) NULL', 'texto'),
+    ('ocr_prestador_endereco', 'TEXT NULL', 'texto'),
+    ('ocr_prestador_municipio', 'VARCHAR(100) NULL', 'texto'),
+    ('ocr_prestador_uf', 'VARCHAR(2) NULL', 'texto'),
+    ('ocr_tomador_nome', 'VARCHAR(255) NULL', 'texto'),
+    ('ocr_tomador_cpf_cnpj', 'VARCHAR(20) NULL', 'texto'),
+    ('ocr_tomador_endereco', 'TEXT NULL', 'texto'),
+    ('ocr_tomador_inscricao_municipal', 'VARCHAR(50) NULL', 'texto'),
+    ('ocr_tomador_municipio', 'VARCHAR(100) NULL', 'texto'),
+    ('ocr_tomador_uf', 'VARCHAR(2) NULL', 'texto'),
+    ('ocr_tomador_email', 'VARCHAR(255) NULL', 'texto'),
+    ('ocr_discriminacao', 'TEXT NULL', 'texto'),
+    ('ocr_codigo_servico', 'VARCHAR(50) NULL', 'texto'),
+    ('ocr_valor_total', 'DECIMAL(15, 2) NULL', 'valor'),
+    ('ocr_valor_base_calculo', 'DECIMAL(15, 2) NULL', 'valor'),
+    ('ocr_valor_aliquota', 'DECIMAL(7, 4) NULL', 'aliquota'),
+    ('ocr_valor_iss', 'DECIMAL(15, 2) NULL', 'valor'),
+    ('ocr_valor_deducoes', 'DECIMAL(15, 2) NULL', 'valor'),
+    ('ocr_valor_pis_pasep', 'DECIMAL(15, 2) NULL', 'valor'),
+    ('ocr_valor_cofins', 'DECIMAL(15, 2) NULL', 'valor'),
+    ('ocr_valor_csll', 'DECIMAL(15, 2) NULL', 'valor'),
+    ('ocr_valor_irrf', 'DECIMAL(15, 2) NULL', 'valor'),
+    ('ocr_valor_inss', 'DECIMAL(15, 2) NULL', 'valor'),
+    ('ocr_valor_credito', 'DECIMAL(15, 2) NULL', 'valor'),
+    ('ocr_valor_tributos_fonte', 'DECIMAL(15, 2) NULL', 'valor'),
+    ('ocr_valor_tributos_fonte_percentual', 'VARCHAR(10) NULL', 'texto'),
+    ('ocr_municipio_prestacao_servico', 'VARCHAR(100) NULL', 'texto'),
+    ('ocr_intermediario_nome', 'VARCHAR(255) NULL', 'texto'),
+    ('ocr_intermediario_cpf_cnpj', 'VARCHAR(20) NULL', 'texto'),
+    ('ocr_outras_informacoes', 'TEXT NULL', 'texto'),
+    ('ocr_numero_inscricao_obra', 'VARCHAR(50) NULL', 'texto'),
+    ('alogo_visivel', 'VARCHAR(10) NULL', 'texto'),
+    ('categoria', 'VARCHAR(100) NULL', 'texto'),
+]
+
+HEADERS_DB = [nome for nome, _, _ in COLUNAS_NOTAS]
+CAMPOS_CONTROLO = ['hash', 'arquivo', 'data_processamento'] # Preenchidos pelo pipeline, não pelo OCR/LLM
+CAMPOS_ESPERADOS = [h for h in HEADERS_DB if h not in CAMPOS_CONTROLO] # Schema OCR (JSON pedido ao LLM)
+DEFINICOES_SQL: Dict[str, str] = {nome: definicao for nome, definicao, _ in COLUNAS_NOTAS}
+CAMPOS_MONETARIOS = [nome for nome, _, tipo in COLUNAS_NOTAS if tipo == 'valor']
+COLUNAS_DATA = [nome for nome, _, tipo in COLUNAS_NOTAS if tipo == 'data']
+COLUNAS_VALOR = [nome for nome, _, tipo in COLUNAS_NOTAS if tipo in ('valor', 'aliquota')]
+TIPOS_PYTHON = {'texto': str, 'data': Union[str, datetime], 'valor': Decimal, 'aliquota': Decimal} # Datas: 'AAAA-MM-DD HH:MM:SS' ou datetime
+
+COLUNAS_SQL = ", ".join(f"`{h}`" for h in HEADERS_DB)
+
+
+# ==============================================================================
+# CACHE DE INSTRUÇÕES
+# ==============================================================================
+# Cada instrução é montada uma vez por combinação de colunas (e número de linhas) e devolvida
+# sempre como o mesmo objeto str: os cursores preparados do mysql.connector só voltam a
+# preparar a instrução no servidor quando recebem um objeto diferente do da última execução.
+# Sem argumentos por omissão: a chave do lru_cache é a mesma para todas as chamadas (posicionais).
+@lru_cache(maxsize=256)
+def sql_upsert(colunas: Tuple[str, ...], linhas: int) -> str:
+    """INSERT ... ON DUPLICATE KEY UPDATE em 'notas_fiscais' para 'colunas', com 'linhas' linhas de valores (%s)."""
+    linha = '(' + ', '.join(['%s'] * len(colunas)) + ')'
+    updates = ', '.join(f"`{h}`=VALUES(`{h}`)" for h in colunas if h != 'hash') or "`hash`=`hash`"
+    return (f"INSERT INTO notas_fiscais ({', '.join(f'`{h}`' for h in colunas)}) VALUES {', '.join([linha] * linhas)} "
+            f"ON DUPLICATE KEY UPDATE {updates}")
+
+
+@lru_cache(maxsize=128)
+def sql_select(colunas: Tuple[str, ...], tabela: str) -> str:
+    """SELECT das 'colunas' de 'tabela' (notas_fiscais ou o arquivo), sem WHERE/ORDER BY."""
+    return f"SELECT {', '.join(f'`{h}`' for h in colunas)} FROM {tabela}"
+
+
+# Instruções com todas as colunas
+SQL_SELECT_NOTAS = sql_select(tuple(HEADERS_DB), 'notas_fiscais')
+SQL_UPSERT_NOTA = sql_upsert(tuple(HEADERS_DB), 1)
+
+
+def _nulo(valor: Any) -> bool:
+    """None, NaN, NaT e pd.NA (como pd.isna, mas só para escalares)."""
+    if valor is None: return True
+    if isinstance(valor, (str, Decimal, int, list, dict, tuple)): return False
+    try:
+        return bool(pd.isna(valor))
+    except (TypeError, ValueError):
+        return False
+
+
+# ==============================================================================
+# REGISTO
+# ==============================================================================
+class Nota:
+    """Uma linha de 'notas_fiscais': um slot por coluna de HEADERS_DB (None = NULL)."""
+    __slots__ = tuple(HEADERS_DB)
+    __annotations__ = {nome: Optional[TIPOS_PYTHON[tipo]] for nome, _, tipo in COLUNAS_NOTAS}
+
+    def __init__(self, **valores):
+        for campo in HEADERS_DB: setattr(self, campo, valores.get(campo))
+
+    @classmethod
+    def de_dict(cls, dados: Dict[str, Any]) -> 'Nota':
+        """Nota a partir de um dict (chaves fora do schema são ignoradas; NaN/NaT passam a None)."""
+        nota = cls.__new__(cls)
+        for campo in HEADERS_DB:
+            valor = dados.get(campo)
+            setattr(nota, campo, None if _nulo(valor) else valor)
+        return nota
+
+    def get(self, campo: str, padrao: Any = None) -> Any:
+        valor = getattr(self, campo, None) if campo in DEFINICOES_SQL else None
+        return padrao if valor is None else valor
+
+    def __contains__(self, campo: str) -> bool:
+        return campo in DEFINICOES_SQL
+
+    def __getitem__(self, campo: str) -> Any:
+        if campo not in DEFINICOES_SQL: raise KeyError(campo)
+        return getattr(self, campo)
+
+    def valores(self, colunas: Sequence[str] = HEADERS_DB) -> tuple:
+        """Valores pela ordem de 'colunas' (parâmetros de um INSERT)."""
+        return tuple(getattr(self, campo) for campo in colunas)
+
+    def para_dict(self) -> Dict[str, Any]:
+        return {campo: getattr(self, campo) for campo in HEADERS_DB}
+
+    def __eq__(self, outra):
+        return isinstance(outra, Nota) and self.valores() == outra.valores()
+
+    def __hash__(self):
+        # Pela chave primária: notas iguais têm o mesmo hash. Não alterar o campo 'hash' de uma
+        # Nota que esteja num set ou seja chave de um dict.
+        return hash(self.hash)
+
+    def __repr__(self):
+        return f"Nota(hash={self.hash!r}, arquivo={self.arquivo!r}, ocr_numero={self.ocr_numero!r})"
+
+
+# ==============================================================================
+# LOTES (DataFrame <-> Nota)
+# ==============================================================================
+def _colunas_sem_nulos(df: pd.DataFrame) -> pd.DataFrame:
+    """As colunas do schema presentes em 'df' (pela ordem de HEADERS_DB), como objetos, com NaN/NaT/pd.NA a None."""
+    valores = df[[c for c in HEADERS_DB if c in df.columns]].astype(object)
+    return valores.where(valores.notna(), None)
+
+
+def linhas_de_dataframe(df: pd.DataFrame) -> Tuple[List[str], List[tuple]]:
+    """(colunas do schema presentes no DataFrame, uma tupla de valores por linha pela ordem dessas colunas)."""
+    valores = _colunas_sem_nulos(df)
+    if valores.columns.empty: return [], [()] * len(df) # itertuples sem colunas não dá linhas
+    return list(valores.columns), list(valores.itertuples(index=False, name=None))
+
+
+def registos_de_dataframe(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Um dict por linha do DataFrame, só com as colunas do schema (NaN/NaT passam a None)."""
+    return _colunas_sem_nulos(df).to_dict('records')
+
+
+def notas_para_dataframe(notas: Iterable[Nota], colunas: Sequence[str] = HEADERS_DB) -> pd.DataFrame:
+    """DataFrame com uma coluna por campo de 'colunas' (objetos Python, como vêm das notas)."""
+    notas = list(notas)
+    return pd.DataFrame({c: pd.Series([getattr(n, c) for n in notas], dtype=object) for c in colunas},
+                        columns=list(colunas))
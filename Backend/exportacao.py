@@ -0,0 +1,74 @@
+"""
+Exportação em streaming das notas para CSV e XLSX.
+
+As linhas vêm de um cursor não bufferizado (iterar_notas), em blocos, e são escritas
+num SpooledTemporaryFile: fica em memória enquanto for pequeno e passa para disco
+acima de LIMITE_MEMORIA_BYTES. O XLSX usa o modo 'constant_memory' do xlsxwriter,
+que grava cada linha assim que a seguinte começa. A memória usada não depende do
+número de notas exportadas.
+"""
+import io
+import csv
+import tempfile
+from datetime import datetime, date
+from decimal import Decimal
+
+import xlsxwriter
+
+from .database import HEADERS_DB, iterar_notas
+
+LIMITE_MEMORIA_BYTES = 8 * 1024 * 1024
+TAMANHO_BLOCO_PADRAO = 2000
+FORMATOS = {
+    'csv': ('text/csv', 'csv'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+
+
+def _escrever_csv(destino, colunas, blocos):
+    destino.write(','.join(colunas).encode('utf-8') + b'\n')
+    for linhas in blocos:
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(linhas)
+        destino.write(buffer.getvalue().encode('utf-8'))
+
+
+def _escrever_xlsx(destino, colunas, blocos):
+    workbook = xlsxwriter.Workbook(destino, {'constant_memory': True, 'in_memory': False, 'tmpdir': tempfile.gettempdir()})
+    try:
+        folha = workbook.add_worksheet('DadosNFS')
+        formato_data = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+        folha.write_row(0, 0, colunas)
+        num_linha = 1
+        for linhas in blocos:
+            for linha in linhas:
+                for num_col, valor in enumerate(linha):
+                    if valor is None: continue
+                    if isinstance(valor, (datetime, date)): folha.write_datetime(num_linha, num_col, valor, formato_data)
+                    elif isinstance(valor, Decimal): folha.write_number(num_linha, num_col, float(valor))
+                    else: folha.write(num_linha, num_col, valor)
+                num_linha += 1
+    finally:
+        workbook.close()
+
+
+def exportar_notas(filtros=None, formato: str = 'csv', colunas=None, tamanho_bloco: int = TAMANHO_BLOCO_PADRAO,
+                   destino=None):
+    """
+    Exporta as notas que satisfazem 'filtros' (os mesmos de consultar_notas_paginado) para
+    'destino' (ficheiro binário aberto para escrita e leitura) ou, por omissão, para um ficheiro
+    temporário, em 'formato' ('csv' ou 'xlsx'). Retorna o ficheiro (posicionado no início), que
+    o chamador deve fechar; ao fechar, o ficheiro temporário é apagado.
+    """
+    if formato not in FORMATOS: raise ValueError(f"Formato de exportação inválido '{formato}'.")
+    colunas = [c for c in (colunas or HEADERS_DB) if c in HEADERS_DB]
+    if destino is None: destino = tempfile.SpooledTemporaryFile(max_size=LIMITE_MEMORIA_BYTES, mode='w+b')
+    try:
+        blocos = iterar_notas(filtros, colunas, tamanho_bloco)
+        if formato == 'csv': _escrever_csv(destino, colunas, blocos)
+        else: _escrever_xlsx(destino, colunas, blocos)
+        destino.seek(0)
+        return destino
+    except Exception:
+        destino.close()
+        raise
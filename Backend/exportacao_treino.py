@@ -0,0 +1,229 @@
+"""
+Exportação incremental e em streaming de pares de treino (texto OCR -> JSON validado).
+
+Os pares são construídos a partir dos dados persistidos: o texto OCR vem da staging
+('extracoes_staging') e o JSON de referência é o registo já validado e salvo em
+'notas_fiscais' ou, para os anos fechados, em 'notas_fiscais_arquivo'. As linhas são lidas por blocos, com paginação por chave
+(gravado_em, hash), e escritas à medida que chegam, pelo que a memória
+usada não depende do número de notas.
+
+A exportação incremental segue 'gravado_em' (momento da gravação no MySQL) e não
+'data_processamento' (momento da extração, que pode ser muito anterior: uma nota extraída
+antes de uma exportação e só validada depois dela tem de entrar na seguinte). A leitura
+recua MARGEM_SEGUNDOS antes da marca, para apanhar as transações confirmadas depois da
+exportação anterior; os pares dessa margem já exportados (guardados na marca) são ignorados.
+Uma nota corrigida e gravada de novo volta a ser exportada.
+
+Uso (a partir da raiz do projeto):
+    python -m Backend.exportacao_treino treino.jsonl --incremental
+    python -m Backend.exportacao_treino treino.parquet --formato parquet
+"""
+import os
+import json
+import hashlib
+import argparse
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, Any, Iterator, Optional, Tuple
+
+import mysql.connector
+
+from .database import create_connection, estado_tabelas, COLUNA_GRAVADO_EM, TABELA_ARQUIVO
+from .esquema import CAMPOS_ESPERADOS
+from .staging import _descomprimir
+
+# pyarrow (opcional) para saída Parquet
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+TAMANHO_BLOCO_PADRAO = 500
+ARQUIVO_MARCA_PADRAO = os.getenv('TREINO_ARQUIVO_MARCA', 'marca_exportacao_treino.json')
+MARGEM_SEGUNDOS = int(os.getenv('TREINO_MARGEM_SEGUNDOS', '60'))
+_FORMATO_GRAVADO_EM = '%Y-%m-%d %H:%M:%S.%f'
+
+# Campos do JSON de referência (os mesmos que o LLM deve devolver)
+CAMPOS_COMPLETION = CAMPOS_ESPERADOS
+
+
+# ==============================================================================
+# MARCA D'ÁGUA (exportação incremental)
+# ==============================================================================
+def ler_marca(caminho: str = ARQUIVO_MARCA_PADRAO) -> Optional[Dict[str, Any]]:
+    """
+    Lê a marca d'água da última exportação, se existir: {'gravado_em', 'hash', 'recentes'
+    ([hash, gravado_em] dos pares já lidos na margem)}. Uma marca antiga, por data_processamento,
+    é ignorada (a exportação seguinte é completa).
+    """
+    try:
+        with open(caminho, 'r', encoding='utf-8') as f:
+            marca = json.load(f)
+        return {'gravado_em': marca['gravado_em'], 'hash': marca['hash'], 'recentes': marca.get('recentes', [])}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def gravar_marca(marca: Optional[Dict[str, Any]], caminho: str = ARQUIVO_MARCA_PADRAO):
+    """Grava a marca d'água devolvida pela exportação (não faz nada se for None)."""
+    if not marca: return
+    with open(caminho, 'w', encoding='utf-8') as f:
+        json.dump(marca, f)
+
+
+# ==============================================================================
+# LEITURA EM STREAMING
+# ==============================================================================
+def iterar_pares_treino(conn, desde: Optional[Dict[str, Any]] = None,
+                        tamanho_bloco: int = TAMANHO_BLOCO_PADRAO,
+                        deduplicar: bool = True, estado: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Gera pares {hash, prompt, completion, data_processamento} para as notas validadas.
+
+    'desde' é a marca d'água de uma exportação anterior (ver ler_marca): são lidas as notas
+    gravadas a partir de MARGEM_SEGUNDOS antes dela, sem repetir as que a marca já inclui. Com
+    'deduplicar', pares com o mesmo texto OCR (ex: a mesma nota digitalizada duas vezes) só são
+    emitidos uma vez; apenas um digest de 16 bytes por texto é mantido em memória. Se 'estado'
+    for um dict, estado['marca'] recebe, no fim, a marca d'água para a próxima exportação.
+    """
+    if not conn or not conn.is_connected(): return
+    cols_select = ", ".join([f"n.`{h}`" for h in CAMPOS_COMPLETION])
+    tabelas = ['notas_fiscais']
+    if estado_tabelas(conn.cursor())['arquivo_emissao_max'] is not None: tabelas.append(TABELA_ARQUIVO) # Anos fechados
+    vistos = set()
+    margem = timedelta(seconds=MARGEM_SEGUNDOS)
+    # (hash, gravado_em) lidos dentro da margem da última posição, por ordem de gravação
+    recentes = deque(sorted((tuple(r) for r in (desde or {}).get('recentes', [])), key=lambda r: r[1]))
+    ja_lidos = set(recentes)
+    posicao = None # (gravado_em, hash) da última linha lida
+    try:
+        while True:
+            if posicao:
+                filtro, params = f"WHERE (n.{COLUNA_GRAVADO_EM}, n.hash) > (%s, %s)", [posicao[0], posicao[1]]
+            elif desde:
+                inicio = datetime.strptime(desde['gravado_em'], _FORMATO_GRAVADO_EM) - margem
+                filtro, params = f"WHERE n.{COLUNA_GRAVADO_EM} >= %s", [inicio]
+            else:
+                filtro, params = "", []
+            # Cada tabela devolve o seu bloco já ordenado (índice de gravado_em); o UNION ALL junta-os
+            query = " UNION ALL ".join(f"""(
+                SELECT n.hash, n.{COLUNA_GRAVADO_EM}, n.data_processamento, s.codec, s.texto_ocr, {cols_select}
+                FROM {tabela} n
+                JOIN extracoes_staging s ON s.hash = n.hash
+                {filtro}
+                ORDER BY n.{COLUNA_GRAVADO_EM}, n.hash
+                LIMIT %s
+            )""" for tabela in tabelas)
+            if len(tabelas) > 1: query += f" ORDER BY {COLUNA_GRAVADO_EM}, hash LIMIT %s"
+            try:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute(query, tuple((params + [tamanho_bloco]) * len(tabelas) + [tamanho_bloco] * (len(tabelas) > 1)))
+                linhas = cursor.fetchall() # No máximo 'tamanho_bloco' linhas
+                cursor.close()
+            except mysql.connector.Error as e:
+                print(f"Erro ao ler pares de treino: {e}")
+                return
+            if not linhas: return
+
+            for linha in linhas:
+                gravado_em = linha[COLUNA_GRAVADO_EM]
+                posicao = (gravado_em, linha['hash'])
+                chave = (linha['hash'], gravado_em.strftime(_FORMATO_GRAVADO_EM))
+                while recentes and recentes[0][1] < (gravado_em - margem).strftime(_FORMATO_GRAVADO_EM):
+                    ja_lidos.discard(recentes.popleft())
+                if chave in ja_lidos: continue # Já exportado na exportação anterior (margem)
+                recentes.append(chave)
+                ja_lidos.add(chave)
+                prompt = _descomprimir(linha['texto_ocr'], linha['codec'])
+                if not prompt: continue
+                if deduplicar:
+                    digest = hashlib.blake2b(prompt.encode('utf-8'), digest_size=16).digest()
+                    if digest in vistos: continue
+                    vistos.add(digest)
+                data_proc = linha['data_processamento']
+                data_proc_str = data_proc.strftime('%Y-%m-%d %H:%M:%S') if hasattr(data_proc, 'strftime') else str(data_proc)
+                completion = {c: linha.get(c) for c in CAMPOS_COMPLETION}
+                yield {
+                    'hash': linha['hash'], 'data_processamento': data_proc_str,
+                    'prompt': prompt, 'completion': json.dumps(completion, ensure_ascii=False, default=str),
+                }
+            if len(linhas) < tamanho_bloco: return
+    finally:
+        if estado is not None and posicao:
+            estado['marca'] = {'gravado_em': posicao[0].strftime(_FORMATO_GRAVADO_EM), 'hash': posicao[1],
+                               'recentes': [list(r) for r in recentes]}
+
+
+# ==============================================================================
+# ESCRITA
+# ==============================================================================
+def exportar_jsonl(conn, destino, desde=None, tamanho_bloco: int = TAMANHO_BLOCO_PADRAO,
+                   deduplicar: bool = True) -> Tuple[int, Optional[Dict[str, Any]]]:
+    """
+    Escreve os pares em JSONL no ficheiro (caminho ou objeto de texto aberto).
+    Retorna (número de pares escritos, nova marca d'água).
+    """
+    abriu = isinstance(destino, (str, os.PathLike))
+    f = open(destino, 'w', encoding='utf-8') if abriu else destino
+    total, estado = 0, {'marca': desde}
+    try:
+        for par in iterar_pares_treino(conn, desde, tamanho_bloco, deduplicar, estado):
+            f.write(json.dumps({'prompt': par['prompt'], 'completion': par['completion']}, ensure_ascii=False) + "\n")
+            total += 1
+    finally:
+        if abriu: f.close()
+    return total, estado['marca']
+
+
+def exportar_parquet(conn, destino: str, desde=None, tamanho_bloco: int = TAMANHO_BLOCO_PADRAO,
+                     deduplicar: bool = True) -> Tuple[int, Optional[Dict[str, Any]]]:
+    """Escreve os pares em Parquet, um row group por bloco. Requer 'pyarrow'."""
+    if not PYARROW_AVAILABLE:
+        raise RuntimeError("Exportação Parquet requer a biblioteca 'pyarrow'. Instale com: pip install pyarrow")
+    esquema = pa.schema([('hash', pa.string()), ('data_processamento', pa.string()),
+                         ('prompt', pa.string()), ('completion', pa.string())])
+    total, estado, bloco = 0, {'marca': desde}, []
+    with pq.ParquetWriter(destino, esquema, compression='zstd') as writer:
+        for par in iterar_pares_treino(conn, desde, tamanho_bloco, deduplicar, estado):
+            bloco.append(par)
+            if len(bloco) >= tamanho_bloco:
+                writer.write_table(pa.Table.from_pylist(bloco, schema=esquema))
+                total += len(bloco)
+                bloco = []
+        if bloco:
+            writer.write_table(pa.Table.from_pylist(bloco, schema=esquema))
+            total += len(bloco)
+    return total, estado['marca']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exporta pares de treino (texto OCR -> JSON validado).")
+    parser.add_argument("destino", help="Ficheiro de saída (.jsonl ou .parquet).")
+    parser.add_argument("--formato", choices=['jsonl', 'parquet'], default=None,
+                        help="Formato de saída (por omissão, deduzido da extensão).")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Exporta só as notas gravadas depois da última exportação.")
+    parser.add_argument("--marca", default=ARQUIVO_MARCA_PADRAO, help="Ficheiro da marca d'água.")
+    parser.add_argument("--sem-deduplicacao", action="store_true", help="Mantém pares com texto OCR repetido.")
+    args = parser.parse_args(argv)
+
+    formato = args.formato or ('parquet' if args.destino.lower().endswith('.parquet') else 'jsonl')
+    conn = create_connection()
+    if not conn:
+        print("Erro: Não foi possível conectar à base de dados.")
+        return
+    try:
+        desde = ler_marca(args.marca) if args.incremental else None
+        exportar = exportar_parquet if formato == 'parquet' else exportar_jsonl
+        inicio = datetime.now()
+        total, marca = exportar(conn, args.destino, desde=desde, deduplicar=not args.sem_deduplicacao)
+        gravar_marca(marca, args.marca)
+        print(f"{total} pares de treino exportados para '{args.destino}' em {(datetime.now() - inicio).total_seconds():.1f}s.")
+    finally:
+        if conn.is_connected(): conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+Cadastro de fornecedores (prestadores) construído a partir das notas validadas.
+
+A tabela 'fornecedores' guarda, por CNPJ/CPF normalizado (só dígitos), o nome, endereço,
+inscrição municipal, município, UF e categoria da última nota validada desse prestador. O
+cadastro inteiro é mantido em memória no processo (carregado da base de dados na primeira
+utilização, como o índice de duplicados).
+
+Antes do LLM, o CNPJ/CPF da secção do prestador do texto OCR (o primeiro válido depois do
+cabeçalho 'PRESTADOR'; sem cabeçalho, o primeiro do texto) é procurado no cadastro: se o
+prestador já for conhecido, o prompt pede só os campos específicos da nota e o CNPJ do
+prestador, e os campos do prestador (CAMPOS_FORNECEDOR) são preenchidos a partir do cadastro.
+Se o CNPJ extraído pelo LLM for outro, o cadastro não é aplicado e a divergência segue para as
+pendências da nota. Se o prestador só for identificado pelo LLM, o cadastro preenche os campos
+que ficaram vazios.
+"""
+import re
+import threading
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+import mysql.connector
+
+from .validacao import documento_valido
+
+CAMPOS_FORNECEDOR = [
+    'ocr_prestador_nome', 'ocr_prestador_endereco', 'ocr_prestador_inscricao_municipal',
+    'ocr_prestador_municipio', 'ocr_prestador_uf', 'categoria'
+]
+# Colunas da tabela (nome no cadastro -> campo da nota)
+_COLUNAS = {
+    'nome': 'ocr_prestador_nome', 'endereco': 'ocr_prestador_endereco',
+    'inscricao_municipal': 'ocr_prestador_inscricao_municipal', 'municipio': 'ocr_prestador_municipio',
+    'uf': 'ocr_prestador_uf', 'categoria': 'categoria',
+}
+TAMANHO_LOTE_CARGA = 1000
+
+_RE_NAO_DIGITO = re.compile(r'\D+')
+_RE_DOCUMENTO = re.compile(r'(?<!\d)(\d{2}\.?\d{3}\.?\d{3}/?\d{4}-?\d{2}|\d{3}\.?\d{3}\.?\d{3}-?\d{2})(?!\d)')
+_RE_SECCAO_PRESTADOR = re.compile(r'PRESTADOR', re.IGNORECASE)
+_RE_SECCAO_TOMADOR = re.compile(r'TOMADOR', re.IGNORECASE)
+
+
+def normalizar_documento(documento: Any) -> str:
+    return _RE_NAO_DIGITO.sub('', str(documento or ''))
+
+
+def formatar_documento(digitos: str) -> str:
+    """'11222333000181' -> '11.222.333/0001-81' (CPF: '529.982.247-25')."""
+    if len(digitos) == 14: return f"{digitos[:2]}.{digitos[2:5]}.{digitos[5:8]}/{digitos[8:12]}-{digitos[12:]}"
+    if len(digitos) == 11: return f"{digitos[:3]}.{digitos[3:6]}.{digitos[6:9]}-{digitos[9:]}"
+    return digitos
+
+
+def _primeiro_documento(texto: str) -> Optional[str]:
+    for match in _RE_DOCUMENTO.finditer(texto):
+        digitos = normalizar_documento(match.group(1))
+        if documento_valido(digitos): return digitos
+    return None
+
+
+def documento_do_prestador(texto: str) -> Optional[str]:
+    """
+    Dígitos do CNPJ/CPF do prestador no texto OCR: o primeiro válido depois do cabeçalho
+    'PRESTADOR' (até ao cabeçalho 'TOMADOR' seguinte), ou o primeiro do texto se não houver
+    esse cabeçalho (o do município ou do tomador podem vir antes do prestador em alguns layouts).
+    """
+    texto = texto or ''
+    seccao = _RE_SECCAO_PRESTADOR.search(texto)
+    if seccao is None: return _primeiro_documento(texto)
+    tomador = _RE_SECCAO_TOMADOR.search(texto, seccao.end())
+    return _primeiro_documento(texto[seccao.end():tomador.start() if tomador else len(texto)])
+
+
+# ==============================================================================
+# TABELA
+# ==============================================================================
+def create_fornecedores_table_if_not_exists(conn):
+    """Cria a tabela 'fornecedores' (mesmos tipos das colunas de 'notas_fiscais') e preenche-a a partir das notas já salvas."""
+    if not conn or not conn.is_connected():
+        print("Erro: Conexão inválida para criar tabela fornecedores.")
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS fornecedores (
+                cnpj VARCHAR(14) PRIMARY KEY, -- Só dígitos (CNPJ ou CPF)
+                nome VARCHAR(255) NULL,
+                endereco TEXT NULL,
+                inscricao_municipal VARCHAR(50) NULL,
+                municipio VARCHAR(100) NULL,
+                uf VARCHAR(2) NULL,
+                categoria VARCHAR(100) NULL,
+                total_notas INT NOT NULL DEFAULT 0,
+                atualizado_em DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            );
+        """)
+        conn.commit()
+        print("Tabela 'fornecedores' verificada/atualizada com sucesso.")
+    except mysql.connector.Error as e:
+        print(f"Erro ao criar a tabela fornecedores: {e}")
+        raise
+
+    # Carga inicial: notas por ordem de processamento, para que a mais recente de cada prestador prevaleça
+    colunas = ", ".join(['ocr_prestador_cpf_cnpj'] + CAMPOS_FORNECEDOR)
+    cursor = conn.cursor(dictionary=True, buffered=True) # buffered: a mesma conexão grava os blocos
+    cursor.execute(f"SELECT {colunas} FROM notas_fiscais ORDER BY data_processamento, hash")
+    total = 0
+    while True:
+        linhas = cursor.fetchmany(TAMANHO_LOTE_CARGA)
+        if not linhas: break
+        total += registar_fornecedores(conn, linhas, atualizar_cache=False)
+    print(f"{total} notas usadas para preencher o cadastro de fornecedores.")
+
+
+def _entradas(lista_dados: Iterable[Dict[str, Any]]) -> List[Tuple]:
+    entradas = []
+    for dados in lista_dados:
+        cnpj = normalizar_documento(dados.get('ocr_prestador_cpf_cnpj'))
+        if not documento_valido(cnpj) or not str(dados.get('ocr_prestador_nome') or '').strip(): continue
+        entradas.append((cnpj, *[str(dados.get(campo) or '').strip() or None for campo in _COLUNAS.values()]))
+    return entradas
+
+
+def registar_fornecedores(conn, lista_dados: Iterable[Dict[str, Any]], atualizar_cache: bool = True) -> int:
+    """
+    Grava no cadastro os prestadores de notas validadas (CNPJ/CPF válido e nome preenchido).
+    Os campos vazios de uma nota não apagam os que já estão no cadastro. Retorna quantas notas foram usadas.
+    """
+    if not conn or not conn.is_connected(): return 0
+    entradas = _entradas(lista_dados)
+    if not entradas: return 0
+    colunas = list(_COLUNAS)
+    atualizacoes = ", ".join(f"`{c}` = COALESCE(VALUES(`{c}`), `{c}`)" for c in colunas)
+    sql = (f"INSERT INTO fornecedores (cnpj, {', '.join(f'`{c}`' for c in colunas)}, total_notas) "
+           f"VALUES (%s, {', '.join(['%s'] * len(colunas))}, 1) "
+           f"ON DUPLICATE KEY UPDATE {atualizacoes}, total_notas = total_notas + 1")
+    try:
+        cursor = conn.cursor()
+        cursor.executemany(sql, entradas)
+        conn.commit()
+    except mysql.connector.Error as e:
+        print(f"Erro ao registar fornecedores: {e}")
+        try: conn.rollback()
+        except mysql.connector.Error: pass
+        return 0
+    if atualizar_cache and _cadastro is not None:
+        for cnpj, *valores in entradas: _cadastro.atualizar(cnpj, dict(zip(_COLUNAS.values(), valores)))
+    return len(entradas)
+
+
+# ==============================================================================
+# CADASTRO EM MEMÓRIA
+# ==============================================================================
+class CadastroFornecedores:
+    """Dicionário CNPJ/CPF (só dígitos) -> campos do prestador (CAMPOS_FORNECEDOR)."""
+
+    def __init__(self):
+        self._fornecedores = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._fornecedores)
+
+    def atualizar(self, cnpj: str, campos: Dict[str, Optional[str]]):
+        """Acrescenta/atualiza um prestador; campos None não apagam os já conhecidos."""
+        with self._lock:
+            atual = dict(self._fornecedores.get(cnpj) or {})
+            atual.update({campo: valor for campo, valor in campos.items() if valor})
+            self._fornecedores[cnpj] = atual
+
+    def procurar(self, documento: Any) -> Optional[Dict[str, str]]:
+        """Campos do prestador com este CNPJ/CPF (qualquer pontuação), ou None se não for conhecido."""
+        return self._fornecedores.get(normalizar_documento(documento))
+
+    def procurar_no_texto(self, texto: str) -> Optional[Tuple[str, Dict[str, str]]]:
+        """(dígitos, campos) se o CNPJ/CPF do prestador no texto OCR for de um prestador conhecido."""
+        cnpj = documento_do_prestador(texto)
+        if cnpj is None: return None
+        campos = self._fornecedores.get(cnpj)
+        return (cnpj, campos) if campos else None
+
+    @staticmethod
+    def divergencia(dados: Dict[str, Any], fornecedor: Optional[Tuple[str, Dict[str, str]]]) -> Optional[str]:
+        """
+        Motivo de revisão se o CNPJ/CPF do prestador extraído pelo LLM for válido e diferente do
+        'fornecedor' encontrado no texto OCR (None se coincidirem ou se o LLM não o extraiu).
+        """
+        if not fornecedor: return None
+        extraido = normalizar_documento(dados.get('ocr_prestador_cpf_cnpj'))
+        if not documento_valido(extraido) or extraido == fornecedor[0]: return None
+        return (f"CNPJ do prestador extraído ({formatar_documento(extraido)}) diferente do encontrado "
+                f"no texto OCR ({formatar_documento(fornecedor[0])}); dados do cadastro não aplicados")
+
+    def completar(self, dados: Dict[str, Any], fornecedor: Optional[Tuple[str, Dict[str, str]]] = None) -> Dict[str, Any]:
+        """
+        Preenche os campos do prestador em 'dados' (o JSON extraído pelo LLM). Com 'fornecedor'
+        (identificado no texto OCR antes do LLM e confirmado com divergencia), o CNPJ e os campos
+        vêm do cadastro; caso contrário, usa o CNPJ extraído e só preenche os campos que ficaram vazios.
+        """
+        if fornecedor:
+            cnpj, campos = fornecedor
+            dados['ocr_prestador_cpf_cnpj'] = formatar_documento(cnpj)
+            for campo in CAMPOS_FORNECEDOR:
+                if campos.get(campo): dados[campo] = campos[campo]
+                else: dados.setdefault(campo, "")
+            return dados
+        campos = self.procurar(dados.get('ocr_prestador_cpf_cnpj'))
+        if campos:
+            for campo in CAMPOS_FORNECEDOR:
+                valor = str(dados.get(campo) or '').strip()
+                if (not valor or valor == "...") and campos.get(campo): dados[campo] = campos[campo]
+        return dados
+
+    def carregar(self, conn) -> 'CadastroFornecedores':
+        """Carrega todo o cadastro persistido para memória."""
+        if not conn or not conn.is_connected(): return self
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT cnpj, {', '.join(f'`{c}`' for c in _COLUNAS)} FROM fornecedores")
+            for cnpj, *valores in cursor.fetchall():
+                self.atualizar(cnpj, dict(zip(_COLUNAS.values(), valores)))
+        except mysql.connector.Error as e:
+            print(f"Erro ao carregar o cadastro de fornecedores: {e}")
+        return self
+
+
+_cadastro = None
+_cadastro_lock = threading.Lock()
+
+def obter_cadastro(conn) -> CadastroFornecedores:
+    """Cadastro partilhado pelo processo (carregado da base de dados na primeira chamada)."""
+    global _cadastro
+    with _cadastro_lock:
+        if _cadastro is None:
+            _cadastro = CadastroFornecedores().carregar(conn)
+            print(f"Cadastro de fornecedores carregado com {len(_cadastro)} prestadores.")
+    return _cadastro
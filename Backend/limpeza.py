@@ -0,0 +1,159 @@
+"""
+Limpeza e normalização dos dados extraídos (schema OCR) antes de irem para a base de dados.
+
+clean_and_format_data trata um dict de cada vez (monitor de pasta, re-limpeza do staging).
+clean_and_format_dataframe trata um DataFrame inteiro (o lote editado na interface) coluna a
+coluna, e dá exatamente o mesmo resultado que aplicar clean_and_format_data a cada linha: os
+valores monetários são lidos numa só passagem (Backend/valores.py, cada texto distinto uma vez) e
+as datas nos formatos habituais com operações vetorizadas do pandas; as restantes (caracteres
+não ASCII, datas fora dos formatos dd/mm/aaaa e aaaa/mm/dd) passam por Backend/datas.py.
+
+Valores monetários e alíquota saem como Decimal (nunca float), prontos para as colunas DECIMAL.
+
+Este módulo não depende das bibliotecas de OCR/LLM, por isso pode ser importado sem elas.
+"""
+from typing import Dict, Any
+
+import numpy as np
+import pandas as pd
+
+from .datas import normalizar_datahora
+from .valores import interpretar_valor, interpretar_percentual, interpretar_valores
+from .esquema import CAMPOS_ESPERADOS, CAMPOS_MONETARIOS # Reexportados (registo do schema)
+
+CAMPOS_STRING = [k for k in CAMPOS_ESPERADOS if k not in CAMPOS_MONETARIOS and k not in ['ocr_valor_aliquota', 'ocr_emissao_datahora', 'ocr_valor_tributos_fonte_percentual']]
+
+
+
+# ==============================================================================
+# LIMPEZA DE UM REGISTO
+# ==============================================================================
+def clean_and_format_data(dados_brutos: Dict[str, Any]) -> Dict[str, Any]:
+    dados_limpos = {}
+
+    # 1. Limpeza inicial (strings)
+    for key in CAMPOS_STRING:
+        value = dados_brutos.get(key)
+        dados_limpos[key] = "" if value is None or str(value).strip() == "..." or str(value).strip() == "" else str(value).strip()
+
+    # 2. Limpeza de campos monetários (Decimal com 2 casas, ver Backend/valores.py)
+    for campo in CAMPOS_MONETARIOS:
+        dados_limpos[campo] = interpretar_valor(dados_brutos.get(campo))
+
+    # 3. Limpeza da Alíquota (fração Decimal com 4 casas)
+    dados_limpos['ocr_valor_aliquota'] = interpretar_percentual(dados_brutos.get('ocr_valor_aliquota'))
+
+    # 4. Limpeza de 'ocr_valor_tributos_fonte_percentual'
+    percent_str = str(dados_brutos.get('ocr_valor_tributos_fonte_percentual') or '')
+    dados_limpos['ocr_valor_tributos_fonte_percentual'] = percent_str.replace('%', '').strip()
+
+    # 5. Limpeza da Data/Hora
+    dados_limpos['ocr_emissao_datahora'] = normalizar_datahora(dados_brutos.get('ocr_emissao_datahora', ''))
+
+    # 6. Verificação Final
+    for campo in CAMPOS_ESPERADOS:
+        if campo not in dados_limpos:
+            if campo == 'ocr_emissao_datahora': dados_limpos[campo] = None
+            elif campo in CAMPOS_MONETARIOS: dados_limpos[campo] = interpretar_valor(None)
+            elif campo == 'ocr_valor_aliquota': dados_limpos[campo] = interpretar_percentual(None)
+            else: dados_limpos[campo] = ''
+
+    # Adiciona categoria se não foi extraída (pode ser calculada aqui se necessário)
+    if 'categoria' not in dados_limpos or not dados_limpos['categoria']:
+         dados_limpos['categoria'] = "" # Ou lógica para determinar a categoria
+
+    return dados_limpos
+
+
+# ==============================================================================
+# LIMPEZA VETORIZADA DE UM LOTE
+# ==============================================================================
+try:
+    import pyarrow as pa
+    TIPO_TEXTO = pd.ArrowDtype(pa.string()) # Operações de texto em C++ (pyarrow.compute)
+except ImportError:
+    TIPO_TEXTO = object
+
+# Só texto ASCII imprimível passa pelo caminho vetorizado: \d, \s e strip() do Python aceitam
+# caracteres Unicode e de controlo que as expressões do pyarrow (RE2) não aceitam.
+_RE_ESPECIAL = r'[^\x20-\x7e\t\n\r]'
+_RE_DATA_HORA = (
+    r'^(?:(?P<d1>[0-9]{2})/(?P<m1>[0-9]{2})/(?P<a1>[0-9]{4})|(?P<a2>[0-9]{4})/(?P<m2>[0-9]{2})/(?P<d2>[0-9]{2}))'
+    r'(?: (?P<hora>[0-9]{2}):(?P<minuto>[0-9]{2})(?::(?P<segundo>[0-9]{2}))?)?Z?$'
+    r'|^(?P<a3>[0-9]{4})/(?P<m3>[0-9]{2})/(?P<d3>[0-9]{2})T(?P<hora3>[0-9]{2}):(?P<minuto3>[0-9]{2}):(?P<segundo3>[0-9]{2})Z$'
+)
+
+
+def _valores(df: pd.DataFrame, coluna: str) -> pd.Series:
+    """Coluna como Series de objetos Python (None se a coluna não existir), como dados_brutos.get(coluna)."""
+    if coluna in df.columns: return df[coluna].astype(object)
+    return pd.Series([None] * len(df), index=df.index, dtype=object)
+
+
+def _como_texto(valores, padrao: str) -> pd.Series:
+    """str(valor or padrao) para cada valor."""
+    return pd.Series([str(v or padrao) for v in valores], dtype=TIPO_TEXTO)
+
+
+def _numeros(texto: pd.Series) -> np.ndarray:
+    """Converte texto só com números válidos (ou nulos) em float64."""
+    if TIPO_TEXTO is object: return texto.astype('float64').to_numpy()
+    return texto.astype(pd.ArrowDtype(pa.float64())).to_numpy('float64', na_value=np.nan)
+
+
+def _limpar_monetarios_lote(df: pd.DataFrame) -> Dict[str, pd.Series]:
+    """Todos os campos monetários numa só passagem de interpretar_valores (cada texto distinto é lido uma vez)."""
+    brutos = [v for campo in CAMPOS_MONETARIOS for v in _valores(df, campo)]
+    numeros = interpretar_valores(brutos)
+    return {campo: pd.Series(numeros[n * len(df):(n + 1) * len(df)], index=df.index, dtype=object)
+            for n, campo in enumerate(CAMPOS_MONETARIOS)}
+
+
+def _limpar_datahoras_lote(valores: pd.Series) -> pd.Series:
+    e_texto = np.array([isinstance(v, str) for v in valores], dtype=bool)
+    texto = pd.Series([v if e else '' for v, e in zip(valores, e_texto)], dtype=TIPO_TEXTO)
+    especiais = texto.str.contains(_RE_ESPECIAL).to_numpy(bool)
+    limpo = (texto.str.replace("```", "", regex=False).str.replace("json", "", regex=False).str.strip()
+             .str.replace(r'\s*\(.*\)\s*', '', regex=True).str.strip()
+             .str.replace(r'[^0-9/\-:\sTZtz]', '', regex=True).str.strip()
+             .str.replace('.', '/', regex=False).str.replace('-', '/', regex=False).str.replace('//', '/', regex=False))
+    partes = limpo.str.extract(_RE_DATA_HORA)
+    partes = partes.where(partes != '') # Grupos sem correspondência: vazio no pyarrow, NaN no object
+    componentes = pd.DataFrame({
+        'year': partes['a1'].fillna(partes['a2']).fillna(partes['a3']),
+        'month': partes['m1'].fillna(partes['m2']).fillna(partes['m3']),
+        'day': partes['d1'].fillna(partes['d2']).fillna(partes['d3']),
+        'hour': partes['hora'].fillna(partes['hora3']).fillna('00'),
+        'minute': partes['minuto'].fillna(partes['minuto3']).fillna('00'),
+        'second': partes['segundo'].fillna(partes['segundo3']).fillna('00'),
+    }).apply(_numeros)
+    datas = pd.to_datetime(componentes, errors='coerce') # Datas impossíveis (ex: 31/02) ficam NaT
+    rapidos = (e_texto & ~especiais & datas.notna().to_numpy(bool) & (componentes['year'] >= 1000).to_numpy(bool)
+               & (componentes['hour'] < 24).to_numpy(bool) & (componentes['minute'] < 60).to_numpy(bool)
+               & (componentes['second'] < 60).to_numpy(bool))
+
+    resultado = np.full(len(valores), None, dtype=object)
+    if rapidos.any():
+        resultado[rapidos] = datas[rapidos].dt.strftime('%Y-%m-%d %H:%M:%S').to_numpy(object)
+    for i in np.flatnonzero(~rapidos):
+        resultado[i] = normalizar_datahora(valores.iat[i])
+    return pd.Series(resultado, index=valores.index, dtype=object)
+
+
+def clean_and_format_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Versão em lote de clean_and_format_data: recebe o DataFrame de dados brutos (uma linha por
+    nota) e devolve um DataFrame com as colunas de CAMPOS_ESPERADOS, no mesmo índice, em que cada
+    linha é igual ao dict que clean_and_format_data devolveria para essa linha.
+    """
+    limpo = {}
+    for key in CAMPOS_STRING:
+        texto = pd.Series([str(v).strip() if v is not None else "" for v in _valores(df, key)], index=df.index, dtype=object)
+        limpo[key] = texto.mask(texto == "...", "")
+    limpo.update(_limpar_monetarios_lote(df))
+    limpo['ocr_valor_aliquota'] = pd.Series(interpretar_valores(_valores(df, 'ocr_valor_aliquota'), percentual=True),
+                                            index=df.index, dtype=object)
+    percentual = _como_texto(_valores(df, 'ocr_valor_tributos_fonte_percentual'), '').str.replace('%', '', regex=False)
+    limpo['ocr_valor_tributos_fonte_percentual'] = pd.Series(percentual.to_numpy(object), index=df.index).str.strip()
+    limpo['ocr_emissao_datahora'] = _limpar_datahoras_lote(_valores(df, 'ocr_emissao_datahora'))
+    return pd.DataFrame(limpo, index=df.index)
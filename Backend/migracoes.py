@@ -0,0 +1,119 @@
+"""
+Migrações de schema versionadas.
+
+Cada migração tem um número de versão, uma descrição e uma função que recebe a
+conexão. A tabela 'schema_version' regista as versões já aplicadas; as pendentes
+correm por ordem, uma única vez, protegidas por um lock do MySQL (GET_LOCK) para
+que vários processos a arrancar ao mesmo tempo não as executem em paralelo.
+
+As funções de migração propagam os erros (não os tratam só com print): uma migração que
+falha não é registada em 'schema_version' e volta a ser tentada no arranque seguinte.
+
+Num processo onde as migrações já foram verificadas, aplicar_migracoes não faz
+nenhuma consulta: as páginas normais não emitem DDL nem consultas de metadados.
+
+Uso no deploy (a partir da raiz do projeto):
+    python -m Backend.migracoes
+"""
+import threading
+
+import mysql.connector
+
+from .database import (
+    create_connection, create_notas_fiscais_table_if_not_exists, create_users_table_if_not_exists,
+    create_consulta_indexes_if_not_exist, create_rollup_table_if_not_exists, create_gravado_em_columns_if_not_exist,
+    create_versoes_table_if_not_exists
+)
+from .staging import create_staging_table_if_not_exists, create_motivo_revisao_column_if_not_exists
+from .duplicados import create_duplicados_table_if_not_exists, create_gravado_em_duplicados_if_not_exists
+from .pesquisa import create_pesquisa_indexes_if_not_exist, create_numero_digitos_if_not_exists
+from .particoes import preparar_particionamento, manter_particoes
+from .fornecedores import create_fornecedores_table_if_not_exists
+
+NOME_LOCK = 'nfse_migracoes'
+TIMEOUT_LOCK_SEGUNDOS = 120
+
+# ==============================================================================
+# MIGRAÇÕES (por ordem; nunca alterar uma migração já publicada, acrescentar uma nova)
+# ==============================================================================
+MIGRACOES = [
+    (1, "Tabela notas_fiscais (colunas OCR e índices)", create_notas_fiscais_table_if_not_exists),
+    (2, "Tabela users", create_users_table_if_not_exists),
+    (3, "Tabela extracoes_staging", create_staging_table_if_not_exists),
+    (4, "Tabela indice_duplicados", create_duplicados_table_if_not_exists),
+    (5, "Índices de consulta em notas_fiscais", create_consulta_indexes_if_not_exist),
+    (6, "Colunas de CNPJ só com dígitos e índices FULLTEXT", create_pesquisa_indexes_if_not_exist),
+    (7, "Tabela rollup_mensal (preenchida a partir das notas existentes)", create_rollup_table_if_not_exists),
+    (8, "Tabela notas_fiscais_arquivo e particionamento mensal (NOTAS_PARTICIONAMENTO=1)", preparar_particionamento),
+    (9, "Tabela fornecedores (preenchida a partir das notas existentes)", create_fornecedores_table_if_not_exists),
+    (10, "Coluna gravado_em (momento da última escrita) em notas_fiscais e no arquivo", create_gravado_em_columns_if_not_exist),
+    (11, "Coluna ocr_numero_digitos (número sem zeros à esquerda) em notas_fiscais e no arquivo", create_numero_digitos_if_not_exists),
+    (12, "Coluna motivo_revisao (fila de revisão do monitor) em extracoes_staging", create_motivo_revisao_column_if_not_exists),
+    (13, "Tabela versoes_tabelas (invalidação do cache de consultas entre processos)", create_versoes_table_if_not_exists),
+    (14, "Coluna gravado_em em indice_duplicados (sincronização do índice de quase-duplicados)", create_gravado_em_duplicados_if_not_exists),
+]
+
+_migracoes_verificadas = False
+_migracoes_lock = threading.Lock()
+
+
+def _versao_atual(cursor) -> int:
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            versao INT PRIMARY KEY,
+            descricao VARCHAR(255),
+            aplicada_em DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cursor.execute("SELECT COALESCE(MAX(versao), 0) FROM schema_version")
+    return cursor.fetchone()[0]
+
+
+def aplicar_migracoes(conn=None) -> bool:
+    """
+    Aplica as migrações pendentes (uma vez por processo). Retorna True se o schema está atualizado.
+    Se 'conn' não for fornecida, usa uma conexão do pool e devolve-a no fim.
+    """
+    global _migracoes_verificadas
+    if _migracoes_verificadas: return True
+    with _migracoes_lock:
+        if _migracoes_verificadas: return True
+        conexao_propria = conn is None
+        if conexao_propria: conn = create_connection()
+        if not conn or not conn.is_connected():
+            print("Erro: Conexão inválida para aplicar migrações.")
+            return False
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT GET_LOCK(%s, %s)", (NOME_LOCK, TIMEOUT_LOCK_SEGUNDOS))
+            if cursor.fetchone()[0] != 1:
+                print(f"Erro: Não foi possível obter o lock de migrações em {TIMEOUT_LOCK_SEGUNDOS}s.")
+                return False
+            try:
+                versao = _versao_atual(cursor)
+                pendentes = [m for m in MIGRACOES if m[0] > versao]
+                for numero, descricao, funcao in pendentes:
+                    print(f"[MIGRAÇÕES] A aplicar {numero}: {descricao}...")
+                    funcao(conn)
+                    cursor.execute("INSERT INTO schema_version (versao, descricao) VALUES (%s, %s)", (numero, descricao))
+                    conn.commit()
+                if pendentes: print(f"[MIGRAÇÕES] Schema atualizado para a versão {pendentes[-1][0]}.")
+                manter_particoes(conn) # Partições dos próximos meses (nada a fazer sem partições)
+                _migracoes_verificadas = True
+                return True
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (NOME_LOCK,))
+                cursor.fetchone()
+        except mysql.connector.Error as e:
+            print(f"Erro ao aplicar migrações: {e}")
+            try:
+                conn.rollback()
+            except Exception as rb_e:
+                print(f"Erro durante o rollback: {rb_e}")
+            return False
+        finally:
+            if conexao_propria and conn.is_connected(): conn.close()
+
+
+if __name__ == "__main__":
+    aplicar_migracoes()
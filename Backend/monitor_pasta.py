@@ -0,0 +1,343 @@
+"""
+Daemon de ingestão contínua para as pastas onde os scanners depositam ficheiros.
+
+Em vez de alguém clicar em "Analisar e Processar Pasta" na interface, este módulo
+monitoriza uma ou mais pastas (inotify via 'watchdog' quando disponível, varrimento
+periódico caso contrário), espera que cada ficheiro fique estável (debounce de
+ficheiros ainda a ser escritos), ignora os que já estão na base de dados e envia
+os restantes, um a um, para o pipeline de extração.
+
+Sem ninguém a rever, só as notas aprovadas pela validação automática (e sem texto
+quase duplicado nem prestador divergente) são salvas em 'notas_fiscais'; as outras
+ficam na staging, na fila de revisão que a interface mostra.
+
+Uso (a partir da raiz do projeto):
+    python -m Backend.monitor_pasta "H:\\projeto2\\Documentos" --debounce 3
+"""
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, Any, Optional, Iterable
+
+import mysql.connector
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- watchdog (opcional): usa inotify no Linux, ReadDirectoryChangesW no Windows ---
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    WATCHDOG_AVAILABLE = True
+except ImportError:
+    print("AVISO: Biblioteca 'watchdog' não encontrada. O monitor usará varrimento periódico da pasta.")
+    print("Instale com: pip install watchdog")
+    Observer = None
+    FileSystemEventHandler = object
+    WATCHDOG_AVAILABLE = False
+
+from .processador import processar_documento_com_llm_local, generate_file_hashes_compat, clean_and_format_data
+from .database import conexao_emprestada, insert_record
+from .esquema import Nota
+from .deduplicacao import hashes_existentes
+from .staging import salvar_extracao, marcar_para_revisao, hashes_em_revisao
+from .duplicados import obter_indice, registar_nota
+from .fornecedores import obter_cadastro, registar_fornecedores
+from .validacao import validar_nota, descrever_sinais
+from .migracoes import aplicar_migracoes
+
+# ==============================================================================
+# CONFIGURAÇÕES DO MONITOR
+# ==============================================================================
+EXTENSOES_SUPORTADAS = ('.png', '.jpg', '.jpeg', '.pdf', '.webp')
+DEBOUNCE_SEGUNDOS = float(os.getenv('MONITOR_DEBOUNCE_SEGUNDOS', '2.0'))
+INTERVALO_VARRIMENTO_SEGUNDOS = float(os.getenv('MONITOR_INTERVALO_SEGUNDOS', '5.0'))
+INTERVALO_VERIFICACAO_SEGUNDOS = 0.5 # Frequência com que os ficheiros pendentes são reavaliados
+MAX_ENTRADAS_MEMORIA = int(os.getenv('MONITOR_MAX_ENTRADAS_MEMORIA', '50000')) # Caminhos/hashes lembrados
+
+
+def _extensao_suportada(caminho: str) -> bool:
+    return caminho.lower().endswith(EXTENSOES_SUPORTADAS)
+
+
+def _lembrar(memoria: OrderedDict, chave, valor=None, limite: int = MAX_ENTRADAS_MEMORIA):
+    """Guarda chave -> valor numa memória limitada: acima do limite, esquece as entradas mais antigas."""
+    memoria[chave] = valor
+    memoria.move_to_end(chave)
+    while len(memoria) > limite: memoria.popitem(last=False)
+
+
+def salvar_resultado_no_banco(conn, filepath: str, current_hash: str, resultado: Dict[str, Any]) -> Optional[bool]:
+    """
+    Callback padrão: limpa o JSON extraído e grava-o em 'notas_fiscais' só se a nota dispensa revisão
+    (mesmo critério da aprovação automática de iniciar_processamento); as restantes ficam na fila de
+    revisão da staging. Retorna True se salvou, False se não há nada a salvar (sem JSON ou fila de
+    revisão) e None se a gravação falhou (o ficheiro volta a ser tentado).
+    """
+    filename = os.path.basename(filepath)
+    json_bruto = resultado.get("json_bruto_llm")
+    if not json_bruto:
+        print(f"    [MONITOR] Sem JSON válido para '{filename}'. Nada foi salvo.")
+        return False
+    dados_limpos = clean_and_format_data(json_bruto)
+    dados_limpos['hash'] = current_hash
+    dados_limpos['arquivo'] = filename
+    dados_limpos['data_processamento'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    validacao = validar_nota(dados_limpos)
+    motivos = [None if validacao['aprovada'] else descrever_sinais(validacao['sinais'])]
+    if resultado.get("quase_duplicado_de"):
+        motivos.append(f"texto quase igual ao da nota {resultado['quase_duplicado_de'][:7]}... "
+                       f"(similaridade {resultado['similaridade']:.0%}), com outra chave fiscal")
+    motivos.append(resultado.get("divergencia_prestador"))
+    motivo = "; ".join(filter(None, motivos))
+    if motivo:
+        if not marcar_para_revisao(conn, current_hash, motivo): return None
+        print(f"    [MONITOR] '{filename}' ficou na fila de revisão: {motivo}.")
+        return False
+
+    if not insert_record(conn, Nota.de_dict(dados_limpos)): return None
+    registar_fornecedores(conn, [dados_limpos])
+    return True
+
+
+class _ManipuladorEventos(FileSystemEventHandler):
+    """Encaminha eventos do watchdog para o registo de ficheiros pendentes do monitor."""
+
+    def __init__(self, monitor):
+        self.monitor = monitor
+
+    def on_created(self, event):
+        if not event.is_directory: self.monitor.registar_ficheiro(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory: self.monitor.registar_ficheiro(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory: self.monitor.registar_ficheiro(event.dest_path)
+
+
+class MonitorPasta:
+    """
+    Monitoriza pastas e processa continuamente os ficheiros novos.
+
+    Os eventos só marcam o ficheiro como pendente; um ficheiro passa para a fila de
+    processamento quando o tamanho e a data de modificação não mudam durante
+    'debounce_segundos'. Um único worker consome a fila, mantendo o uso de OCR/LLM
+    constante em vez de picos.
+    """
+
+    def __init__(self, pastas: Iterable[str], ao_extrair: Optional[Callable] = None,
+                 debounce_segundos: float = DEBOUNCE_SEGUNDOS, recursivo: bool = False):
+        self.pastas = [os.path.abspath(p) for p in pastas]
+        self.ao_extrair = ao_extrair or salvar_resultado_no_banco
+        self.debounce_segundos = debounce_segundos
+        self.recursivo = recursivo
+        self._pendentes = {} # caminho -> (tamanho, mtime, instante da última alteração)
+        self._em_fila = set()
+        self._vistos = OrderedDict() # caminho -> (tamanho, mtime) já tratados (evita re-hash a cada varrimento)
+        self._lock = threading.Lock()
+        self._fila = queue.Queue()
+        self._parar = threading.Event()
+        self._hashes_conhecidos = OrderedDict() # Hashes já tratados por este monitor (evita idas ao MySQL)
+        self._threads = []
+        self._observer = None
+
+    # --- Registo e debounce ---
+    def registar_ficheiro(self, caminho: str):
+        """Marca um ficheiro como pendente (ou reinicia o debounce se ainda estiver a ser escrito)."""
+        if not _extensao_suportada(caminho): return
+        try:
+            stat = os.stat(caminho)
+        except OSError:
+            return # Ficheiro removido/renomeado entretanto
+        with self._lock:
+            if caminho in self._em_fila: return
+            if self._vistos.get(caminho) == (stat.st_size, stat.st_mtime): return
+            anterior = self._pendentes.get(caminho)
+            if anterior and anterior[0] == stat.st_size and anterior[1] == stat.st_mtime:
+                return # Evento repetido sem alteração real
+            self._pendentes[caminho] = (stat.st_size, stat.st_mtime, time.monotonic())
+
+    def _promover_ficheiros_estaveis(self):
+        """Move para a fila os ficheiros que não mudaram durante o período de debounce."""
+        agora = time.monotonic()
+        with self._lock:
+            candidatos = list(self._pendentes.items())
+        for caminho, (tamanho, mtime, instante) in candidatos:
+            if agora - instante < self.debounce_segundos: continue
+            try:
+                stat = os.stat(caminho)
+            except OSError:
+                with self._lock: self._pendentes.pop(caminho, None)
+                continue
+            with self._lock:
+                if stat.st_size != tamanho or stat.st_mtime != mtime:
+                    self._pendentes[caminho] = (stat.st_size, stat.st_mtime, agora) # Ainda a ser escrito
+                    continue
+                if stat.st_size == 0: continue # Scanner criou o ficheiro mas ainda não escreveu
+                self._pendentes.pop(caminho, None)
+                self._em_fila.add(caminho)
+                _lembrar(self._vistos, caminho, (tamanho, mtime))
+            self._fila.put(caminho)
+
+    def _varrer_pastas(self):
+        """Regista todos os ficheiros compatíveis existentes nas pastas monitorizadas."""
+        for pasta in self.pastas:
+            try:
+                if self.recursivo:
+                    for raiz, _, ficheiros in os.walk(pasta):
+                        for f in ficheiros: self.registar_ficheiro(os.path.join(raiz, f))
+                else:
+                    for entrada in os.scandir(pasta):
+                        if entrada.is_file(): self.registar_ficheiro(entrada.path)
+            except OSError as e:
+                print(f"    [MONITOR] Erro ao varrer a pasta '{pasta}': {e}")
+
+    def _loop_debounce(self):
+        ultimo_varrimento = 0.0
+        while not self._parar.is_set():
+            if not WATCHDOG_AVAILABLE and time.monotonic() - ultimo_varrimento >= INTERVALO_VARRIMENTO_SEGUNDOS:
+                self._varrer_pastas()
+                ultimo_varrimento = time.monotonic()
+            self._promover_ficheiros_estaveis()
+            self._parar.wait(INTERVALO_VERIFICACAO_SEGUNDOS)
+
+    # --- Processamento ---
+    def _processar_ficheiro(self, filepath: str) -> bool:
+        """
+        Processa um ficheiro estável. Retorna True se deve voltar a ser tentado mais tarde
+        (sem conexão, ou uma consulta/gravação no MySQL falhou).
+
+        Cada etapa com base de dados usa uma conexão do pool só durante essa etapa: nenhuma
+        fica presa durante o OCR/LLM.
+        """
+        filename = os.path.basename(filepath)
+        try:
+            current_hash, hashes_legados = generate_file_hashes_compat(filepath)
+        except OSError as e:
+            print(f"    [MONITOR] Não foi possível gerar o hash para '{filename}': {e}. Ficheiro ignorado.")
+            return False
+        candidatos = [current_hash, *hashes_legados]
+        if any(h in self._hashes_conhecidos for h in candidatos):
+            print(f"    [MONITOR] '{filename}' (hash: {current_hash[:7]}...) já foi processado. Ignorado.")
+            return False
+
+        with conexao_emprestada() as conn:
+            if conn is None:
+                print(f"    [MONITOR] Sem conexão à base de dados. '{filename}' voltará a ser tentado.")
+                return True
+            try:
+                ja_tratado = bool(hashes_existentes(conn, candidatos, propagar_erros=True) or hashes_em_revisao(conn, [current_hash]))
+            except mysql.connector.Error as e:
+                print(f"    [MONITOR] Erro ao verificar se '{filename}' já foi processado: {e}. Voltará a ser tentado.")
+                return True
+            if not ja_tratado: indice, cadastro = obter_indice(conn), obter_cadastro(conn)
+        if ja_tratado:
+            _lembrar(self._hashes_conhecidos, current_hash)
+            print(f"    [MONITOR] '{filename}' (hash: {current_hash[:7]}...) já foi processado ou está por rever. Ignorado.")
+            return False
+
+        inicio = time.monotonic()
+        resultado = processar_documento_com_llm_local(filepath, indice, current_hash, cadastro)
+        if resultado.get("duplicado_de"):
+            print(f"    [MONITOR] '{filename}' é duplicado da nota {resultado['duplicado_de'][:7]}... (mesma chave fiscal). Ignorado.")
+            _lembrar(self._hashes_conhecidos, current_hash)
+            return False
+
+        with conexao_emprestada() as conn:
+            if conn is None or not salvar_extracao(conn, current_hash, filename, resultado):
+                print(f"    [MONITOR] Não foi possível gravar a extração de '{filename}' na staging. Voltará a ser tentado.")
+                return True
+            salvo = self.ao_extrair(conn, filepath, current_hash, resultado)
+            if salvo is None:
+                print(f"    [MONITOR] Erro ao salvar '{filename}' na base de dados. Voltará a ser tentado.")
+                return True
+            _lembrar(self._hashes_conhecidos, current_hash)
+            if salvo:
+                registar_nota(conn, current_hash, resultado.get("texto_bruto_ocr"), resultado.get("json_bruto_llm"))
+                print(f"    [MONITOR] '{filename}' processado em {time.monotonic() - inicio:.1f}s.")
+        return False
+
+    def _loop_processamento(self):
+        while not self._parar.is_set():
+            try:
+                filepath = self._fila.get(timeout=INTERVALO_VERIFICACAO_SEGUNDOS)
+            except queue.Empty:
+                continue
+            tentar_novamente = False
+            try:
+                tentar_novamente = self._processar_ficheiro(filepath)
+            except Exception as e:
+                print(f"    [MONITOR] Erro fatal ao processar '{filepath}': {e}")
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._em_fila.discard(filepath)
+                    if tentar_novamente: self._vistos.pop(filepath, None)
+                self._fila.task_done()
+            if tentar_novamente:
+                self._parar.wait(INTERVALO_VARRIMENTO_SEGUNDOS) # Evita martelar o MySQL enquanto está em baixo
+                self.registar_ficheiro(filepath)
+
+    # --- Ciclo de vida ---
+    def iniciar(self):
+        """Regista os ficheiros já presentes e arranca as threads."""
+        self._varrer_pastas()
+
+        if WATCHDOG_AVAILABLE:
+            self._observer = Observer()
+            manipulador = _ManipuladorEventos(self)
+            for pasta in self.pastas:
+                self._observer.schedule(manipulador, pasta, recursive=self.recursivo)
+            self._observer.start()
+
+        for alvo in (self._loop_debounce, self._loop_processamento):
+            t = threading.Thread(target=alvo, daemon=True)
+            t.start()
+            self._threads.append(t)
+        modo = "eventos do sistema de ficheiros" if WATCHDOG_AVAILABLE else "varrimento periódico"
+        print(f"[MONITOR] A monitorizar {', '.join(self.pastas)} ({modo}, debounce {self.debounce_segundos}s).")
+
+    def parar(self):
+        self._parar.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+        for t in self._threads: t.join()
+        print("[MONITOR] Monitor parado.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Monitoriza pastas e processa continuamente novas NFS-e.")
+    parser.add_argument("pastas", nargs="+", help="Pastas a monitorizar.")
+    parser.add_argument("--debounce", type=float, default=DEBOUNCE_SEGUNDOS,
+                        help="Segundos sem alterações antes de um ficheiro ser considerado completo.")
+    parser.add_argument("--recursivo", action="store_true", help="Monitoriza também as subpastas.")
+    args = parser.parse_args(argv)
+
+    pastas_invalidas = [p for p in args.pastas if not os.path.isdir(p)]
+    if pastas_invalidas:
+        print(f"Erro: Caminho(s) de pasta inválido(s) ou inacessível(eis): {', '.join(pastas_invalidas)}")
+        sys.exit(1)
+
+    if not aplicar_migracoes(): # As gravações dependem das tabelas auxiliares (staging, rollups...)
+        print("Erro: Não foi possível aplicar as migrações do schema.")
+        sys.exit(1)
+
+    monitor = MonitorPasta(args.pastas, debounce_segundos=args.debounce, recursivo=args.recursivo)
+    monitor.iniciar()
+    try:
+        while True: time.sleep(1)
+    except KeyboardInterrupt:
+        monitor.parar()
+
+
+if __name__ == "__main__":
+    main()
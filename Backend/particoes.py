@@ -0,0 +1,208 @@
+"""
+Particionamento mensal de 'notas_fiscais' e arquivo dos anos fiscais fechados.
+
+Com NOTAS_PARTICIONAMENTO=1, a migração particiona a tabela por RANGE sobre a coluna gerada
+'ano_mes' (AAAAMM do mês de emissão; 0 sem data). O MySQL exige que a coluna de
+partição faça parte de todas as chaves únicas, pelo que a chave primária passa a
+(hash, ano_mes); o upsert alinha primeiro o mês de emissão das notas regravadas
+(Backend/database.py), para que uma nota continue a ter uma única linha. As tabelas
+InnoDB particionadas não suportam índices FULLTEXT: ao particionar, esses índices são
+removidos e o planeador de pesquisa volta a usar LIKE nas colunas de nomes.
+
+O resto da aplicação não lê NOTAS_PARTICIONAMENTO: o estado real das tabelas (partições,
+índices FULLTEXT, notas arquivadas) é lido do information_schema (estado_tabelas em
+Backend/database.py). Com partições, os filtros de data das consultas acrescentam a condição
+equivalente sobre 'ano_mes', que o MySQL usa para ler só as partições do intervalo (partition pruning).
+
+O arquivo move as notas dos anos fechados (anteriores aos ANOS_ATIVOS mais recentes)
+para 'notas_fiscais_arquivo', comprimida (ROW_FORMAT=COMPRESSED). Os rollups mensais
+não são alterados, e a reconstrução dos rollups, as consultas, a contagem, os agregados e as
+exportações também leem o arquivo sempre que o intervalo de datas pode conter notas arquivadas.
+
+Uso (a partir da raiz do projeto):
+    python -m Backend.particoes particionar     # Particiona uma tabela já existente
+    python -m Backend.particoes manter          # Cria as partições dos próximos meses
+    python -m Backend.particoes arquivar        # Move os anos fechados para o arquivo
+"""
+import os
+import argparse
+from datetime import date
+from typing import List, Optional
+
+import mysql.connector
+from mysql.connector import errorcode
+
+from .database import (
+    create_connection, invalidar_tabelas, incrementar_versoes, invalidar_estado_tabelas, TABELA_ARQUIVO, COLUNA_GRAVADO_EM
+)
+from .esquema import COLUNAS_SQL
+from .pesquisa import COLUNAS_TEXTO_INTEGRAL
+
+MESES_A_FRENTE = 3 # Partições criadas antecipadamente para os próximos meses
+ANOS_ATIVOS = 2 # Ano corrente + anterior ficam na tabela principal
+PARTICIONAMENTO_PEDIDO = os.getenv('NOTAS_PARTICIONAMENTO', '0') == '1' # Só decide se a migração particiona
+
+
+def _nome_particao(ano_mes: int) -> str:
+    return f"p{ano_mes}"
+
+
+def _somar_meses(ano_mes: int, meses: int) -> int:
+    indice = (ano_mes // 100) * 12 + (ano_mes % 100 - 1) + meses
+    return (indice // 12) * 100 + indice % 12 + 1
+
+
+def _particoes_existentes(cursor) -> List[str]:
+    cursor.execute("""
+        SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'notas_fiscais' AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """)
+    return [row[0] for row in cursor.fetchall()]
+
+
+# ==============================================================================
+# TABELA DE ARQUIVO E PARTICIONAMENTO (migração)
+# ==============================================================================
+def create_arquivo_table_if_not_exists(conn):
+    """Cria 'notas_fiscais_arquivo' com a estrutura de 'notas_fiscais', comprimida e sem partições."""
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {TABELA_ARQUIVO} LIKE notas_fiscais")
+    if _particoes_existentes(cursor):
+        cursor.execute(f"ALTER TABLE {TABELA_ARQUIVO} REMOVE PARTITIONING")
+    cursor.execute(f"ALTER TABLE {TABELA_ARQUIVO} ROW_FORMAT=COMPRESSED KEY_BLOCK_SIZE=8")
+    conn.commit()
+    print(f"Tabela '{TABELA_ARQUIVO}' verificada/atualizada com sucesso.")
+
+
+def particionar_notas(conn):
+    """Particiona 'notas_fiscais' por mês de emissão (não faz nada se já estiver particionada)."""
+    cursor = conn.cursor()
+    if _particoes_existentes(cursor):
+        print("Tabela 'notas_fiscais' já está particionada.")
+        return
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'notas_fiscais' AND COLUMN_NAME = 'ano_mes'
+    """)
+    if cursor.fetchone()[0] == 0:
+        cursor.execute("ALTER TABLE notas_fiscais ADD COLUMN ano_mes INT AS "
+                       "(COALESCE(YEAR(ocr_emissao_datahora) * 100 + MONTH(ocr_emissao_datahora), 0)) STORED NOT NULL")
+    for nome_indice in COLUNAS_TEXTO_INTEGRAL.values():
+        try: cursor.execute(f"DROP INDEX {nome_indice} ON notas_fiscais")
+        except mysql.connector.Error as e:
+            if e.errno != errorcode.ER_CANT_DROP_FIELD_OR_KEY: raise # Só ignora o índice inexistente
+    cursor.execute("ALTER TABLE notas_fiscais DROP PRIMARY KEY, ADD PRIMARY KEY (hash, ano_mes)")
+
+    cursor.execute("SELECT MIN(NULLIF(ano_mes, 0)) FROM notas_fiscais")
+    hoje = date.today()
+    atual = hoje.year * 100 + hoje.month
+    inicio = min(cursor.fetchone()[0] or atual, atual)
+    meses, mes = [], inicio
+    while mes <= _somar_meses(atual, MESES_A_FRENTE):
+        meses.append(mes)
+        mes = _somar_meses(mes, 1)
+    definicoes = ["PARTITION p_sem_data VALUES LESS THAN (1)"]
+    definicoes += [f"PARTITION {_nome_particao(m)} VALUES LESS THAN ({_somar_meses(m, 1)})" for m in meses]
+    definicoes.append("PARTITION p_futuro VALUES LESS THAN MAXVALUE")
+    cursor.execute(f"ALTER TABLE notas_fiscais PARTITION BY RANGE (ano_mes) ({', '.join(definicoes)})")
+    incrementar_versoes(cursor, 'notas_fiscais')
+    conn.commit()
+    invalidar_estado_tabelas()
+    invalidar_tabelas('notas_fiscais')
+    print(f"Tabela 'notas_fiscais' particionada por mês ({len(meses)} partições mensais).")
+
+
+def preparar_particionamento(conn):
+    """Migração: tabela de arquivo sempre; particionamento só com NOTAS_PARTICIONAMENTO=1."""
+    create_arquivo_table_if_not_exists(conn)
+    if PARTICIONAMENTO_PEDIDO: particionar_notas(conn)
+
+
+def manter_particoes(conn, meses_a_frente: int = MESES_A_FRENTE) -> int:
+    """Garante partições até 'meses_a_frente' meses depois do atual (divide p_futuro). Retorna quantas criou."""
+    cursor = conn.cursor()
+    mensais = [int(p[1:]) for p in _particoes_existentes(cursor) if p[1:].isdigit()]
+    if not mensais: return 0
+    hoje = date.today()
+    alvo = _somar_meses(hoje.year * 100 + hoje.month, meses_a_frente)
+    novos, mes = [], _somar_meses(max(mensais), 1)
+    while mes <= alvo:
+        novos.append(mes)
+        mes = _somar_meses(mes, 1)
+    if not novos: return 0
+    definicoes = [f"PARTITION {_nome_particao(m)} VALUES LESS THAN ({_somar_meses(m, 1)})" for m in novos]
+    cursor.execute(f"ALTER TABLE notas_fiscais REORGANIZE PARTITION p_futuro INTO "
+                   f"({', '.join(definicoes)}, PARTITION p_futuro VALUES LESS THAN MAXVALUE)")
+    conn.commit()
+    print(f"{len(novos)} partições mensais criadas em 'notas_fiscais'.")
+    return len(novos)
+
+
+# ==============================================================================
+# ARQUIVO DOS ANOS FECHADOS
+# ==============================================================================
+def arquivar_anos_fechados(conn, anos_ativos: int = ANOS_ATIVOS, ano_limite: Optional[int] = None) -> int:
+    """
+    Move para 'notas_fiscais_arquivo' as notas emitidas antes de 1 de janeiro de 'ano_limite'
+    (por omissão, o primeiro dos 'anos_ativos' anos mais recentes), um mês por transação.
+    Com a tabela particionada, as partições esvaziadas são removidas. Retorna o número de notas movidas.
+    """
+    ano_limite = ano_limite or date.today().year - anos_ativos + 1
+    colunas = f"{COLUNAS_SQL}, `{COLUNA_GRAVADO_EM}`" # Mantém o momento da gravação (marcas d'água incrementais)
+    cursor = conn.cursor()
+    cursor.execute("SELECT MIN(ocr_emissao_datahora) FROM notas_fiscais WHERE ocr_emissao_datahora < %s",
+                   (date(ano_limite, 1, 1),))
+    primeira = cursor.fetchone()[0]
+    if primeira is None: return 0
+
+    total, mes = 0, primeira.year * 100 + primeira.month
+    while mes < ano_limite * 100 + 1:
+        inicio = date(mes // 100, mes % 100, 1)
+        seguinte = _somar_meses(mes, 1)
+        fim = date(seguinte // 100, seguinte % 100, 1)
+        try:
+            filtro = "ocr_emissao_datahora >= %s AND ocr_emissao_datahora < %s"
+            cursor.execute(f"REPLACE INTO {TABELA_ARQUIVO} ({colunas}) SELECT {colunas} FROM notas_fiscais WHERE {filtro}", (inicio, fim))
+            cursor.execute(f"DELETE FROM notas_fiscais WHERE {filtro}", (inicio, fim))
+            movidas = cursor.rowcount
+            incrementar_versoes(cursor, 'notas_fiscais')
+            conn.commit()
+        except mysql.connector.Error as e:
+            print(f"Erro ao arquivar as notas de {inicio:%Y-%m}: {e}")
+            conn.rollback()
+            raise
+        total += movidas
+        mes = seguinte
+
+    antigas = [p for p in _particoes_existentes(cursor) if p[1:].isdigit() and int(p[1:]) < ano_limite * 100 + 1]
+    if antigas:
+        cursor.execute(f"ALTER TABLE notas_fiscais DROP PARTITION {', '.join(antigas)}")
+        print(f"{len(antigas)} partições vazias removidas.")
+    invalidar_estado_tabelas()
+    invalidar_tabelas('notas_fiscais')
+    print(f"{total} notas anteriores a {ano_limite} movidas para '{TABELA_ARQUIVO}'.")
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Particionamento mensal e arquivo de notas_fiscais.")
+    parser.add_argument("comando", choices=['particionar', 'manter', 'arquivar'])
+    parser.add_argument("--anos-ativos", type=int, default=ANOS_ATIVOS,
+                        help="Anos mais recentes que ficam na tabela principal (arquivar).")
+    args = parser.parse_args(argv)
+
+    conn = create_connection()
+    if not conn:
+        print("Erro: Não foi possível conectar à base de dados.")
+        return
+    try:
+        if args.comando == 'particionar': particionar_notas(conn)
+        elif args.comando == 'manter': manter_particoes(conn)
+        else: arquivar_anos_fechados(conn, anos_ativos=args.anos_ativos)
+    finally:
+        if conn.is_connected(): conn.close()
+
+
+if __name__ == "__main__":
+    main()
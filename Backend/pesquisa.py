@@ -0,0 +1,165 @@
+"""
+Pesquisa indexada em 'notas_fiscais'.
+
+O filtro antigo, LOWER(coluna) LIKE '%termo%', não usa nenhum índice: cada pesquisa
+lia a tabela inteira. Este módulo escolhe, por coluna, a forma de comparação que um
+índice consegue servir:
+
+  * CNPJ/CPF: colunas geradas só com dígitos ('*_cnpj_digitos', indexadas), pelo que
+    '11111111000111' encontra '11.111.111/0001-11'. 14 ou 11 dígitos -> igualdade;
+    menos dígitos -> prefixo.
+  * Nomes e discriminação: índices FULLTEXT, consultados em BOOLEAN MODE com prefixo
+    em cada palavra ('+palavra*'), se o índice existir na tabela consultada (o chamador
+    passa as colunas com índice, lidas do information_schema; ver estado_tabelas em
+    Backend/database.py). Sem índice (ex: tabela particionada), LIKE. O FULLTEXT encontra
+    palavras que começam pelo termo, não texto no meio de uma palavra: 'ltda' encontra
+    'Ltda.' mas não 'XLTDA' (o LIKE '%termo%' encontrava).
+  * Número da nota: prefixo sobre a coluna gerada 'ocr_numero_digitos' (sem pontuação e
+    sem zeros à esquerda, indexada), pelo que '555' encontra '0000555' e '000.555' e um
+    número incompleto ('55') também encontra a nota.
+  * Código de verificação: igualdade; categoria: prefixo.
+  * Restantes colunas (ou termos que o índice não serve): LIKE '%termo%' como antes.
+
+As colunas usam a collation da tabela (case-insensitive), por isso não é preciso LOWER().
+"""
+import re
+from typing import Any, Dict, Iterable, Tuple
+
+import mysql.connector
+from mysql.connector import errorcode
+
+# Colunas geradas (dígitos do CNPJ/CPF) associadas às colunas originais
+COLUNAS_CNPJ_DIGITOS = {
+    'ocr_prestador_cpf_cnpj': 'ocr_prestador_cnpj_digitos',
+    'ocr_tomador_cpf_cnpj': 'ocr_tomador_cnpj_digitos',
+}
+COLUNAS_TEXTO_INTEGRAL = {
+    'ocr_prestador_nome': 'ft_prestador_nome',
+    'ocr_tomador_nome': 'ft_tomador_nome',
+    'ocr_discriminacao': 'ft_discriminacao',
+}
+COLUNA_NUMERO_DIGITOS = 'ocr_numero_digitos' # Número da nota sem pontuação nem zeros à esquerda
+COLUNAS_IGUALDADE = ['hash', 'ocr_codigo_verificacao']
+TABELAS_PESQUISA = ['notas_fiscais', 'notas_fiscais_arquivo'] # O arquivo (Backend/particoes.py) também é pesquisado
+COLUNAS_PREFIXO = ['categoria', 'arquivo']
+
+TAMANHO_MINIMO_PALAVRA = 3 # innodb_ft_min_token_size por omissão
+
+_RE_NAO_DIGITO = re.compile(r'\D+')
+_RE_PALAVRAS = re.compile(r'\w+', re.UNICODE)
+
+
+def _expressao_digitos(coluna: str) -> str:
+    """Expressão SQL que remove a pontuação habitual de um CNPJ/CPF (compatível com MySQL 5.7)."""
+    return f"REPLACE(REPLACE(REPLACE(REPLACE(`{coluna}`, '.', ''), '/', ''), '-', ''), ' ', '')"
+
+
+def _numero_sem_zeros(termo: str) -> str:
+    """O que a coluna 'ocr_numero_digitos' guarda para este número ('000.555' -> '555')."""
+    for caracter in './- ': termo = termo.replace(caracter, '')
+    return termo.lstrip('0')
+
+
+def _escapar_like(termo: str) -> str:
+    return termo.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# ==============================================================================
+# SCHEMA
+# ==============================================================================
+def create_pesquisa_indexes_if_not_exist(conn):
+    """Cria as colunas geradas de CNPJ só com dígitos, os seus índices e os índices FULLTEXT."""
+    if not conn or not conn.is_connected():
+        print("Erro: Conexão inválida para criar os índices de pesquisa.")
+        return
+    from .database import _criar_indice # Importação tardia: database importa este módulo
+    cursor = conn.cursor()
+    try:
+        for coluna, coluna_digitos in COLUNAS_CNPJ_DIGITOS.items():
+            cursor.execute("""
+                SELECT COUNT(*) FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'notas_fiscais' AND COLUMN_NAME = %s
+            """, (coluna_digitos,))
+            if cursor.fetchone()[0] == 0:
+                cursor.execute(f"ALTER TABLE notas_fiscais ADD COLUMN `{coluna_digitos}` VARCHAR(20) "
+                               f"AS ({_expressao_digitos(coluna)}) STORED")
+                print(f"Coluna gerada '{coluna_digitos}' adicionada à tabela 'notas_fiscais'.")
+            _criar_indice(cursor, f"CREATE INDEX idx_{coluna_digitos} ON notas_fiscais (`{coluna_digitos}`);")
+        for coluna, nome_indice in COLUNAS_TEXTO_INTEGRAL.items():
+            # Tabela particionada: sem FULLTEXT, o planeador usa LIKE (o estado é lido do information_schema)
+            if not _criar_indice(cursor, f"CREATE FULLTEXT INDEX {nome_indice} ON notas_fiscais (`{coluna}`);",
+                                 ignorar=(errorcode.ER_DUP_KEYNAME, errorcode.ER_TABLE_CANT_HANDLE_FT)):
+                print(f"Índice FULLTEXT '{nome_indice}' não criado (já existe ou a tabela está particionada).")
+        conn.commit()
+        print("Índices de pesquisa de 'notas_fiscais' verificados com sucesso.")
+    except mysql.connector.Error as e:
+        print(f"Erro ao criar os índices de pesquisa: {e}")
+        raise
+
+
+def create_numero_digitos_if_not_exists(conn):
+    """Cria a coluna gerada 'ocr_numero_digitos' (e o seu índice) em 'notas_fiscais' e no arquivo, se existir."""
+    if not conn or not conn.is_connected():
+        print("Erro: Conexão inválida para criar a coluna do número da nota.")
+        return
+    from .database import _criar_indice # Importação tardia: database importa este módulo
+    cursor = conn.cursor()
+    try:
+        for tabela in TABELAS_PESQUISA:
+            cursor.execute("""
+                SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+            """, (tabela,))
+            if cursor.fetchone()[0] == 0: continue
+            cursor.execute("""
+                SELECT COUNT(*) FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+            """, (tabela, COLUNA_NUMERO_DIGITOS))
+            if cursor.fetchone()[0] == 0:
+                cursor.execute(f"ALTER TABLE {tabela} ADD COLUMN `{COLUNA_NUMERO_DIGITOS}` VARCHAR(50) "
+                               f"AS (TRIM(LEADING '0' FROM {_expressao_digitos('ocr_numero')})) STORED")
+                print(f"Coluna gerada '{COLUNA_NUMERO_DIGITOS}' adicionada à tabela '{tabela}'.")
+            _criar_indice(cursor, f"CREATE INDEX idx_{COLUNA_NUMERO_DIGITOS} ON {tabela} (`{COLUNA_NUMERO_DIGITOS}`);")
+        conn.commit()
+    except mysql.connector.Error as e:
+        print(f"Erro ao criar a coluna do número da nota: {e}")
+        raise
+
+
+# ==============================================================================
+# PLANEADOR
+# ==============================================================================
+def planear_pesquisa(coluna: str, termo: str, nome_param: str = 'termo',
+                     colunas_fulltext: Iterable[str] = ()) -> Tuple[str, Dict[str, Any], str]:
+    """
+    Escolhe a condição SQL (com parâmetros nomeados SQLAlchemy) para procurar 'termo' em 'coluna'.
+    'colunas_fulltext' são as colunas com índice FULLTEXT na tabela consultada.
+    Retorna (condição, parâmetros, estratégia), com estratégia em 'exata', 'prefixo',
+    'texto_integral' ou 'contem'.
+    """
+    termo = str(termo or '').strip()
+
+    if coluna in COLUNAS_CNPJ_DIGITOS:
+        digitos = _RE_NAO_DIGITO.sub('', termo)
+        if digitos:
+            coluna_digitos = COLUNAS_CNPJ_DIGITOS[coluna]
+            if len(digitos) in (11, 14):
+                return f"`{coluna_digitos}` = :{nome_param}", {nome_param: digitos}, 'exata'
+            return f"`{coluna_digitos}` LIKE :{nome_param}", {nome_param: f"{digitos}%"}, 'prefixo'
+
+    elif coluna in COLUNAS_TEXTO_INTEGRAL and coluna in colunas_fulltext:
+        palavras = _RE_PALAVRAS.findall(termo)
+        if palavras and all(len(p) >= TAMANHO_MINIMO_PALAVRA for p in palavras):
+            expressao = ' '.join(f"+{p}*" for p in palavras)
+            return f"MATCH(`{coluna}`) AGAINST (:{nome_param} IN BOOLEAN MODE)", {nome_param: expressao}, 'texto_integral'
+
+    elif coluna == 'ocr_numero' and _numero_sem_zeros(termo).isdigit():
+        # Prefixo (e não igualdade): números incompletos também encontram a nota; o índice serve ambos
+        return f"`{COLUNA_NUMERO_DIGITOS}` LIKE :{nome_param}", {nome_param: f"{_numero_sem_zeros(termo)}%"}, 'prefixo'
+
+    elif coluna in COLUNAS_IGUALDADE:
+        return f"`{coluna}` = :{nome_param}", {nome_param: termo}, 'exata'
+
+    elif coluna in COLUNAS_PREFIXO:
+        return f"`{coluna}` LIKE :{nome_param}", {nome_param: f"{_escapar_like(termo)}%"}, 'prefixo'
+
+    return f"`{coluna}` LIKE :{nome_param}", {nome_param: f"%{_escapar_like(termo)}%"}, 'contem'
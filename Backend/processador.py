@@ -2,10 +2,9 @@ import os
 import json
 import hashlib
 import re # Importa a biblioteca de expressões regulares
-import base64
 import io
-from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 import time # Para Azure OCR
 from dotenv import load_dotenv # Mantido para credenciais DB, se necessário
 import traceback # Para depuração de erros
@@ -18,6 +17,11 @@ load_dotenv()
 import ollama
 import fitz # PyMuPDF para PDFs
 
+from .duplicados import verificar_texto, confirmar_duplicado, confirmar_duplicado_no_texto
+from .limpeza import clean_and_format_data, clean_and_format_dataframe # Reexportadas (ver Backend/limpeza.py)
+from .esquema import CAMPOS_ESPERADOS
+from .fornecedores import CAMPOS_FORNECEDOR, formatar_documento
+
 # --- Bibliotecas Azure ---
 try:
     from azure.cognitiveservices.vision.computervision import ComputerVisionClient
@@ -70,9 +74,10 @@ except Exception as e:
 # ==============================================================================
 # FUNÇÃO DE EXTRAÇÃO DE TEXTO (AZURE COMPUTER VISION) COM MELHOR ERROR HANDLING
 # ==============================================================================
-def extrair_texto_com_azure(filepath: str) -> str:
+def extrair_texto_com_azure(filepath: str, layout: list = None) -> str:
     """
     Extrai texto bruto de um ficheiro (imagem ou PDF) usando Azure Computer Vision OCR.
+    Se 'layout' for uma lista, é preenchida com {pagina, texto, bbox} de cada linha lida.
     """
     # Verifica disponibilidade e credenciais carregadas
     if not AZURE_AVAILABLE or not AZURE_SUBSCRIPTION_KEY or not AZURE_ENDPOINT:
@@ -195,6 +200,8 @@ def extrair_texto_com_azure(filepath: str) -> str:
                                 for line in text_result.lines:
                                     if line.text:
                                         texto_extraido_total += line.text + "\n"
+                                        if layout is not None:
+                                            layout.append({"pagina": i + 1, "texto": line.text, "bbox": list(line.bounding_box or [])})
                     else: print(f"    [AZURE OCR] Operação {i+1} sucedeu, mas não retornou resultados analisáveis.")
                 elif read_result:
                     print(f"    [AZURE OCR] Falha na operação {i+1} para '{filename}'. Status: {read_result.status}")
@@ -216,33 +223,106 @@ def extrair_texto_com_azure(filepath: str) -> str:
     return texto_extraido_total
 
 
+# ==============================================================================
+# FORMATO JSON DO PROMPT
+# ==============================================================================
+# Saída esperada para o texto de exemplo do prompt (mesma ordem de CAMPOS_ESPERADOS)
+EXEMPLO_SAIDA_LLM = {
+    "ocr_numero": "0000555", "ocr_emissao_datahora": "15/03/2024 10:30:00", "ocr_codigo_verificacao": "ABCD-1234",
+    "ocr_prestador_nome": "MINHA EMPRESA DE SERVIÇOS LTDA", "ocr_prestador_cpf_cnpj": "11.111.111/0001-11", "ocr_prestador_inscricao_municipal": "98765",
+    "ocr_prestador_endereco": "", "ocr_prestador_municipio": "EXEMPLO", "ocr_prestador_uf": "EX",
+    "ocr_tomador_nome": "CLIENTE IMPORTANTE S/A", "ocr_tomador_cpf_cnpj": "22.222.222/0001-22", "ocr_tomador_endereco": "RUA EXEMPLO, 123",
+    "ocr_tomador_inscricao_municipal": "", "ocr_tomador_municipio": "", "ocr_tomador_uf": "", "ocr_tomador_email": "contato@cliente.com",
+    "ocr_discriminacao": "Consultoria especializada. Ref. Contrato XPTO. Suporte técnico em informática.", "ocr_codigo_servico": "01.07",
+    "ocr_valor_total": "1.500,00", "ocr_valor_base_calculo": "1.500,00", "ocr_valor_aliquota": "5,00%", "ocr_valor_iss": "75,00",
+    "ocr_valor_deducoes": "0,00", "ocr_valor_pis_pasep": "9,75", "ocr_valor_cofins": "45,00", "ocr_valor_csll": "15,00",
+    "ocr_valor_irrf": "22,50", "ocr_valor_inss": "0,00", "ocr_valor_credito": "", "ocr_valor_tributos_fonte": "166,25",
+    "ocr_valor_tributos_fonte_percentual": "11,08%", "ocr_municipio_prestacao_servico": "",
+    "ocr_intermediario_nome": "", "ocr_intermediario_cpf_cnpj": "", "ocr_outras_informacoes": "",
+    "ocr_numero_inscricao_obra": "", "alogo_visivel": "", "categoria": "Consultoria TI"
+}
+
+
+def _formato_json(campos: List[str], valores: Dict[str, str] = None, por_linha: int = 3) -> str:
+    """Objeto JSON do prompt só com 'campos' (valores do exemplo, ou "..." para preencher), alguns por linha."""
+    pares = []
+    for campo in campos:
+        valor = json.dumps(valores[campo], ensure_ascii=False) if valores else '"..."'
+        pares.append(f'"{campo}": {valor}')
+    linhas = [", ".join(pares[i:i + por_linha]) for i in range(0, len(pares), por_linha)]
+    return "{\n            " + ",\n            ".join(linhas) + "\n        }"
+
+
 # ==============================================================================
 # FUNÇÃO PRINCIPAL DE PROCESSAMENTO (LLM) - AGORA USA AZURE OCR
 # ==============================================================================
-def processar_documento_com_llm_local(filepath: str) -> Dict[str, Any]:
+def processar_documento_com_llm_local(filepath: str, indice_duplicados=None, current_hash: str = None,
+                                     cadastro_fornecedores=None) -> Dict[str, Any]:
     """
     Processa um documento:
     1. Extrai texto usando Azure Computer Vision OCR.
-    2. Envia o texto extraído para o modelo LLM (Ollama) para estruturação em JSON.
-    3. RETORNA um dicionário com o texto bruto e o JSON bruto para fine-tuning.
+    2. Se 'indice_duplicados' for fornecido, procura uma nota já salva com texto quase igual.
+    3. Envia o texto extraído para o modelo LLM (Ollama) para estruturação em JSON. Se o
+       prestador estiver em 'cadastro_fornecedores', os seus campos vêm do cadastro e não
+       são pedidos ao LLM (ver Backend/fornecedores.py).
+    4. RETORNA um dicionário com o texto bruto e o JSON bruto para fine-tuning. Com uma nota
+       quase igual, devolve 'duplicado_de' se a chave fiscal também for a dela (é a mesma nota;
+       se a chave já está no texto OCR, sem chamar o LLM) ou 'quase_duplicado_de' caso
+       contrário (a nota segue para revisão).
     """
     filename = os.path.basename(filepath)
 
     # 1. Extrai o texto usando a nova função Azure OCR
     print(f"    [FLUXO] Iniciando extração de texto com Azure OCR para '{filename}'...")
-    texto_bruto = extrair_texto_com_azure(filepath)
+    layout_ocr = []
+    inicio_ocr = time.monotonic()
+    texto_bruto = extrair_texto_com_azure(filepath, layout=layout_ocr)
+    tempos = {"ocr_s": round(time.monotonic() - inicio_ocr, 3), "llm_s": None}
 
     dados_extraidos = {}
     resposta_llm = ""
+    fornecedor = None
+    # Modelo LLM para Extração JSON (mantido como Ollama)
+    modelo_usado = 'phi3:medium' # Ou seu modelo fine-tuned: 'meu_extrator_nfse:latest'
+    # Metadados devolvidos em todos os casos (persistidos na staging, ver Backend/staging.py)
+    metadados = {"layout_ocr": layout_ocr, "modelo": modelo_usado, "tempos": tempos}
+
+    # Quase-duplicado de uma nota já salva (mesma nota digitalizada de novo, PDF reexportado... ou
+    # a nota do mês seguinte do mesmo prestador): só a chave fiscal decide, lida no texto OCR
+    # (similaridade muito alta) ou extraída pelo LLM
+    duplicado = verificar_texto(indice_duplicados, texto_bruto, ignorar_hash=current_hash) if texto_bruto else None
+    if duplicado and confirmar_duplicado_no_texto(indice_duplicados, duplicado, texto_bruto):
+        print(f"    [DUPLICADOS] '{filename}' é quase idêntico à nota {duplicado[0][:7]}... (similaridade {duplicado[1]:.0%}) "
+              "e o texto OCR tem a mesma chave fiscal: é um duplicado. O LLM não é chamado.")
+        return {
+            "texto_bruto_ocr": texto_bruto,
+            "json_bruto_llm": None,
+            "resposta_llm_com_erro": f"Duplicado da nota {duplicado[0]} (similaridade {duplicado[1]:.0%}, mesma chave fiscal no texto OCR)",
+            "duplicado_de": duplicado[0], "similaridade": duplicado[1],
+            **metadados
+        }
+    if duplicado:
+        print(f"    [DUPLICADOS] '{filename}' é quase idêntico à nota {duplicado[0][:7]}... (similaridade {duplicado[1]:.0%}). A chave fiscal será comparada após o LLM.")
 
     # 2. Se a extração de texto foi bem-sucedida, envia para LLM (Ollama)
     if texto_bruto and len(texto_bruto) > 10:
 
-        # Modelo LLM para Extração JSON (mantido como Ollama)
-        modelo_usado = 'phi3:medium' # Ou seu modelo fine-tuned: 'meu_extrator_nfse:latest'
-
         print(f"    [{modelo_usado.upper()}] Enviando texto extraído (Azure) de '{filename}' para o modelo '{modelo_usado}'...")
 
+        # Prestador já conhecido (CNPJ no texto OCR encontrado no cadastro): o LLM só extrai os campos da nota
+        fornecedor = cadastro_fornecedores.procurar_no_texto(texto_bruto) if cadastro_fornecedores is not None else None
+        campos_pedidos = CAMPOS_ESPERADOS
+        instrucao_prestador = ""
+        if fornecedor:
+            # O CNPJ do prestador continua a ser pedido: confirma o encontrado no texto OCR
+            campos_pedidos = [c for c in CAMPOS_ESPERADOS if c not in CAMPOS_FORNECEDOR]
+            instrucao_prestador = ("O prestador desta nota já está cadastrado: **não extraia** os restantes dados do prestador nem a "
+                                   "categoria (esses campos não fazem parte do JSON pedido), só o CPF/CNPJ do prestador.")
+            print(f"    [FORNECEDORES] Prestador {formatar_documento(fornecedor[0])} encontrado no cadastro. Prompt reduzido a {len(campos_pedidos)} campos.")
+        formato_exemplo = _formato_json(campos_pedidos, EXEMPLO_SAIDA_LLM)
+        formato_pedido = _formato_json(campos_pedidos)
+        metadados["campos_pedidos"] = len(campos_pedidos)
+
         # ---> PROMPT REFINADO (v5) <---
         prompt_texto = f"""
         Você é um sistema especialista em extrair informações de Notas Fiscais de Serviço brasileiras (NFS-e) a partir de texto OCRizado.
@@ -253,6 +333,7 @@ def processar_documento_com_llm_local(filepath: str) -> Dict[str, Any]:
         Preencha cada campo do formato JSON abaixo com o valor correspondente encontrado no texto.
         Se um campo **não for encontrado** no texto OCR, use uma string vazia ("") como valor para esse campo no JSON.
         Preste **muita atenção** para diferenciar "PRESTADOR DE SERVIÇOS" de "TOMADOR DE SERVIÇOS". Verifique os cabeçalhos das seções.
+        {instrucao_prestador}
 
         **Instruções Específicas para Impostos e Deduções:**
         Procure ativamente por rótulos como "Valor PIS", "PIS/PASEP (R$)", "Retenção de PIS", "Valor COFINS", "COFINS (R$)", "Retenção de COFINS", "Valor CSLL", "CSLL (R$)", "Retenção de CSLL", "Valor IRRF", "IRRF (R$)", "Retenção IR", "Valor INSS", "INSS (R$)", "Retenção de INSS", "Valor das Deduções", "Deduções (R$)", "Crédito (R$)", "Valor Aprox. Tributos".
@@ -280,20 +361,7 @@ def processar_documento_com_llm_local(filepath: str) -> Dict[str, Any]:
         Valor Aprox Tributos: R$ 166,25 (11,08%) Fonte: IBPT
         ---
         Formato JSON de Saída (Exemplo):
-        {{
-            "ocr_numero": "0000555", "ocr_emissao_datahora": "15/03/2024 10:30:00", "ocr_codigo_verificacao": "ABCD-1234",
-            "ocr_prestador_nome": "MINHA EMPRESA DE SERVIÇOS LTDA", "ocr_prestador_cpf_cnpj": "11.111.111/0001-11", "ocr_prestador_inscricao_municipal": "98765",
-            "ocr_prestador_endereco": "", "ocr_prestador_municipio": "EXEMPLO", "ocr_prestador_uf": "EX",
-            "ocr_tomador_nome": "CLIENTE IMPORTANTE S/A", "ocr_tomador_cpf_cnpj": "22.222.222/0001-22", "ocr_tomador_endereco": "RUA EXEMPLO, 123",
-            "ocr_tomador_inscricao_municipal": "", "ocr_tomador_municipio": "", "ocr_tomador_uf": "", "ocr_tomador_email": "contato@cliente.com",
-            "ocr_discriminacao": "Consultoria especializada. Ref. Contrato XPTO. Suporte técnico em informática.", "ocr_codigo_servico": "01.07",
-            "ocr_valor_total": "1.500,00", "ocr_valor_base_calculo": "1.500,00", "ocr_valor_aliquota": "5,00%", "ocr_valor_iss": "75,00",
-            "ocr_valor_deducoes": "0,00", "ocr_valor_pis_pasep": "9,75", "ocr_valor_cofins": "45,00", "ocr_valor_csll": "15,00",
-            "ocr_valor_irrf": "22,50", "ocr_valor_inss": "0,00", "ocr_valor_credito": "", "ocr_valor_tributos_fonte": "166,25",
-            "ocr_valor_tributos_fonte_percentual": "11,08%", "ocr_municipio_prestacao_servico": "",
-            "ocr_intermediario_nome": "", "ocr_intermediario_cpf_cnpj": "", "ocr_outras_informacoes": "",
-            "ocr_numero_inscricao_obra": "", "alogo_visivel": "", "categoria": "Consultoria TI"
-        }}
+        {formato_exemplo}
         </EXEMPLO_DE_TAREFA>
 
         <TAREFA_REAL>
@@ -303,24 +371,12 @@ def processar_documento_com_llm_local(filepath: str) -> Dict[str, Any]:
         ---
 
         Formato JSON Obrigatório (preencha os "..."):
-        {{
-            "ocr_numero": "...", "ocr_emissao_datahora": "...", "ocr_codigo_verificacao": "...",
-            "ocr_prestador_nome": "...", "ocr_prestador_cpf_cnpj": "...", "ocr_prestador_inscricao_municipal": "...",
-            "ocr_prestador_endereco": "...", "ocr_prestador_municipio": "...", "ocr_prestador_uf": "...",
-            "ocr_tomador_nome": "...", "ocr_tomador_cpf_cnpj": "...", "ocr_tomador_endereco": "...",
-            "ocr_tomador_inscricao_municipal": "...", "ocr_tomador_municipio": "...", "ocr_tomador_uf": "...", "ocr_tomador_email": "...",
-            "ocr_discriminacao": "...", "ocr_codigo_servico": "...",
-            "ocr_valor_total": "...", "ocr_valor_base_calculo": "...", "ocr_valor_aliquota": "...", "ocr_valor_iss": "...",
-            "ocr_valor_deducoes": "...", "ocr_valor_pis_pasep": "...", "ocr_valor_cofins": "...", "ocr_valor_csll": "...",
-            "ocr_valor_irrf": "...", "ocr_valor_inss": "...", "ocr_valor_credito": "...",
-            "ocr_valor_tributos_fonte": "...", "ocr_valor_tributos_fonte_percentual": "...",
-            "ocr_municipio_prestacao_servico": "...", "ocr_intermediario_nome": "...", "ocr_intermediario_cpf_cnpj": "...",
-            "ocr_outras_informacoes": "...", "ocr_numero_inscricao_obra": "...", "alogo_visivel": "...", "categoria": "..."
-        }}
+        {formato_pedido}
         </TAREFA_REAL>
         """
         # ---> FIM DO PROMPT REFINADO <---
 
+        inicio_llm = time.monotonic()
         try:
             # Chama o Ollama para extrair o JSON do texto obtido pelo Azure
             response = ollama.chat( model=modelo_usado, messages=[{'role': 'user', 'content': prompt_texto}], options={'temperature': 0.0} )
@@ -329,12 +385,14 @@ def processar_documento_com_llm_local(filepath: str) -> Dict[str, Any]:
         except Exception as e:
              print(f"    [{modelo_usado.upper()}] Erro ao comunicar com o modelo Ollama para '{filename}': {e}")
              resposta_llm = ""
+        tempos["llm_s"] = round(time.monotonic() - inicio_llm, 3)
     else:
         print(f"    [PROCESSAMENTO] ERRO: Extração de texto (Azure OCR) falhou ou retornou texto insuficiente para '{filename}'. Impossível processar com LLM.")
         return {
             "texto_bruto_ocr": texto_bruto, # Retorna o texto (ou vazio) que veio do Azure
             "json_bruto_llm": None,
-            "resposta_llm_com_erro": "Extração de texto Azure falhou ou texto insuficiente"
+            "resposta_llm_com_erro": "Extração de texto Azure falhou ou texto insuficiente",
+            **metadados
         }
 
     # --- Processamento Final da Resposta LLM (Ollama) ---
@@ -343,7 +401,8 @@ def processar_documento_com_llm_local(filepath: str) -> Dict[str, Any]:
         return {
             "texto_bruto_ocr": texto_bruto,
             "json_bruto_llm": None,
-            "resposta_llm_com_erro": "Resposta do LLM (Ollama) foi vazia"
+            "resposta_llm_com_erro": "Resposta do LLM (Ollama) foi vazia",
+            **metadados
         }
 
     try:
@@ -383,185 +442,136 @@ def processar_documento_com_llm_local(filepath: str) -> Dict[str, Any]:
         traceback.print_exc()
         dados_extraidos = {}
 
+    # Campos do prestador a partir do cadastro (todos, se o prompt foi reduzido e o CNPJ extraído
+    # coincide com o do texto OCR; os vazios, caso contrário)
+    if dados_extraidos and cadastro_fornecedores is not None:
+        divergencia = cadastro_fornecedores.divergencia(dados_extraidos, fornecedor)
+        if divergencia:
+            print(f"    [FORNECEDORES] '{filename}': {divergencia}.")
+            metadados["divergencia_prestador"] = divergencia
+            fornecedor = None
+        dados_extraidos = cadastro_fornecedores.completar(dados_extraidos, fornecedor)
+
+    if dados_extraidos and duplicado:
+        if confirmar_duplicado(indice_duplicados, duplicado, dados_extraidos):
+            print(f"    [DUPLICADOS] '{filename}' tem a mesma chave fiscal da nota {duplicado[0][:7]}...: é um duplicado.")
+            return {
+                "texto_bruto_ocr": texto_bruto,
+                "json_bruto_llm": None,
+                "resposta_llm_com_erro": f"Duplicado da nota {duplicado[0]} (similaridade {duplicado[1]:.0%}, mesma chave fiscal)",
+                "duplicado_de": duplicado[0], "similaridade": duplicado[1],
+                **metadados
+            }
+        metadados.update({"quase_duplicado_de": duplicado[0], "similaridade": duplicado[1]})
+
     # --- Retorno para Treinamento ---
     if dados_extraidos:
         return {
             "texto_bruto_ocr": texto_bruto, # Texto do Azure
-            "json_bruto_llm": dados_extraidos # JSON do Ollama
+            "json_bruto_llm": dados_extraidos, # JSON do Ollama
+            "resposta_llm_bruta": resposta_llm,
+            **metadados
         }
     else: # Se a extração do JSON falhou
         return {
             "texto_bruto_ocr": texto_bruto, # Texto do Azure
             "json_bruto_llm": None,
-            "resposta_llm_com_erro": resposta_llm # Resposta completa do Ollama que falhou
+            "resposta_llm_com_erro": resposta_llm, # Resposta completa do Ollama que falhou
+            **metadados
         }
 
 
 # ==============================================================================
 # FUNÇÕES AUXILIARES (generate_file_hash, clean_and_format_data)
 # ==============================================================================
-def generate_file_hash(filepath: str) -> str:
-    # ... (código inalterado) ...
-    hash_md5 = hashlib.md5()
+# --- Hash de conteúdo ---
+# Todos os algoritmos suportados produzem 32 caracteres hex, pelo que cabem na
+# coluna 'hash VARCHAR(32)' existente. Para migrar (ex: HASH_ALGORITMO=blake2b),
+# os algoritmos antigos listados em HASH_ALGORITMOS_LEGADOS continuam a ser
+# calculados na mesma passagem e usados só na verificação de duplicados, até que
+# as notas antigas deixem de ser relevantes.
+HASH_ALGORITMO = os.getenv('HASH_ALGORITMO', 'md5').lower()
+HASH_ALGORITMOS_LEGADOS = [a.strip().lower() for a in os.getenv('HASH_ALGORITMOS_LEGADOS', 'md5').split(',')
+                           if a.strip() and a.strip().lower() != HASH_ALGORITMO]
+HASH_TAMANHO_LEITURA = 1024 * 1024 # Leituras de 1 MiB (em vez de 4 KB)
+
+try:
+    import xxhash
+    XXHASH_AVAILABLE = True
+except ImportError:
+    XXHASH_AVAILABLE = False
+
+
+def _novo_hasher(algoritmo: str = None):
+    """Cria o objeto de hash para o algoritmo pedido (md5, blake2b ou xxh3)."""
+    algoritmo = (algoritmo or HASH_ALGORITMO).lower()
+    if algoritmo == 'md5': return hashlib.md5()
+    if algoritmo == 'blake2b': return hashlib.blake2b(digest_size=16)
+    if algoritmo == 'xxh3':
+        if not XXHASH_AVAILABLE:
+            raise ValueError("HASH_ALGORITMO=xxh3 requer a biblioteca 'xxhash'. Instale com: pip install xxhash")
+        return xxhash.xxh3_128()
+    raise ValueError(f"Algoritmo de hash não suportado: '{algoritmo}'")
+
+
+def generate_bytes_hash(dados, algoritmo: str = None) -> str:
+    """Hash de um conteúdo já em memória (bytes, bytearray ou memoryview), sem passar pelo disco."""
+    hasher = _novo_hasher(algoritmo)
+    hasher.update(dados)
+    return hasher.hexdigest()
+
+
+def generate_hashes_compat(dados) -> Tuple[str, List[str]]:
+    """Retorna (hash principal, hashes legados) de um conteúdo em memória, para a verificação de duplicados."""
+    return generate_bytes_hash(dados), [generate_bytes_hash(dados, a) for a in HASH_ALGORITMOS_LEGADOS]
+
+
+def generate_file_hashes_compat(filepath: str) -> Tuple[str, List[str]]:
+    """Como generate_hashes_compat, mas lendo o ficheiro uma única vez em blocos grandes."""
+    hashers = [_novo_hasher()] + [_novo_hasher(a) for a in HASH_ALGORITMOS_LEGADOS]
+    buffer = bytearray(HASH_TAMANHO_LEITURA)
+    vista = memoryview(buffer)
+    with open(filepath, "rb", buffering=0) as f:
+        while True:
+            lidos = f.readinto(buffer)
+            if not lidos: break
+            for hasher in hashers: hasher.update(vista[:lidos])
+    return hashers[0].hexdigest(), [h.hexdigest() for h in hashers[1:]]
+
+
+def generate_file_hash(filepath: str, algoritmo: str = None) -> str:
+    """Hash do conteúdo de um ficheiro (algoritmo configurado em HASH_ALGORITMO por omissão)."""
+    hasher = _novo_hasher(algoritmo)
     try:
-        with open(filepath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        buffer = bytearray(HASH_TAMANHO_LEITURA)
+        vista = memoryview(buffer)
+        with open(filepath, "rb", buffering=0) as f:
+            while True:
+                lidos = f.readinto(buffer)
+                if not lidos: break
+                hasher.update(vista[:lidos])
+        return hasher.hexdigest()
     except Exception as e:
         print(f"    [HASH] Erro ao gerar hash para {filepath}: {e}")
         return None
 
-def clean_and_format_data(dados_brutos: Dict[str, Any]) -> Dict[str, Any]:
-    # ... (código inalterado da função clean_and_format_data) ...
-    print(f"    [LIMPEZA] Iniciando limpeza para dados brutos (Schema OCR)...")
-    dados_limpos = {}
-    campos_esperados = [
-        'ocr_numero', 'ocr_emissao_datahora', 'ocr_codigo_verificacao',
-        'ocr_prestador_nome', 'ocr_prestador_cpf_cnpj', 'ocr_prestador_inscricao_municipal',
-        'ocr_prestador_endereco', 'ocr_prestador_municipio', 'ocr_prestador_uf',
-        'ocr_tomador_nome', 'ocr_tomador_cpf_cnpj', 'ocr_tomador_endereco',
-        'ocr_tomador_inscricao_municipal', 'ocr_tomador_municipio', 'ocr_tomador_uf', 'ocr_tomador_email',
-        'ocr_discriminacao', 'ocr_codigo_servico',
-        'ocr_valor_total', 'ocr_valor_base_calculo', 'ocr_valor_aliquota', 'ocr_valor_iss',
-        'ocr_valor_deducoes', 'ocr_valor_pis_pasep', 'ocr_valor_cofins', 'ocr_valor_csll',
-        'ocr_valor_irrf', 'ocr_valor_inss', 'ocr_valor_credito',
-        'ocr_valor_tributos_fonte', 'ocr_valor_tributos_fonte_percentual',
-        'ocr_municipio_prestacao_servico', 'ocr_intermediario_nome', 'ocr_intermediario_cpf_cnpj',
-        'ocr_outras_informacoes', 'ocr_numero_inscricao_obra', 'alogo_visivel',
-        'categoria' # Adicionado categoria
-    ]
-    campos_monetarios = [
-        'ocr_valor_total', 'ocr_valor_base_calculo', 'ocr_valor_iss', 'ocr_valor_deducoes',
-        'ocr_valor_pis_pasep', 'ocr_valor_cofins', 'ocr_valor_csll', 'ocr_valor_irrf',
-        'ocr_valor_inss', 'ocr_valor_credito', 'ocr_valor_tributos_fonte'
-    ]
-    campos_string = [k for k in campos_esperados if k not in campos_monetarios and k not in ['ocr_valor_aliquota', 'ocr_emissao_datahora', 'ocr_valor_tributos_fonte_percentual']]
-
-    # 1. Limpeza inicial (strings)
-    for key in campos_string:
-        value = dados_brutos.get(key)
-        dados_limpos[key] = "" if value is None or str(value).strip() == "..." or str(value).strip() == "" else str(value).strip()
-
-    # 2. Limpeza de campos monetários
-    for campo in campos_monetarios:
-        valor_str = str(dados_brutos.get(campo) or '0')
-        valor_numerico_str = ''.join(c for c in valor_str if c.isdigit() or c in [',', '.'])
-        valor_numerico_str = valor_numerico_str.replace('R$', '').strip()
-        if ',' in valor_numerico_str and '.' in valor_numerico_str:
-            if valor_numerico_str.rfind('.') < valor_numerico_str.rfind(','):
-                 valor_numerico_str = valor_numerico_str.replace('.', '').replace(',', '.')
-            else:
-                 valor_numerico_str = valor_numerico_str.replace(',', '')
-        elif ',' in valor_numerico_str:
-             valor_numerico_str = valor_numerico_str.replace(',', '.')
-        elif '.' in valor_numerico_str:
-             partes = valor_numerico_str.split('.')
-             if len(partes[-1]) != 2:
-                  valor_numerico_str = valor_numerico_str.replace('.', '')
+
+def generate_file_hashes_parallel(filepaths: List[str], max_workers: int = None) -> Dict[str, Tuple[str, List[str]]]:
+    """
+    Calcula (hash principal, hashes legados) de vários ficheiros em paralelo.
+    O hashlib liberta o GIL em blocos grandes, pelo que threads chegam para usar vários núcleos/IO.
+    Ficheiros ilegíveis ficam com (None, []).
+    """
+    def _hash_seguro(filepath):
         try:
-            dados_limpos[campo] = float(valor_numerico_str) if valor_numerico_str else 0.0
-        except ValueError:
-            print(f"    [LIMPEZA WARN] Não foi possível converter valor monetário '{valor_str}' para float no campo '{campo}'. Usando 0.0.")
-            dados_limpos[campo] = 0.0
-
-    # 3. Limpeza da Alíquota
-    aliquota_str = str(dados_brutos.get('ocr_valor_aliquota') or '0')
-    aliquota_str = aliquota_str.replace('%', '').strip()
-    valor_numerico = ''.join(c for c in aliquota_str if c.isdigit() or c == ',').replace(',', '.')
-    try:
-        aliquota_float = float(valor_numerico) if valor_numerico else 0.0
-        if aliquota_float >= 1:
-            dados_limpos['ocr_valor_aliquota'] = aliquota_float / 100.0
-        else:
-            dados_limpos['ocr_valor_aliquota'] = aliquota_float
-    except ValueError:
-        print(f"    [LIMPEZA WARN] Não foi possível converter alíquota '{aliquota_str}' para float. Usando 0.0.")
-        dados_limpos['ocr_valor_aliquota'] = 0.0
-
-    # 4. Limpeza de 'ocr_valor_tributos_fonte_percentual'
-    percent_str = str(dados_brutos.get('ocr_valor_tributos_fonte_percentual') or '')
-    dados_limpos['ocr_valor_tributos_fonte_percentual'] = percent_str.replace('%', '').strip()
-
-    # 5. Limpeza da Data/Hora
-    data_str = dados_brutos.get('ocr_emissao_datahora', '') or ''
-    dados_limpos['ocr_emissao_datahora'] = None
-    data_encontrada_str = None
-    dt_obj = None
-    data_str_original = data_str
-    if isinstance(data_str, str) and data_str and data_str.strip() != "...":
-        data_str_limpa = data_str.replace("```", "").replace("json", "").strip()
-        data_str_limpa = re.sub(r'\s*\(.*\)\s*', '', data_str_limpa).strip()
-        data_str_limpa = re.sub(r'[^\d/\-:\sTZtz]', '', data_str_limpa).strip()
-        data_str_limpa = data_str_limpa.replace('.', '/').replace('-', '/')
-        data_str_limpa = data_str_limpa.replace('//', '/')
-        formatos_principais = [
-            '%d/%m/%Y %H:%M:%S', '%Y/%m/%d %H:%M:%S',
-            '%d/%m/%Y %H:%M',    '%Y/%m/%d %H:%M',
-            '%d/%m/%Y',          '%Y/%m/%d',
-            '%Y-%m-%dT%H:%M:%SZ', '%Y/%m/%dT%H:%M:%SZ',
-        ]
-        formatos_principais.extend([f.replace('/', '-') for f in formatos_principais if '/' in f])
-        for fmt in formatos_principais:
-            try:
-                str_to_parse = data_str_limpa.replace('Z', '') if 'Z' not in fmt else data_str_limpa
-                dt_obj = datetime.strptime(str_to_parse, fmt)
-                data_encontrada_str = data_str_limpa
-                break
-            except ValueError: continue
-        if dt_obj is None:
-            print(f"    [DATA DEBUG] Formatos padrão falharam para '{data_str_original}'. Tentando Regex...")
-            match_datetime = re.search(
-                r'(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})[\sT]*(\d{1,2}:\d{1,2}(:\d{1,2})?)?|'
-                r'(\d{4}[/-]\d{1,2}[/-]\d{1,2})[\sT]*(\d{1,2}:\d{1,2}(:\d{1,2})?)?Z?',
-                data_str_original
-            )
-            if match_datetime:
-                if match_datetime.group(1) and match_datetime.group(2): data_pescada, hora_pescada = match_datetime.group(1), match_datetime.group(2)
-                elif match_datetime.group(4) and match_datetime.group(5): data_pescada, hora_pescada = match_datetime.group(4), match_datetime.group(5)
-                elif match_datetime.group(1): data_pescada, hora_pescada = match_datetime.group(1), ""
-                elif match_datetime.group(4): data_pescada, hora_pescada = match_datetime.group(4), ""
-                else: data_pescada, hora_pescada = "", ""
-                if data_pescada:
-                     data_hora_pescada = f"{data_pescada.strip()} {hora_pescada.strip() if hora_pescada else ''}".strip()
-                     print(f"    [DATA DEBUG] Regex encontrou: '{data_hora_pescada}'")
-                     formatos_pesca = formatos_principais
-                     for fmt_pesca in formatos_pesca:
-                         try:
-                             str_to_parse = data_hora_pescada.replace('Z', '') if 'Z' not in fmt_pesca else data_hora_pescada
-                             if '/' in fmt_pesca and '-' in str_to_parse: str_to_parse = str_to_parse.replace('-', '/')
-                             if '-' in fmt_pesca and '/' in str_to_parse: str_to_parse = str_to_parse.replace('/', '-')
-                             dt_obj = datetime.strptime(str_to_parse, fmt_pesca)
-                             data_encontrada_str = data_hora_pescada
-                             print(f"    [DATA DEBUG] Regex parse funcionou com formato '{fmt_pesca}'")
-                             break
-                         except ValueError: continue
-            else: print(f"    [DATA DEBUG] Regex não encontrou padrão de data/hora em '{data_str_original}'.")
-    if dt_obj:
-        continha_hora = ':' in (data_encontrada_str or "")
-        if dt_obj.hour == 0 and dt_obj.minute == 0 and dt_obj.second == 0 and not continha_hora:
-             dados_limpos['ocr_emissao_datahora'] = dt_obj.strftime('%Y-%m-%d 00:00:00')
-        else:
-             try: dados_limpos['ocr_emissao_datahora'] = dt_obj.strftime('%Y-%m-%d %H:%M:%S')
-             except ValueError: dados_limpos['ocr_emissao_datahora'] = dt_obj.strftime('%Y-%m-%d 00:00:00')
-        print(f"    [DATA DEBUG] Data final formatada: {dados_limpos['ocr_emissao_datahora']}")
-    else: print(f"    [DATA FINAL] Aviso: Formato de data não reconhecido ou inválido após todas as tentativas: '{data_str_original}'")
-
-    # 6. Verificação Final
-    for campo in campos_esperados:
-        if campo not in dados_limpos:
-            if campo == 'ocr_emissao_datahora': dados_limpos[campo] = None
-            elif campo in campos_monetarios or campo == 'ocr_valor_aliquota': dados_limpos[campo] = 0.0
-            else: dados_limpos[campo] = ''
-        elif (campo in campos_monetarios or campo == 'ocr_valor_aliquota') and dados_limpos[campo] is None:
-             dados_limpos[campo] = 0.0
-
-    # Adiciona categoria se não foi extraída (pode ser calculada aqui se necessário)
-    if 'categoria' not in dados_limpos or not dados_limpos['categoria']:
-         dados_limpos['categoria'] = "" # Ou lógica para determinar a categoria
-
-    return dados_limpos
+            return generate_file_hashes_compat(filepath)
+        except Exception as e:
+            print(f"    [HASH] Erro ao gerar hash para {filepath}: {e}")
+            return None, []
 
+    max_workers = max_workers or min(8, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(filepaths, executor.map(_hash_seguro, filepaths)))
 
 # --- Funções OCR legadas (mantidas mas não chamadas) ---
 def extrair_texto_do_documento_EASYOCR_LEGACY(filepath: str) -> str:
@@ -0,0 +1,236 @@
+"""
+Staging comprimida dos resultados brutos de OCR e LLM, indexada pelo hash do ficheiro.
+
+Guarda o texto OCR, o layout (linhas + bounding boxes), a resposta bruta do LLM,
+o JSON extraído, o modelo usado e os tempos de cada etapa. Assim, revalidar,
+voltar a limpar ou exportar dados de treino passa a ser uma leitura local, sem
+correr de novo o OCR e o LLM.
+
+É também a fila de revisão do monitor de pastas: as extrações que ele não salva
+(validação reprovada, texto quase duplicado, prestador divergente) ficam aqui com
+'motivo_revisao' preenchido até alguém as validar na interface.
+"""
+import json
+import zlib
+from datetime import datetime
+from typing import Dict, Any, Iterable, List, Optional
+
+import mysql.connector
+
+from .limpeza import clean_and_format_data
+from .database import _add_column_if_not_exists
+
+# zstd é mais rápido e comprime melhor; zlib (biblioteca padrão) é o fallback
+try:
+    import zstandard
+    _ZSTD_COMPRESSOR = zstandard.ZstdCompressor(level=10)
+    _ZSTD_DECOMPRESSOR = zstandard.ZstdDecompressor()
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+CODEC_PADRAO = 'zstd' if ZSTD_AVAILABLE else 'zlib'
+
+# Colunas comprimidas (nome na tabela -> chave no resultado de processar_documento_com_llm_local)
+_CAMPOS_COMPRIMIDOS = {
+    'texto_ocr': 'texto_bruto_ocr',
+    'layout_ocr': 'layout_ocr',
+    'resposta_llm': 'resposta_llm_bruta',
+    'json_llm': 'json_bruto_llm',
+}
+
+
+# ==============================================================================
+# COMPRESSÃO
+# ==============================================================================
+def _comprimir(valor, codec: str = CODEC_PADRAO) -> Optional[bytes]:
+    """Serializa (JSON para estruturas) e comprime um valor. None permanece None."""
+    if valor is None: return None
+    texto = valor if isinstance(valor, str) else json.dumps(valor, ensure_ascii=False, default=str)
+    dados = texto.encode('utf-8')
+    if codec == 'zstd': return _ZSTD_COMPRESSOR.compress(dados)
+    return zlib.compress(dados, 6)
+
+
+def _descomprimir(dados: Optional[bytes], codec: str) -> Optional[str]:
+    if dados is None: return None
+    if codec == 'zstd':
+        if not ZSTD_AVAILABLE:
+            raise RuntimeError("Registo comprimido com zstd, mas a biblioteca 'zstandard' não está instalada.")
+        return _ZSTD_DECOMPRESSOR.decompress(bytes(dados)).decode('utf-8')
+    return zlib.decompress(bytes(dados)).decode('utf-8')
+
+
+# ==============================================================================
+# TABELA
+# ==============================================================================
+def create_staging_table_if_not_exists(conn):
+    """Cria a tabela 'extracoes_staging' se ela não existir."""
+    if not conn or not conn.is_connected():
+        print("Erro: Conexão inválida para criar tabela extracoes_staging.")
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS extracoes_staging (
+                hash VARCHAR(32) PRIMARY KEY,
+                arquivo VARCHAR(255),
+                modelo VARCHAR(100),
+                codec VARCHAR(10) NOT NULL,
+                texto_ocr MEDIUMBLOB NULL,
+                layout_ocr MEDIUMBLOB NULL,
+                resposta_llm MEDIUMBLOB NULL,
+                json_llm MEDIUMBLOB NULL,
+                erro TEXT NULL,
+                tempo_ocr_s DECIMAL(10, 3) NULL,
+                tempo_llm_s DECIMAL(10, 3) NULL,
+                criado_em DATETIME NOT NULL,
+                INDEX idx_staging_criado_em (criado_em)
+            );
+        """)
+        conn.commit()
+        print("Tabela 'extracoes_staging' verificada/atualizada com sucesso.")
+    except mysql.connector.Error as e:
+        print(f"Erro ao criar a tabela extracoes_staging: {e}")
+        raise
+
+
+def create_motivo_revisao_column_if_not_exists(conn):
+    """Acrescenta 'motivo_revisao' (fila de revisão do monitor) a 'extracoes_staging'."""
+    if not conn or not conn.is_connected():
+        print("Erro: Conexão inválida para criar a coluna motivo_revisao.")
+        return
+    cursor = conn.cursor()
+    _add_column_if_not_exists(cursor, 'extracoes_staging', 'motivo_revisao', "TEXT NULL")
+    conn.commit()
+
+
+# ==============================================================================
+# ESCRITA E LEITURA
+# ==============================================================================
+def salvar_extracao(conn, current_hash: str, filename: str, resultado: Dict[str, Any]) -> bool:
+    """Grava (ou substitui) o resultado bruto de processar_documento_com_llm_local para um hash."""
+    if not conn or not conn.is_connected() or not current_hash or not isinstance(resultado, dict):
+        return False
+    try:
+        tempos = resultado.get('tempos') or {}
+        # Em caso de falha, a resposta do LLM vem em 'resposta_llm_com_erro'
+        resposta_llm = resultado.get('resposta_llm_bruta', resultado.get('resposta_llm_com_erro'))
+        valores = {
+            'texto_ocr': _comprimir(resultado.get('texto_bruto_ocr')),
+            'layout_ocr': _comprimir(resultado.get('layout_ocr') or None),
+            'resposta_llm': _comprimir(resposta_llm),
+            'json_llm': _comprimir(resultado.get('json_bruto_llm')),
+        }
+        cursor = conn.cursor()
+        cursor.execute("""
+            REPLACE INTO extracoes_staging
+                (hash, arquivo, modelo, codec, texto_ocr, layout_ocr, resposta_llm, json_llm,
+                 erro, tempo_ocr_s, tempo_llm_s, criado_em)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (
+            current_hash, filename, resultado.get('modelo'), CODEC_PADRAO,
+            valores['texto_ocr'], valores['layout_ocr'], valores['resposta_llm'], valores['json_llm'],
+            resultado.get('resposta_llm_com_erro') if not resultado.get('json_bruto_llm') else None,
+            tempos.get('ocr_s'), tempos.get('llm_s'), datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        ))
+        conn.commit()
+        return True
+    except mysql.connector.Error as e:
+        print(f"Erro ao gravar extração em staging (hash: {current_hash}): {e}")
+        return False
+
+
+def marcar_para_revisao(conn, current_hash: str, motivo: str) -> bool:
+    """Põe uma extração já gravada na fila de revisão (um novo salvar_extracao volta a limpar o motivo)."""
+    if not conn or not conn.is_connected() or not current_hash: return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE extracoes_staging SET motivo_revisao = %s WHERE hash = %s", (motivo, current_hash))
+        conn.commit()
+        return True
+    except mysql.connector.Error as e:
+        print(f"Erro ao marcar a extração para revisão (hash: {current_hash}): {e}")
+        return False
+
+
+def _linha_para_resultado(linha: Dict[str, Any]) -> Dict[str, Any]:
+    """Converte uma linha da tabela no mesmo formato devolvido por processar_documento_com_llm_local."""
+    codec = linha['codec']
+    resultado = {
+        'hash': linha['hash'], 'filename': linha['arquivo'], 'modelo': linha['modelo'],
+        'tempos': {
+            'ocr_s': float(linha['tempo_ocr_s']) if linha['tempo_ocr_s'] is not None else None,
+            'llm_s': float(linha['tempo_llm_s']) if linha['tempo_llm_s'] is not None else None,
+        },
+        'criado_em': linha['criado_em'],
+    }
+    for coluna, chave in _CAMPOS_COMPRIMIDOS.items():
+        texto = _descomprimir(linha.get(coluna), codec)
+        if texto is not None and coluna in ('layout_ocr', 'json_llm'):
+            texto = json.loads(texto)
+        resultado[chave] = texto
+    if linha.get('erro'): resultado['resposta_llm_com_erro'] = linha['erro']
+    if linha.get('motivo_revisao'): resultado['motivo_revisao'] = linha['motivo_revisao']
+    return resultado
+
+
+def carregar_extracoes(conn, hashes: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Lê e descomprime as extrações de vários hashes. Retorna {hash: resultado}."""
+    hashes = [h for h in dict.fromkeys(hashes) if h]
+    if not conn or not conn.is_connected() or not hashes: return {}
+    try:
+        cursor = conn.cursor(dictionary=True)
+        placeholders = ', '.join(['%s'] * len(hashes))
+        cursor.execute(f"SELECT * FROM extracoes_staging WHERE hash IN ({placeholders})", tuple(hashes))
+        return {linha['hash']: _linha_para_resultado(linha) for linha in cursor.fetchall()}
+    except mysql.connector.Error as e:
+        print(f"Erro ao ler extrações da staging: {e}")
+        return {}
+
+
+def carregar_extracao(conn, current_hash: str) -> Optional[Dict[str, Any]]:
+    """Lê e descomprime a extração de um único hash (None se não existir)."""
+    return carregar_extracoes(conn, [current_hash]).get(current_hash)
+
+
+def relimpar_extracoes(conn, hashes: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Volta a aplicar clean_and_format_data ao JSON guardado, sem OCR nem LLM."""
+    return {
+        h: clean_and_format_data(resultado['json_bruto_llm'])
+        for h, resultado in carregar_extracoes(conn, hashes).items() if resultado.get('json_bruto_llm')
+    }
+
+
+# ==============================================================================
+# FILA DE REVISÃO (extrações do monitor ainda não salvas em notas_fiscais)
+# ==============================================================================
+_SEM_NOTA_SALVA = ("NOT EXISTS (SELECT 1 FROM notas_fiscais n WHERE n.hash = s.hash) "
+                   "AND NOT EXISTS (SELECT 1 FROM notas_fiscais_arquivo a WHERE a.hash = s.hash)")
+
+
+def hashes_em_revisao(conn, hashes: Iterable[str]) -> set:
+    """Subconjunto dos hashes que estão na fila de revisão. Os erros do MySQL propagam-se."""
+    hashes = [h for h in dict.fromkeys(hashes) if h]
+    if not hashes: return set()
+    cursor = conn.cursor()
+    placeholders = ', '.join(['%s'] * len(hashes))
+    cursor.execute(f"SELECT s.hash FROM extracoes_staging s WHERE s.hash IN ({placeholders}) "
+                   f"AND s.motivo_revisao IS NOT NULL AND {_SEM_NOTA_SALVA}", tuple(hashes))
+    return {linha[0] for linha in cursor.fetchall()}
+
+
+def extracoes_pendentes(conn, limite: int = 200) -> List[Dict[str, Any]]:
+    """Extrações da fila de revisão (mais antigas primeiro), no formato de carregar_extracoes."""
+    if not conn or not conn.is_connected(): return []
+    try:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(f"""
+            SELECT s.* FROM extracoes_staging s
+            WHERE s.motivo_revisao IS NOT NULL AND s.json_llm IS NOT NULL AND {_SEM_NOTA_SALVA}
+            ORDER BY s.criado_em LIMIT %s
+        """, (limite,))
+        return [_linha_para_resultado(linha) for linha in cursor.fetchall()]
+    except mysql.connector.Error as e:
+        print(f"Erro ao ler a fila de revisão da staging: {e}")
+        return []
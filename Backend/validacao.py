@@ -0,0 +1,131 @@
+"""
+Validação cruzada dos campos de uma nota já limpa (Backend/limpeza.py), para aprovar
+automaticamente as notas sem problemas e deixar para revisão manual só as restantes.
+
+Cada verificação tem um peso e, se falhar, deixa um sinal no campo correspondente:
+  * dígitos verificadores do CPF/CNPJ do prestador (obrigatório), do tomador e do intermediário;
+  * ISS ≈ base de cálculo × alíquota (tolerância TOLERANCIA_ISS; sem base, usa total - deduções);
+  * valor total > 0 e maior ou igual à soma das retenções;
+  * data de emissão reconhecida e não futura;
+  * UF do prestador (obrigatória) e do tomador na lista de unidades federativas.
+
+A pontuação é a fração (ponderada) das verificações que passaram. As notas com pontuação
+maior ou igual a LIMIAR_APROVACAO (VALIDACAO_LIMIAR_APROVACAO; 1.0 por omissão, ou seja, sem
+nenhum sinal) são salvas diretamente; um limiar acima de 1 desliga a aprovação automática.
+"""
+import os
+import re
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Any, List
+
+from .valores import interpretar_valor, interpretar_percentual, ZERO
+
+LIMIAR_APROVACAO = float(os.getenv('VALIDACAO_LIMIAR_APROVACAO', '1.0'))
+TOLERANCIA_ISS = Decimal(os.getenv('VALIDACAO_TOLERANCIA_ISS', '0.05')) # Reais (arredondamentos municipais)
+
+UFS = frozenset([
+    'AC', 'AL', 'AP', 'AM', 'BA', 'CE', 'DF', 'ES', 'GO', 'MA', 'MT', 'MS', 'MG', 'PA',
+    'PB', 'PR', 'PE', 'PI', 'RJ', 'RN', 'RS', 'RO', 'RR', 'SC', 'SP', 'SE', 'TO',
+])
+CAMPOS_RETENCOES = ['ocr_valor_inss', 'ocr_valor_pis_pasep', 'ocr_valor_cofins', 'ocr_valor_csll', 'ocr_valor_irrf']
+PESOS = {
+    'ocr_prestador_cpf_cnpj': 3, 'ocr_tomador_cpf_cnpj': 2, 'ocr_intermediario_cpf_cnpj': 1,
+    'ocr_valor_iss': 2, 'ocr_valor_total': 3, 'ocr_emissao_datahora': 2,
+    'ocr_prestador_uf': 1, 'ocr_tomador_uf': 1,
+}
+
+_RE_NAO_DIGITO = re.compile(r'\D+')
+_PESOS_CNPJ = (6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)
+
+
+# ==============================================================================
+# DOCUMENTOS (CPF / CNPJ)
+# ==============================================================================
+def _digito_verificador(digitos: List[int], pesos) -> int:
+    resto = sum(d * p for d, p in zip(digitos, pesos)) % 11
+    return 0 if resto < 2 else 11 - resto
+
+
+def cpf_valido(cpf: str) -> bool:
+    digitos = [int(c) for c in _RE_NAO_DIGITO.sub('', cpf or '')]
+    if len(digitos) != 11 or len(set(digitos)) == 1: return False
+    return (_digito_verificador(digitos[:9], range(10, 1, -1)) == digitos[9]
+            and _digito_verificador(digitos[:10], range(11, 1, -1)) == digitos[10])
+
+
+def cnpj_valido(cnpj: str) -> bool:
+    digitos = [int(c) for c in _RE_NAO_DIGITO.sub('', cnpj or '')]
+    if len(digitos) != 14 or len(set(digitos)) == 1: return False
+    return (_digito_verificador(digitos[:12], _PESOS_CNPJ[1:]) == digitos[12]
+            and _digito_verificador(digitos[:13], _PESOS_CNPJ) == digitos[13])
+
+
+def documento_valido(documento: str) -> bool:
+    """CPF (11 dígitos) ou CNPJ (14 dígitos) com os dígitos verificadores corretos; a pontuação é ignorada."""
+    numero = _RE_NAO_DIGITO.sub('', documento or '')
+    if len(numero) == 11: return cpf_valido(numero)
+    if len(numero) == 14: return cnpj_valido(numero)
+    return False
+
+
+# ==============================================================================
+# VALIDAÇÃO DE UMA NOTA
+# ==============================================================================
+def _sinais(dados: Dict[str, Any], agora: datetime) -> Dict[str, str]:
+    sinais = {}
+    for campo, obrigatorio in [('ocr_prestador_cpf_cnpj', True), ('ocr_tomador_cpf_cnpj', False),
+                               ('ocr_intermediario_cpf_cnpj', False)]:
+        documento = str(dados.get(campo) or '').strip()
+        if not documento:
+            if obrigatorio: sinais[campo] = "CPF/CNPJ em falta"
+        elif not documento_valido(documento):
+            sinais[campo] = "CPF/CNPJ com dígitos verificadores inválidos"
+
+    total = interpretar_valor(dados.get('ocr_valor_total'))
+    iss = interpretar_valor(dados.get('ocr_valor_iss'))
+    aliquota = interpretar_percentual(dados.get('ocr_valor_aliquota'))
+    base = interpretar_valor(dados.get('ocr_valor_base_calculo'))
+    if base == ZERO: base = total - interpretar_valor(dados.get('ocr_valor_deducoes'))
+    if (iss != ZERO or aliquota != ZERO) and abs(base * aliquota - iss) > TOLERANCIA_ISS:
+        sinais['ocr_valor_iss'] = f"ISS ({iss}) diferente de base × alíquota ({base * aliquota:.2f})"
+
+    retencoes = sum((interpretar_valor(dados.get(c)) for c in CAMPOS_RETENCOES), ZERO)
+    if total <= ZERO: sinais['ocr_valor_total'] = "Valor total em falta"
+    elif total < retencoes: sinais['ocr_valor_total'] = f"Valor total menor do que as retenções ({retencoes})"
+
+    emissao = dados.get('ocr_emissao_datahora')
+    if not emissao:
+        sinais['ocr_emissao_datahora'] = "Data de emissão não reconhecida"
+    else:
+        try:
+            if datetime.strptime(str(emissao), '%Y-%m-%d %H:%M:%S') > agora + timedelta(days=1):
+                sinais['ocr_emissao_datahora'] = "Data de emissão no futuro"
+        except ValueError:
+            sinais['ocr_emissao_datahora'] = "Data de emissão não reconhecida"
+
+    for campo, obrigatorio in [('ocr_prestador_uf', True), ('ocr_tomador_uf', False)]:
+        uf = str(dados.get(campo) or '').strip().upper()
+        if (uf or obrigatorio) and uf not in UFS: sinais[campo] = "UF inválida" if uf else "UF em falta"
+    return sinais
+
+
+def validar_nota(dados_limpos: Dict[str, Any], agora: datetime = None) -> Dict[str, Any]:
+    """
+    Valida uma nota limpa. Retorna {'pontuacao': float entre 0 e 1, 'sinais': {campo: motivo},
+    'aprovada': pontuacao >= LIMIAR_APROVACAO}.
+    """
+    sinais = _sinais(dados_limpos, agora or datetime.now())
+    pontuacao = 1 - sum(PESOS[c] for c in sinais) / sum(PESOS.values())
+    return {'pontuacao': pontuacao, 'sinais': sinais, 'aprovada': pontuacao >= LIMIAR_APROVACAO}
+
+
+def validar_notas(lista_dados_limpos: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Versão em lote de validar_nota (mesmo instante de referência para todo o lote)."""
+    agora = datetime.now()
+    return [validar_nota(dados, agora) for dados in lista_dados_limpos]
+
+
+def descrever_sinais(sinais: Dict[str, str]) -> str:
+    """Texto curto para a coluna de pendências do editor ('campo: motivo; ...')."""
+    return "; ".join(f"{campo.replace('ocr_', '')}: {motivo}" for campo, motivo in sinais.items())
@@ -0,0 +1,104 @@
+"""
+Interpretação exata de valores monetários e percentuais extraídos (texto livre) para Decimal.
+
+Os valores vão diretamente para as colunas DECIMAL(15,2) (e a alíquota para DECIMAL(7,4)) sem
+passar por float, por isso os totais somados no Python ou no MySQL batem ao centavo.
+
+Regras de separadores (pt-BR e en):
+  * com '.' e ',' no mesmo valor, o último é o separador decimal e o outro o de milhares
+    ('1.234,56' e '1,234.56' -> 1234.56);
+  * com um só tipo de separador, é de milhares se aparecer mais de uma vez ('1.234.567');
+  * um separador único seguido de exatamente 3 dígitos é de milhares ('1,234', '1.234' -> inteiros),
+    exceto se a parte inteira for 0 ('0,015') ou num percentual ('2,015%', '0.025'), onde é decimal;
+    nos outros casos é decimal ('1234,5', '12.50' -> 1234.50, 12.50);
+  * o resto do texto ('R$', espaços, '%') é ignorado. Texto sem número, None e NaN valem 0.
+
+Os arredondamentos são ROUND_HALF_UP (como o MySQL ao gravar em DECIMAL).
+
+A conversão para float só acontece à saída, para mostrar: nas grelhas (tipar_dataframe em
+Backend/database.py), nos gráficos do dashboard e no snapshot Parquet. Os totais vêm de
+agregar_notas (SUM no MySQL) e dos rollups, lidos como Decimal.
+"""
+import re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from numbers import Integral
+from typing import Any, Iterable, List
+
+CASAS_VALOR = Decimal('0.01') # DECIMAL(15, 2)
+CASAS_ALIQUOTA = Decimal('0.0001') # DECIMAL(7, 4)
+ZERO = Decimal('0')
+
+_RE_NAO_NUMERICO = re.compile(r'[^\d,.]')
+
+
+def _normalizar_separadores(texto: str, percentual: bool = False) -> str:
+    """Texto só com dígitos e, no máximo, um '.' decimal ('' se não houver número válido)."""
+    texto = _RE_NAO_NUMERICO.sub('', texto)
+    virgula, ponto = texto.rfind(','), texto.rfind('.')
+    if virgula >= 0 and ponto >= 0:
+        decimal, milhares = (',', '.') if virgula > ponto else ('.', ',')
+        texto = texto.replace(milhares, '')
+        if texto.count(decimal) > 1: return ''
+        return texto.replace(decimal, '.')
+    separador = ',' if virgula >= 0 else '.' if ponto >= 0 else None
+    if separador is None: return texto
+    partes = texto.split(separador)
+    if len(partes) > 2: return texto.replace(separador, '')
+    milhares = len(partes[1]) == 3 and not percentual and partes[0].lstrip('0') != ''
+    return texto.replace(separador, '' if milhares else '.')
+
+
+def interpretar_numero(valor: Any, percentual: bool = False) -> Decimal:
+    """
+    Decimal (sem arredondar) de um número ou texto em formato pt-BR/en; 0 se não houver número.
+    Com 'percentual', um separador único é sempre decimal ('2,015' -> 2.015).
+    """
+    if valor is None or isinstance(valor, bool): return ZERO
+    if isinstance(valor, Decimal): numero = valor
+    elif isinstance(valor, Integral): return Decimal(int(valor)) # int e inteiros numpy (colunas int64)
+    elif isinstance(valor, float): numero = Decimal(str(valor)) # O decimal mais curto que dá o mesmo float (também np.float64)
+    else:
+        texto = _normalizar_separadores(str(valor), percentual)
+        if texto in ('', '.'): return ZERO
+        try:
+            numero = Decimal(texto)
+        except InvalidOperation:
+            return ZERO
+    return numero if numero.is_finite() else ZERO
+
+
+def _arredondar(numero: Decimal, casas: Decimal) -> Decimal:
+    try:
+        return numero.quantize(casas, rounding=ROUND_HALF_UP)
+    except InvalidOperation: # Mais dígitos do que a precisão do contexto: não cabe na coluna de qualquer forma
+        return ZERO.quantize(casas)
+
+
+def interpretar_valor(valor: Any) -> Decimal:
+    """Valor monetário com 2 casas decimais ('R$ 1.234,56' -> Decimal('1234.56'))."""
+    return _arredondar(interpretar_numero(valor), CASAS_VALOR)
+
+
+def interpretar_percentual(valor: Any) -> Decimal:
+    """
+    Alíquota como fração com 4 casas decimais. Valores >= 1 são lidos como percentagem
+    ('5%', '5' e '0,05' -> Decimal('0.0500')).
+    """
+    numero = interpretar_numero(valor, percentual=True)
+    if numero >= 1: numero = numero / 100
+    return _arredondar(numero, CASAS_ALIQUOTA)
+
+
+def interpretar_valores(valores: Iterable[Any], percentual: bool = False) -> List[Decimal]:
+    """Versão em lote: cada texto distinto é interpretado uma só vez (zeros e vazios repetem-se muito)."""
+    funcao = interpretar_percentual if percentual else interpretar_valor
+    memoria = {}
+    resultado = []
+    for valor in valores:
+        if isinstance(valor, str):
+            numero = memoria.get(valor)
+            if numero is None: numero = memoria[valor] = funcao(valor)
+        else:
+            numero = funcao(valor)
+        resultado.append(numero)
+    return resultado
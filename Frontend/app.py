@@ -2,6 +2,7 @@ import streamlit as st
 import os
 import pandas as pd
 from datetime import datetime
+from decimal import Decimal
 import tempfile
 import io
 import plotly.express as px
@@ -17,29 +18,37 @@ DIRETORIO_RAIZ = os.path.abspath(os.path.join(DIRETORIO_ATUAL, '..'))
 if DIRETORIO_RAIZ not in sys.path:
     sys.path.append(DIRETORIO_RAIZ)
 
-# Adicionado para depuração - Verifique o output no seu terminal
-print("--- Debug sys.path ---")
-print("Diretório Atual (app.py):", DIRETORIO_ATUAL)
-print("Diretório Raiz (calculado):", DIRETORIO_RAIZ)
-print("sys.path:", sys.path)
-print("--- Fim Debug sys.path ---")
-
-
 # Certifique-se que o nome do arquivo no Backend é 'processador.py'
 try:
     # Esta linha assume que o ficheiro se chama 'processador.py' dentro da pasta 'Backend'
     # e que existe um ficheiro '__init__.py' na pasta 'Backend'.
-    from Backend.processador import processar_documento_com_llm_local, generate_file_hash, clean_and_format_data
+    from Backend.processador import (processar_documento_com_llm_local, clean_and_format_dataframe,
+                                     generate_hashes_compat, generate_file_hashes_parallel)
 except ImportError as e:
     st.error(f"Erro ao importar 'Backend.processador': {e}. Verifique o nome do arquivo ('processador.py'), se ele existe em 'Backend/', e se 'Backend/__init__.py' existe.")
     st.stop()
 
 from Backend.database import (
-    create_connection, create_notas_fiscais_table_if_not_exists, create_users_table_if_not_exists, get_all_hashes,
-    insert_record, fetch_all_data_as_dataframe, search_data_as_dataframe,
+    conexao_emprestada,
+    insert_records_bulk,
+    consultar_notas_paginado, agregar_notas, fetch_rollup_mensal_as_dataframe,
     add_user, delete_user, get_all_usernames, update_user_password, set_password_change_flag,
-    fetch_all_users_for_admin_view, fetch_all_users
+    fetch_all_users_for_admin_view, fetch_all_users, obter_metricas_pool, obter_metricas_cache
+)
+from Backend.migracoes import aplicar_migracoes
+from Backend.staging import salvar_extracao, extracoes_pendentes
+from Backend.exportacao_treino import exportar_jsonl, ler_marca, gravar_marca
+from Backend.deduplicacao import hashes_existentes
+from Backend.valores import interpretar_valor
+from Backend.esquema import HEADERS_DB, CAMPOS_CONTROLO, CAMPOS_ESPERADOS, registos_de_dataframe
+from Backend.validacao import validar_notas, descrever_sinais
+from Backend.exportacao import exportar_notas, FORMATOS as FORMATOS_EXPORTACAO
+from Backend.analitica import (
+    ANALITICA_DISPONIVEL, DIMENSOES_ANALISE, atualizar_snapshot, resumo_por_dimensao,
+    ler_marca as ler_marca_snapshot
 )
+from Backend.duplicados import obter_indice, registar_notas, chave_fiscal
+from Backend.fornecedores import obter_cadastro, registar_fornecedores
 # Assumindo que user_management.py também está em Backend/
 try:
     from Backend.user_management import initialize_authenticator, is_admin, check_force_password_change
@@ -105,24 +114,29 @@ st.markdown("""
 # ==============================================================================
 st.set_page_config(layout="wide", page_title="Extrator de Dados de NFS-e")
 
-# @st.cache_resource # Cache da conexão pode causar problemas se a conexão expirar
-def get_db_connection():
-    return create_connection()
+# As sessões não guardam conexões: cada operação empresta uma do pool com conexao_emprestada()
+# e devolve-a no fim, por isso o pool limita as operações em curso e não o número de sessões.
 
-conn = get_db_connection() # Usa a função para obter a conexão
-
-if conn:
-    create_notas_fiscais_table_if_not_exists(conn)
-    create_users_table_if_not_exists(conn)
-else:
-    st.error("Falha fatal ao conectar à base de dados MySQL. Verifique as credenciais no .env e se o serviço está em execução.")
-    st.stop()
+@st.cache_resource
+def preparar_schema():
+    """Aplica as migrações pendentes uma única vez por processo (não a cada rerun)."""
+    return aplicar_migracoes()
 
 # @st.cache_resource # Cache do authenticator pode ser problemático com alterações de senha
 def init_auth(_conn):
      return initialize_authenticator(_conn)
 
-authenticator = init_auth(conn) # Usa a função para inicializar
+with conexao_emprestada() as conn:
+    if conn:
+        if not preparar_schema():
+            preparar_schema.clear() # Volta a tentar no próximo rerun
+            st.error("Falha ao aplicar as migrações do schema da base de dados. Verifique os logs do terminal.")
+            st.stop()
+    else:
+        st.error("Falha fatal ao conectar à base de dados MySQL. Verifique as credenciais no .env e se o serviço está em execução.")
+        st.stop()
+
+    authenticator = init_auth(conn) # Usa a função para inicializar
 
 if authenticator is None:
     st.error("Erro ao carregar o sistema de autenticação.")
@@ -135,7 +149,9 @@ authenticator.login()
 # ==============================================================================
 if st.session_state["authentication_status"]:
 
-    if check_force_password_change(conn, st.session_state["username"]):
+    with conexao_emprestada() as conn:
+        forcar_alteracao = check_force_password_change(conn, st.session_state["username"])
+    if forcar_alteracao:
         st.warning("Este é o seu primeiro login ou a sua palavra-passe foi redefinida. Por segurança, por favor, crie uma nova palavra-passe.")
         with st.form("change_password_form"):
             st.subheader("Alterar a sua Palavra-passe")
@@ -147,8 +163,10 @@ if st.session_state["authentication_status"]:
                     password_bytes = new_password.encode('utf-8')
                     salt = bcrypt.gensalt()
                     hashed_password = bcrypt.hashpw(password_bytes, salt).decode('utf-8')
-                    if update_user_password(conn, st.session_state["username"], hashed_password):
-                        set_password_change_flag(conn, st.session_state["username"], False)
+                    with conexao_emprestada() as conn:
+                        alterada = update_user_password(conn, st.session_state["username"], hashed_password)
+                        if alterada: set_password_change_flag(conn, st.session_state["username"], False)
+                    if alterada:
                         st.success("Palavra-passe alterada com sucesso! A página será recarregada.")
                         st.rerun()
                     else: st.error("Ocorreu um erro ao alterar a sua palavra-passe.")
@@ -169,7 +187,8 @@ if st.session_state["authentication_status"]:
                     confirm_password = st.text_input("Confirme a Nova Palavra-passe", type="password")
                     submitted_change = st.form_submit_button("Confirmar Alteração")
                     if submitted_change:
-                        current_credentials = fetch_all_users(conn)
+                        with conexao_emprestada() as conn:
+                            current_credentials = fetch_all_users(conn)
                         if current_credentials and current_credentials.get("usernames"):
                             password_correct = False
                             try:
@@ -195,7 +214,9 @@ if st.session_state["authentication_status"]:
                                     # password_bytes = new_password.encode('utf-8')
                                     # salt = bcrypt.gensalt()
                                     # hashed_password = bcrypt.hashpw(password_bytes, salt).decode('utf-8')
-                                    if update_user_password(conn, st.session_state["username"], hashed_password):
+                                    with conexao_emprestada() as conn:
+                                        alterada = update_user_password(conn, st.session_state["username"], hashed_password)
+                                    if alterada:
                                         st.success("Palavra-passe alterada com sucesso!")
                                         st.session_state['show_change_password_form'] = False
                                         st.session_state['authentication_status'] = None # Força novo login
@@ -207,50 +228,20 @@ if st.session_state["authentication_status"]:
                         else:
                              st.error("Não foi possível verificar a palavra-passe atual. Tente novamente mais tarde.")
 
-        # --- Definição dos Cabeçalhos para DataFrame e DB ---
-        HEADERS_OCR = [
-            'ocr_numero', 'ocr_emissao_datahora', 'ocr_codigo_verificacao',
-            'ocr_prestador_nome', 'ocr_prestador_cpf_cnpj', 'ocr_prestador_inscricao_municipal',
-            'ocr_prestador_endereco', 'ocr_prestador_municipio', 'ocr_prestador_uf',
-            'ocr_tomador_nome', 'ocr_tomador_cpf_cnpj', 'ocr_tomador_endereco',
-            'ocr_tomador_inscricao_municipal', 'ocr_tomador_municipio', 'ocr_tomador_uf', 'ocr_tomador_email',
-            'ocr_discriminacao', 'ocr_codigo_servico',
-            'ocr_valor_total', 'ocr_valor_base_calculo', 'ocr_valor_aliquota', 'ocr_valor_iss',
-            'ocr_valor_deducoes', 'ocr_valor_pis_pasep', 'ocr_valor_cofins', 'ocr_valor_csll',
-            'ocr_valor_irrf', 'ocr_valor_inss', 'ocr_valor_credito',
-            'ocr_valor_tributos_fonte', 'ocr_valor_tributos_fonte_percentual',
-            'ocr_municipio_prestacao_servico', 'ocr_intermediario_nome', 'ocr_intermediario_cpf_cnpj',
-            'ocr_outras_informacoes', 'ocr_numero_inscricao_obra', 'alogo_visivel',
-            'categoria' # Adicionado categoria se for esperado do OCR/LLM
-        ]
-        HEADERS_DB = [
-            'hash', 'arquivo', 'data_processamento',
-            'ocr_numero', 'ocr_emissao_datahora', 'ocr_codigo_verificacao',
-            'ocr_prestador_nome', 'ocr_prestador_cpf_cnpj', 'ocr_prestador_inscricao_municipal',
-            'ocr_prestador_endereco', 'ocr_prestador_municipio', 'ocr_prestador_uf',
-            'ocr_tomador_nome', 'ocr_tomador_cpf_cnpj', 'ocr_tomador_endereco',
-            'ocr_tomador_inscricao_municipal', 'ocr_tomador_municipio', 'ocr_tomador_uf', 'ocr_tomador_email',
-            'ocr_discriminacao', 'ocr_codigo_servico',
-            'ocr_valor_total', 'ocr_valor_base_calculo', 'ocr_valor_aliquota', 'ocr_valor_iss',
-            'ocr_valor_deducoes', 'ocr_valor_pis_pasep', 'ocr_valor_cofins', 'ocr_valor_csll',
-            'ocr_valor_irrf', 'ocr_valor_inss', 'ocr_valor_credito',
-            'ocr_valor_tributos_fonte', 'ocr_valor_tributos_fonte_percentual',
-            'ocr_municipio_prestacao_servico', 'ocr_intermediario_nome', 'ocr_intermediario_cpf_cnpj',
-            'ocr_outras_informacoes', 'ocr_numero_inscricao_obra', 'alogo_visivel',
-            'categoria' # Adicionado categoria se for esperado do OCR/LLM ou calculado
-        ]
+        # Cabeçalhos (HEADERS_DB, CAMPOS_ESPERADOS) vêm do registo do schema: Backend/esquema.py
 
         # --- Funções de Processamento e Finalização ---
-        def iniciar_processamento(conn, lista_de_arquivos, modo_pasta=False):
-            # Obtém conexão fresca para esta operação
-            current_conn = get_db_connection()
-            if not current_conn:
-                st.error("Não foi possível obter conexão com a base de dados para processamento.")
-                return
-
-            existing_hashes = get_all_hashes(current_conn) # Passa a conexão
+        def iniciar_processamento(lista_de_arquivos, modo_pasta=False):
+            # Uma conexão do pool por etapa com base de dados: nenhuma fica presa durante o OCR/LLM
+            with conexao_emprestada() as conn:
+                if not conn:
+                    st.error("Não foi possível obter conexão com a base de dados para processamento.")
+                    return
+                indice_duplicados = obter_indice(conn) # MinHash/LSH sobre o texto OCR das notas salvas
+                cadastro_fornecedores = obter_cadastro(conn) # Prestadores já conhecidos (menos campos pedidos ao LLM)
             dados_para_validacao = [] # Lista para guardar os JSONs brutos extraídos
             dados_brutos_completos = [] # Lista para guardar os dicionários completos (texto+json)
+            revisao_obrigatoria = {} # hash -> motivo (mesma chave fiscal, texto quase igual ao de uma nota já salva, prestador divergente): nunca aprovadas automaticamente
             status_bar = st.progress(0, text="Aguardando início...")
 
             # Limpa dados anteriores antes de processar novos
@@ -258,40 +249,67 @@ if st.session_state["authentication_status"]:
             st.session_state['erros_processamento'] = [] # Lista para guardar todos os erros
             st.session_state['dados_brutos_completos_para_treino'] = None # Limpa dados de treino também
 
+            # Hashes de todo o lote calculados antes do loop (pastas em paralelo, uploads em memória),
+            # seguidos de uma única consulta em blocos só para estes candidatos
+            if modo_pasta:
+                hashes_por_pasta = generate_file_hashes_parallel(lista_de_arquivos)
+                hashes_lote = [hashes_por_pasta[arquivo] for arquivo in lista_de_arquivos]
+            else:
+                hashes_lote = [generate_hashes_compat(memoryview(arquivo.getvalue())) for arquivo in lista_de_arquivos]
+            with conexao_emprestada() as conn:
+                existing_hashes = hashes_existentes(conn, [h for principal, legados in hashes_lote for h in [principal, *legados]])
+
             for i, arquivo in enumerate(lista_de_arquivos):
                 progresso_atual = (i + 1) / len(lista_de_arquivos)
                 filepath = None # Inicializa filepath
                 filename = "N/A" # Inicializa filename
                 current_hash = None # Inicializa hash
                 try:
+                    current_hash, hashes_legados = hashes_lote[i]
                     if modo_pasta:
                         filepath, filename = arquivo, os.path.basename(arquivo)
                     else:
                         filename = arquivo.name
+
+                    status_bar.progress(progresso_atual, text=f"Analisando: '{filename}' ({i+1}/{len(lista_de_arquivos)})")
+
+                    # Verifica hash apenas se for válido (inclui hashes legados durante a migração de algoritmo)
+                    if current_hash and (current_hash in existing_hashes or any(h in existing_hashes for h in hashes_legados)):
+                        st.warning(f"O ficheiro '{filename}' (hash: {current_hash[:7]}...) já foi processado e será ignorado.")
+                        continue
+                    elif not current_hash:
+                        st.error(f"Não foi possível gerar o hash para '{filename}'. Ficheiro ignorado.")
+                        continue
+
+                    # Só os ficheiros novos são escritos em disco para o OCR
+                    if not modo_pasta:
                         with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as tmp_file:
                             tmp_file.write(arquivo.getvalue())
                             filepath = tmp_file.name
 
-                    status_bar.progress(progresso_atual, text=f"Analisando: '{filename}' ({i+1}/{len(lista_de_arquivos)})")
-
                     if filepath:
-                        current_hash = generate_file_hash(filepath)
-                        # Verifica hash apenas se for válido
-                        if current_hash and current_hash in existing_hashes:
-                            st.warning(f"O ficheiro '{filename}' (hash: {current_hash[:7]}...) já foi processado e será ignorado.")
-                            continue
-                        elif not current_hash:
-                            st.error(f"Não foi possível gerar o hash para '{filename}'. Ficheiro ignorado.")
-                            continue
-
                         # Chama a função que retorna {"texto_bruto_ocr": ..., "json_bruto_llm": ...}
-                        dados_para_treino = processar_documento_com_llm_local(filepath)
+                        dados_para_treino = processar_documento_com_llm_local(filepath, indice_duplicados, current_hash, cadastro_fornecedores)
+
+                        if isinstance(dados_para_treino, dict) and dados_para_treino.get("duplicado_de"):
+                            st.warning(f"O ficheiro '{filename}' é quase idêntico a uma nota já salva com a mesma chave fiscal "
+                                       f"(hash: {dados_para_treino['duplicado_de'][:7]}..., similaridade {dados_para_treino['similaridade']:.0%}) e será ignorado.")
+                            continue
+                        if isinstance(dados_para_treino, dict) and dados_para_treino.get("quase_duplicado_de"):
+                            revisao_obrigatoria[current_hash] = (f"texto quase igual ao da nota {dados_para_treino['quase_duplicado_de'][:7]}... "
+                                                                 f"(similaridade {dados_para_treino['similaridade']:.0%}), com outra chave fiscal")
+                        if isinstance(dados_para_treino, dict) and dados_para_treino.get("divergencia_prestador"):
+                            revisao_obrigatoria[current_hash] = "; ".join(filter(None, [revisao_obrigatoria.get(current_hash),
+                                                                                      dados_para_treino["divergencia_prestador"]]))
 
                         # Guarda sempre o resultado completo (mesmo com erro) para treino/debug
                         if isinstance(dados_para_treino, dict):
                              dados_brutos_completos.append({
                                  "filename": filename, "hash": current_hash, **dados_para_treino
                              })
+                             # Persiste OCR/LLM brutos para revalidação e treino sem reprocessar
+                             with conexao_emprestada() as conn:
+                                 salvar_extracao(conn, current_hash, filename, dados_para_treino)
                         else:
                              st.error(f"Resultado inesperado do processamento para '{filename}'. Tipo: {type(dados_para_treino)}")
                              dados_brutos_completos.append({
@@ -304,6 +322,11 @@ if st.session_state["authentication_status"]:
                         # Se a extração do JSON foi bem-sucedida, prepara para o editor
                         if dados_para_treino.get("json_bruto_llm"):
                             dados_extraidos_raw = dados_para_treino["json_bruto_llm"]
+                            hash_mesma_chave = indice_duplicados.procurar_chave(chave_fiscal(dados_extraidos_raw), ignorar_hash=current_hash)
+                            if hash_mesma_chave:
+                                revisao_obrigatoria[current_hash] = "; ".join(filter(None, [revisao_obrigatoria.get(current_hash),
+                                                                                          "mesma chave fiscal de uma nota já salva"]))
+                                st.warning(f"Atenção: '{filename}' tem o mesmo CNPJ, número e código de verificação de uma nota já salva (hash: {hash_mesma_chave[:7]}...). Verifique antes de salvar.")
                             dados_extraidos_raw['hash'] = current_hash
                             dados_extraidos_raw['arquivo'] = filename
                             dados_extraidos_raw['data_processamento'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -344,20 +367,47 @@ if st.session_state["authentication_status"]:
                         except Exception as e: st.warning(f"Não foi possível remover o ficheiro temporário {filepath}: {e}")
 
             status_bar.empty()
-            # Fecha a conexão obtida no início da função
-            if current_conn and current_conn.is_connected():
-                current_conn.close()
-                print("Conexão (iniciar_processamento) fechada.")
-
 
             # Processa os resultados após o loop
             if dados_para_validacao: # Se pelo menos um JSON foi extraído com sucesso
-                st.success("Extração concluída! Valide os dados brutos extraídos abaixo.")
                 df_para_editor = pd.DataFrame(dados_para_validacao)
-                cols_para_editor = ['hash', 'arquivo', 'data_processamento'] + HEADERS_OCR
+                cols_para_editor = CAMPOS_CONTROLO + ['pendencias'] + CAMPOS_ESPERADOS
                 for col in cols_para_editor:
                    if col not in df_para_editor.columns: df_para_editor[col] = ""
-                st.session_state['dados_processados_para_editor'] = df_para_editor[cols_para_editor]
+                df_para_editor = df_para_editor[cols_para_editor]
+
+                # Validação cruzada: as notas sem pendências são salvas já, sem passar pelo editor
+                try:
+                    df_limpo = clean_and_format_dataframe(df_para_editor)
+                    validacoes = validar_notas(df_limpo.to_dict('records'))
+                except Exception as e:
+                    st.warning(f"Não foi possível validar automaticamente o lote; todas as notas seguem para revisão: {e}")
+                    traceback.print_exc()
+                    validacoes = [None] * len(df_para_editor)
+                aprovadas = []
+                for index, validacao in zip(df_para_editor.index, validacoes):
+                    if validacao is None: continue
+                    pendencias = descrever_sinais(validacao['sinais'])
+                    motivo_revisao = revisao_obrigatoria.get(df_para_editor.at[index, 'hash'])
+                    if motivo_revisao:
+                        pendencias = "; ".join(filter(None, [pendencias, motivo_revisao]))
+                    elif validacao['aprovada']:
+                        aprovadas.append(index)
+                    df_para_editor.at[index, 'pendencias'] = pendencias
+                if aprovadas:
+                    textos_ocr_lote = {item.get('hash'): item.get('texto_bruto_ocr') for item in dados_brutos_completos}
+                    with conexao_emprestada() as conn:
+                        notas_salvas, _ = salvar_lote_limpo(conn, df_para_editor.loc[aprovadas], df_limpo.loc[aprovadas], textos_ocr_lote)
+                    if notas_salvas:
+                        st.success(f"{len(notas_salvas)} nota(s) aprovada(s) pela validação automática e salva(s) diretamente.")
+                        st.session_state['resumo_lote_salvo'] = resumo_lote(notas_salvas)
+                        df_para_editor = df_para_editor[~df_para_editor['hash'].isin([d['hash'] for d in notas_salvas])]
+
+                if not df_para_editor.empty:
+                    st.success("Extração concluída! Valide os dados brutos extraídos abaixo (a coluna 'pendencias' indica o que rever).")
+                    st.session_state['dados_processados_para_editor'] = df_para_editor
+                else:
+                    st.session_state['dados_processados_para_editor'] = None
 
             elif dados_brutos_completos: # Se houve processamento mas nenhum JSON válido
                 st.warning("Nenhum JSON válido foi extraído dos ficheiros processados. Verifique os erros exibidos ou os logs do terminal.")
@@ -371,79 +421,94 @@ if st.session_state["authentication_status"]:
             else: st.session_state['dados_brutos_completos_para_treino'] = None
 
 
-        def finalizar_lote(df_editado_do_editor):
-            # Obtém conexão fresca para esta operação
-            current_conn = get_db_connection()
-            if not current_conn:
-                st.error("Não foi possível obter conexão com a base de dados para salvar.")
-                return
+        def salvar_lote_limpo(current_conn, df_bruto, df_limpo, textos_ocr_lote):
+            """
+            Grava o lote limpo (df_limpo, mesmo índice que df_bruto) numa única transação e regista as
+            notas salvas no índice de quase-duplicados. Retorna (dicts das notas salvas, sucesso).
+            """
+            sucesso = True
+            # Campos de controlo do lote bruto e valores limpos (já Decimal) -> um dict por linha (to_dict('records'))
+            df_notas = df_limpo.copy()
+            df_notas['hash'] = df_bruto['hash'] if 'hash' in df_bruto.columns else ''
+            df_notas['arquivo'] = df_bruto['arquivo'] if 'arquivo' in df_bruto.columns else [f'linha_{i}' for i in df_bruto.index]
+            df_notas['data_processamento'] = (df_bruto['data_processamento'] if 'data_processamento' in df_bruto.columns
+                                              else datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            registos_para_db = registos_de_dataframe(df_notas)
+            dados_limpos_por_hash = {d['hash']: d for d in registos_para_db}
+
+            # Insere todo o lote numa única transação (INSERT de várias linhas)
+            resultado_bulk = insert_records_bulk(current_conn, registos_para_db)
+            for hash_falhado, erro in resultado_bulk['falhas']:
+                nota = dados_limpos_por_hash.get(hash_falhado)
+                nome = nota['arquivo'] if nota is not None else hash_falhado
+                st.error(f"Erro ao salvar dados do ficheiro '{nome}' no banco de dados: {erro}")
+                sucesso = False
+            dados_limpos_lista = [dados_limpos_por_hash[h] for h in resultado_bulk['salvos'] if h in dados_limpos_por_hash]
+            registar_notas(current_conn, [(h, textos_ocr_lote.get(h), dados_limpos_por_hash[h])
+                                          for h in resultado_bulk['salvos'] if h in dados_limpos_por_hash])
+            registar_fornecedores(current_conn, dados_limpos_lista) # Notas validadas (revistas ou aprovadas automaticamente)
+            return dados_limpos_lista, sucesso
+
+
+        def carregar_fila_revisao(pendentes):
+            """Põe no editor as extrações que o monitor deixou por rever, com o motivo em 'pendencias'."""
+            pendentes = [r for r in pendentes if isinstance(r.get('json_bruto_llm'), dict)]
+            df_para_editor = pd.DataFrame([{**r['json_bruto_llm'], 'hash': r['hash'], 'arquivo': r['filename'],
+                                            'data_processamento': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+                                           for r in pendentes])
+            cols_para_editor = CAMPOS_CONTROLO + ['pendencias'] + CAMPOS_ESPERADOS
+            for col in cols_para_editor:
+               if col not in df_para_editor.columns: df_para_editor[col] = ""
+            df_para_editor = df_para_editor[cols_para_editor]
+            df_para_editor['pendencias'] = [r.get('motivo_revisao', '') for r in pendentes]
+            st.session_state['dados_processados_para_editor'] = df_para_editor
+            st.session_state['dados_brutos_completos_para_treino'] = pendentes
+            st.session_state['erros_processamento'] = []
+
+
+        def resumo_lote(dados_limpos_lista):
+            # Somas exatas em Decimal (como os SUM das colunas DECIMAL no MySQL)
+            valor_total = sum((interpretar_valor(d.get('ocr_valor_total')) for d in dados_limpos_lista), Decimal('0'))
+            iss_total = sum((interpretar_valor(d.get('ocr_valor_iss')) for d in dados_limpos_lista), Decimal('0'))
+            inss_total = sum((interpretar_valor(d.get('ocr_valor_inss')) for d in dados_limpos_lista), Decimal('0'))
+            return {
+                "total_validado": len(dados_limpos_lista), "valor_total": valor_total,
+                "iss_total": iss_total, "inss_total": inss_total,
+                "hashes": [d['hash'] for d in dados_limpos_lista]
+            }
+
 
+        def finalizar_lote(df_editado_do_editor):
             total_validado = len(df_editado_do_editor)
             dados_limpos_lista = []
             sucesso_geral = True
+            # Texto OCR do lote, para registar as notas salvas no índice de quase-duplicados
+            textos_ocr_lote = {item.get('hash'): item.get('texto_bruto_ocr') for item in (st.session_state.get('dados_brutos_completos_para_treino') or [])}
 
             if total_validado > 0:
                 with st.spinner('Limpando e Salvando dados...'):
-                    for index, row_editada in df_editado_do_editor.iterrows():
-                        dados_brutos_editados = row_editada.to_dict()
-                        current_hash = dados_brutos_editados.get('hash', '')
-                        filename = dados_brutos_editados.get('arquivo', f'linha_{index}')
-
-                        try:
-                            # Chama clean_and_format_data com os dados JÁ EDITADOS
-                            dados_limpos = clean_and_format_data(dados_brutos_editados)
-
-                            # Adiciona/Atualiza hash, arquivo, data_processamento
-                            dados_limpos['hash'] = current_hash
-                            dados_limpos['arquivo'] = filename
-                            dados_limpos['data_processamento'] = dados_brutos_editados.get('data_processamento', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-
-                            # Prepara dados para DB, garantindo todas as colunas
-                            row_data_para_db = {}
-                            for col_db in HEADERS_DB:
-                                row_data_para_db[col_db] = dados_limpos.get(col_db) # Pega o valor limpo
-                                if pd.isna(row_data_para_db[col_db]): row_data_para_db[col_db] = None
-                                numeric_db_cols = ['ocr_valor_total', 'ocr_valor_base_calculo', 'ocr_valor_aliquota', 'ocr_valor_iss',
-                                                    'ocr_valor_deducoes', 'ocr_valor_pis_pasep', 'ocr_valor_cofins', 'ocr_valor_csll',
-                                                    'ocr_valor_irrf', 'ocr_valor_inss', 'ocr_valor_credito', 'ocr_valor_tributos_fonte']
-                                if col_db in numeric_db_cols and row_data_para_db[col_db] is not None:
-                                     try: row_data_para_db[col_db] = float(row_data_para_db[col_db])
-                                     except (ValueError, TypeError):
-                                          st.warning(f"Valor inválido '{dados_limpos.get(col_db)}' para campo numérico '{col_db}' no ficheiro '{filename}'. Será salvo como NULO.")
-                                          row_data_para_db[col_db] = None
-
-                            # Insere no DB (passa a conexão atual)
-                            if insert_record(current_conn, row_data_para_db):
-                                dados_limpos_lista.append(dados_limpos)
-                            else:
-                                st.error(f"Erro ao salvar dados do ficheiro '{filename}' no banco de dados.")
-                                sucesso_geral = False
-
-                        except Exception as e:
-                            st.error(f"Erro ao limpar/processar dados do ficheiro '{filename}' para salvar: {e}")
-                            traceback.print_exc()
-                            sucesso_geral = False
-
-                # Geração do resumo e ficheiros de exportação
-                if sucesso_geral and dados_limpos_lista:
-                    df_dados_limpos = pd.DataFrame(dados_limpos_lista)
-                    df_dados_limpos = df_dados_limpos.reindex(columns=[col for col in HEADERS_DB if col in df_dados_limpos.columns])
-
-                    valor_total = pd.to_numeric(df_dados_limpos['ocr_valor_total'], errors='coerce').sum()
-                    iss_total = pd.to_numeric(df_dados_limpos['ocr_valor_iss'], errors='coerce').sum()
-                    inss_total = pd.to_numeric(df_dados_limpos.get('ocr_valor_inss', 0), errors='coerce').sum()
-
-                    output_excel = io.BytesIO()
-                    with pd.ExcelWriter(output_excel, engine='xlsxwriter') as writer:
-                        df_dados_limpos.to_excel(writer, index=False, sheet_name='DadosNFS')
-                    csv_data = df_dados_limpos.to_csv(index=False).encode('utf-8')
-
-                    st.session_state['resumo_lote_salvo'] = {
-                        "total_validado": len(dados_limpos_lista), "valor_total": valor_total,
-                        "iss_total": iss_total, "inss_total": inss_total,
-                        "excel_data": output_excel.getvalue(), "csv_data": csv_data
-                    }
-                    st.balloons()
+                    try:
+                        # Limpeza vetorizada de todo o lote editado (mesmo resultado que clean_and_format_data por linha)
+                        df_limpo = clean_and_format_dataframe(df_editado_do_editor)
+                    except Exception as e:
+                        st.error(f"Erro ao limpar/processar os dados do lote para salvar: {e}")
+                        traceback.print_exc()
+                        df_limpo = df_editado_do_editor.iloc[0:0]
+                        sucesso_geral = False
+
+                    # Conexão do pool só durante a gravação (devolvida mesmo com exceções)
+                    with conexao_emprestada() as conn:
+                        if not conn:
+                            st.error("Não foi possível obter conexão com a base de dados para salvar.")
+                            return
+                        dados_limpos_lista, sucesso_gravacao = salvar_lote_limpo(conn, df_editado_do_editor, df_limpo, textos_ocr_lote)
+                    sucesso_geral = sucesso_geral and sucesso_gravacao
+
+                # Geração do resumo (os ficheiros de exportação só são gerados quando pedidos)
+                if dados_limpos_lista:
+                    st.session_state['resumo_lote_salvo'] = resumo_lote(dados_limpos_lista)
+                    if sucesso_geral: st.balloons()
+                    else: st.error("Algumas notas não foram salvas. Verifique as mensagens acima; as restantes foram salvas.")
                 elif sucesso_geral:
                      st.warning("Nenhum dado foi efetivamente salvo após a limpeza/processamento.")
                 else:
@@ -453,10 +518,46 @@ if st.session_state["authentication_status"]:
                 st.session_state['dados_processados_para_editor'] = None
                 st.session_state['dados_brutos_completos_para_treino'] = None
 
-            # Fecha a conexão obtida no início da função
-            if current_conn and current_conn.is_connected():
-                current_conn.close()
-                print("Conexão (finalizar_lote) fechada.")
+
+        def botoes_exportacao(filtros, chave, nome_base):
+            """
+            Exportação sob pedido: o ficheiro só é gerado (em streaming, para um ficheiro temporário
+            em disco) quando o utilizador clica em 'Preparar'; a sessão guarda o caminho, não os bytes.
+            """
+            estado_key = f"{chave}_ficheiro"
+            assinatura = repr(sorted((k, str(v)) for k, v in (filtros or {}).items()))
+            pronto = st.session_state.get(estado_key)
+            if pronto and pronto[2] != assinatura: # Os filtros mudaram: o ficheiro preparado já não corresponde
+                descartar_exportacao(chave)
+                pronto = None
+
+            col_formato, col_preparar, col_baixar = st.columns([1, 1, 2])
+            formato = col_formato.selectbox("Formato:", list(FORMATOS_EXPORTACAO.keys()), key=f"{chave}_formato", label_visibility="collapsed")
+            if col_preparar.button("⚙️ Preparar exportação", key=f"{chave}_preparar"):
+                descartar_exportacao(chave)
+                with st.spinner("A gerar o ficheiro de exportação..."):
+                    with tempfile.NamedTemporaryFile('w+b', delete=False, suffix=f".{FORMATOS_EXPORTACAO[formato][1]}") as tmp_export:
+                        try:
+                            exportar_notas(filtros, formato, destino=tmp_export)
+                            pronto = (tmp_export.name, formato, assinatura)
+                        except Exception as e:
+                            pronto = None
+                            st.error(f"Erro ao gerar a exportação: {e}")
+                    if pronto is None: os.remove(tmp_export.name)
+                st.session_state[estado_key] = pronto
+            if pronto and os.path.exists(pronto[0]):
+                caminho, formato_pronto, _ = pronto
+                mime, extensao = FORMATOS_EXPORTACAO[formato_pronto]
+                with open(caminho, 'rb') as f_export: # Lido do disco pelo download_button, sem cópia na sessão
+                    col_baixar.download_button(f"📥 Baixar {nome_base} (.{extensao})", f_export,
+                                               f"{nome_base}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extensao}", mime,
+                                               key=f"{chave}_baixar")
+
+        def descartar_exportacao(chave):
+            pronto = st.session_state.pop(f"{chave}_ficheiro", None)
+            if pronto and os.path.exists(pronto[0]):
+                try: os.remove(pronto[0])
+                except OSError as e: print(f"Não foi possível remover o ficheiro de exportação {pronto[0]}: {e}")
 
 
         # --- Interface Principal ---
@@ -478,29 +579,30 @@ if st.session_state["authentication_status"]:
                 c2.metric("Valor Total", f"R$ {resumo['valor_total']:,.2f}")
                 c3.metric("Total ISS", f"R$ {resumo['iss_total']:,.2f}")
                 c4.metric("Total INSS", f"R$ {resumo.get('inss_total', 0.0):,.2f}")
-                dl_col1, dl_col2, _ = st.columns([1,1,2])
-                dl_col1.download_button("📥 Baixar Lote (.xlsx)", resumo['excel_data'], f"lote_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx")
-                dl_col2.download_button("📄 Baixar Lote (.csv)", resumo['csv_data'], f"lote_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+                botoes_exportacao({'hashes': resumo['hashes']}, 'exportacao_lote', 'lote')
                 st.success("Dados salvos na base de dados com sucesso!")
                 if st.button("✔️ OK, Ocultar Resumo"):
                     st.session_state['resumo_lote_salvo'] = None
+                    descartar_exportacao('exportacao_lote')
                     st.rerun()
             st.markdown("---")
 
         tabs_list = ["➕ Processar Documentos", "🔍 Consultar Dados", "📊 Dashboard Financeiro"]
-        if is_admin(conn, st.session_state["username"]):
+        with conexao_emprestada() as conn:
+            utilizador_admin = is_admin(conn, st.session_state["username"])
+        if utilizador_admin:
             tabs_list.append("⚙️ Gerir Utilizadores")
 
         tabs = st.tabs(tabs_list)
 
         with tabs[0]: # ABA 1: PROCESSAR
             st.header("Adicionar novos documentos")
-            sub_tab1, sub_tab2 = st.tabs(["📤 Upload Manual", "📁 Processar Pasta"])
+            sub_tab1, sub_tab2, sub_tab3 = st.tabs(["📤 Upload Manual", "📁 Processar Pasta", "🗂️ Fila de Revisão do Monitor"])
             with sub_tab1:
                 uploaded_files = st.file_uploader("Selecione os ficheiros:", accept_multiple_files=True, type=['pdf', 'png', 'jpg', 'jpeg', 'webp'], key="uploader")
                 if uploaded_files:
                      if st.button("▶️ Iniciar Processamento dos Ficheiros Selecionados"):
-                         iniciar_processamento(conn, uploaded_files)
+                         iniciar_processamento(uploaded_files)
                          st.rerun() # Adicionado rerun para atualizar a UI após o processamento
 
             with sub_tab2:
@@ -514,13 +616,25 @@ if st.session_state["authentication_status"]:
                              if not arquivos_na_pasta:
                                  st.warning("Nenhum ficheiro compatível (.png, .jpg, .jpeg, .pdf, .webp) encontrado na pasta.")
                              else:
-                                 iniciar_processamento(conn, arquivos_na_pasta, modo_pasta=True)
+                                 iniciar_processamento(arquivos_na_pasta, modo_pasta=True)
                                  st.rerun() # Adicionado rerun para atualizar a UI
                         except Exception as e:
                             st.error(f"Erro ao listar ficheiros na pasta: {e}")
                     else:
                         st.error("Caminho da pasta inválido ou inacessível.")
 
+            with sub_tab3:
+                st.caption("Notas extraídas pelo monitor de pastas que não foram salvas automaticamente "
+                           "(validação reprovada, texto quase igual ao de outra nota ou prestador divergente).")
+                if st.button("📥 Carregar fila de revisão no editor", key="carregar_revisao_btn"):
+                    with conexao_emprestada() as conn:
+                        pendentes = extracoes_pendentes(conn)
+                    if pendentes:
+                        carregar_fila_revisao(pendentes)
+                        st.rerun()
+                    else:
+                        st.info("Não há notas do monitor por rever.")
+
             # --- Secção de Validação e Edição ---
             # Verifica se 'dados_processados_para_editor' existe e não está vazio
             if st.session_state.get('dados_processados_para_editor') is not None and not st.session_state['dados_processados_para_editor'].empty:
@@ -555,6 +669,7 @@ if st.session_state["authentication_status"]:
                     #num_rows="dynamic", # Remover se não quiser adicionar/remover linhas
                     height=400,
                     key="data_editor",
+                    disabled=['pendencias'], # Resultado da validação automática (só leitura)
                     use_container_width=True,
                     # Opcional: Configurar colunas específicas se necessário
                     # column_config={ ... }
@@ -575,7 +690,7 @@ if st.session_state["authentication_status"]:
                 # --- Botão para Exportar Dados de Treino ---
                 if st.session_state.get('dados_brutos_completos_para_treino'):
                     try:
-                        jsonl_data = ""
+                        jsonl_buffer = io.StringIO() # Escrita linear (sem concatenação de strings)
                         for item in st.session_state['dados_brutos_completos_para_treino']:
                             # Cria o par prompt/completion (JSON bruto do LLM)
                             if item.get("json_bruto_llm"):
@@ -583,15 +698,16 @@ if st.session_state["authentication_status"]:
                                     "prompt": item.get("texto_bruto_ocr", ""),
                                     "completion": json.dumps(item["json_bruto_llm"], ensure_ascii=False)
                                 }
-                                jsonl_data += json.dumps(training_pair, ensure_ascii=False) + "\n"
+                                jsonl_buffer.write(json.dumps(training_pair, ensure_ascii=False) + "\n")
                             # Opcional: Incluir erros no ficheiro de treino
                             elif item.get("resposta_llm_com_erro"):
                                 error_pair = {
                                      "prompt": item.get("texto_bruto_ocr", ""),
                                      "completion_error": item.get("resposta_llm_com_erro")
                                 }
-                                jsonl_data += json.dumps(error_pair, ensure_ascii=False) + "\n"
+                                jsonl_buffer.write(json.dumps(error_pair, ensure_ascii=False) + "\n")
 
+                        jsonl_data = jsonl_buffer.getvalue()
                         if jsonl_data:
                             col_btn3.download_button(
                                 label="🧬 Baixar Dados para Treino (.jsonl)",
@@ -608,6 +724,28 @@ if st.session_state["authentication_status"]:
                  st.info("Nenhum dado válido extraído para edição devido a erros no processamento. Verifique as mensagens de erro acima.")
                  pass
 
+            # --- Exportação do Histórico para Treino (notas validadas + OCR da staging) ---
+            with st.expander("🧬 Exportar Histórico para Treino"):
+                st.caption("Pares texto OCR → JSON validado de todas as notas salvas. O ficheiro é escrito em disco por blocos.")
+                apenas_novos = st.checkbox("Apenas notas validadas desde a última exportação", value=True, key="treino_incremental")
+                if st.button("Gerar ficheiro de treino", key="gerar_treino_btn"):
+                    with conexao_emprestada() as export_conn:
+                        if export_conn:
+                            with tempfile.NamedTemporaryFile('w', delete=False, suffix='.jsonl', encoding='utf-8') as tmp_jsonl:
+                                total_pares, nova_marca = exportar_jsonl(export_conn, tmp_jsonl, desde=ler_marca() if apenas_novos else None)
+                            st.session_state['ficheiro_treino'] = (tmp_jsonl.name, total_pares, nova_marca)
+                        else: st.error("Não foi possível obter conexão com a base de dados para exportar.")
+
+                if st.session_state.get('ficheiro_treino'):
+                    caminho_treino, total_pares, nova_marca = st.session_state['ficheiro_treino']
+                    if total_pares and os.path.exists(caminho_treino):
+                        with open(caminho_treino, 'rb') as f_treino:
+                            if st.download_button(f"📥 Baixar {total_pares} pares (.jsonl)", f_treino,
+                                                  f"dados_treino_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl",
+                                                  mime="application/jsonl"):
+                                gravar_marca(nova_marca) # A marca só avança depois do download
+                    else: st.info("Não há novas notas validadas para exportar.")
+
 
         with tabs[1]: # ABA 2: CONSULTAR
             st.header("Consultar e Analisar a Base de Dados")
@@ -619,206 +757,187 @@ if st.session_state["authentication_status"]:
                 "Razão Social (Prestador)": "ocr_prestador_nome",
                 "Número da Nota": "ocr_numero",
                 "Razão Social (Tomador)": "ocr_tomador_nome",
+                "CNPJ do Tomador": "ocr_tomador_cpf_cnpj",
+                "Discriminação do Serviço": "ocr_discriminacao",
                 "Categoria": "categoria" # Descomentar se a coluna existir e for útil
             }
             search_field_display = col_search1.selectbox("Pesquisar por:", list(search_field_map.keys()))
             search_column_db = search_field_map[search_field_display]
             search_term = col_search2.text_input("Digite o termo para procurar:", key="search_box_specific")
 
-            # Busca inicial ao carregar a aba ou após limpar pesquisa
-            if 'df_consulta' not in st.session_state or not search_term:
-                 st.session_state.df_consulta = fetch_all_data_as_dataframe()
-
-            if st.button("🔎 Pesquisar", key="pesquisar_btn"):
-                if search_term:
-                    # Passa conn para search_data_as_dataframe
-                    st.session_state.df_consulta = search_data_as_dataframe(conn, search_term, search_column_db)
-                else:
-                    # Já busca tudo se o termo estiver vazio
-                    st.session_state.df_consulta = fetch_all_data_as_dataframe()
-                    st.info("Nenhum termo inserido. Exibindo todos os dados.")
-                st.rerun() # Atualiza a exibição com os resultados
-
-            df_completo = st.session_state.get('df_consulta') # Pega o DataFrame do estado
-
-            if df_completo is not None and not df_completo.empty:
+            with st.expander("Filtros e ordenação"):
+                f_col1, f_col2, f_col3 = st.columns(3)
+                filtro_emissao_de = f_col1.date_input("Emissão de:", value=None, key="filtro_emissao_de")
+                filtro_emissao_ate = f_col2.date_input("Emissão até:", value=None, key="filtro_emissao_ate")
+                filtro_categoria = f_col3.text_input("Categoria:", key="filtro_categoria")
+                f_col4, f_col5, f_col6 = st.columns(3)
+                filtro_prestador_cnpj = f_col4.text_input("CNPJ do Prestador (início):", key="filtro_prestador_cnpj")
+                filtro_valor_min = f_col5.number_input("Valor total mínimo:", value=None, min_value=0.0, key="filtro_valor_min")
+                filtro_valor_max = f_col6.number_input("Valor total máximo:", value=None, min_value=0.0, key="filtro_valor_max")
+                o_col1, o_col2, o_col3 = st.columns(3)
+                ordenacao_map = {
+                    "Data de Processamento": "data_processamento", "Data de Emissão": "ocr_emissao_datahora",
+                    "Valor Total": "ocr_valor_total", "Número da Nota": "ocr_numero",
+                    "Razão Social (Prestador)": "ocr_prestador_nome", "Categoria": "categoria"
+                }
+                ordenar_por = ordenacao_map[o_col1.selectbox("Ordenar por:", list(ordenacao_map.keys()), key="consulta_ordenar_por")]
+                ordem_descendente = o_col2.checkbox("Ordem decrescente", value=True, key="consulta_descendente")
+                tamanho_pagina = o_col3.selectbox("Notas por página:", [50, 100, 250, 500], index=1, key="consulta_tamanho_pagina")
+
+            filtros_consulta = {
+                'termo': search_term.strip(), 'coluna_termo': search_column_db,
+                'emissao_de': filtro_emissao_de, 'emissao_ate': filtro_emissao_ate,
+                'categoria': filtro_categoria.strip(), 'prestador_cnpj': filtro_prestador_cnpj.strip(),
+                'valor_min': filtro_valor_min, 'valor_max': filtro_valor_max,
+            }
+            # Qualquer alteração de filtro ou ordenação volta à primeira página
+            assinatura_consulta = (tuple(sorted((k, str(v)) for k, v in filtros_consulta.items())), ordenar_por, ordem_descendente, tamanho_pagina)
+            if st.session_state.get('consulta_assinatura') != assinatura_consulta:
+                st.session_state['consulta_assinatura'] = assinatura_consulta
+                st.session_state['consulta_cursores'] = [None] # Cursor de início de cada página visitada
+            cursores_consulta = st.session_state['consulta_cursores']
+
+            df_pagina, proximo_cursor = consultar_notas_paginado(
+                filtros_consulta, ordenar_por=ordenar_por, descendente=ordem_descendente,
+                limite=tamanho_pagina, apos=cursores_consulta[-1]
+            )
+            # COUNT e somas calculados no MySQL para a seleção inteira (valores DECIMAL exatos)
+            resumo_selecao = agregar_notas(filtros_consulta)
+            total_notas_selecao = resumo_selecao['total_notas'] if resumo_selecao else None
+
+            if total_notas_selecao is None:
+                 st.error("Erro ao buscar dados no banco de dados.")
+            elif total_notas_selecao > 0:
                 st.markdown("---")
                 st.subheader("Resumo Financeiro da Seleção Atual")
-                numeric_cols_db = ['ocr_valor_total', 'ocr_valor_iss', 'ocr_valor_inss', 'ocr_valor_pis_pasep',
-                                   'ocr_valor_cofins', 'ocr_valor_csll', 'ocr_valor_irrf']
-                for col in numeric_cols_db:
-                    if col in df_completo.columns:
-                         df_completo[col] = pd.to_numeric(df_completo[col], errors='coerce').fillna(0.0)
-                    else: df_completo[col] = 0.0
-
-                total_servicos_selecao = df_completo['ocr_valor_total'].sum()
-                total_iss_selecao = df_completo['ocr_valor_iss'].sum()
-                total_inss_selecao = df_completo['ocr_valor_inss'].sum()
-                total_pis_selecao = df_completo['ocr_valor_pis_pasep'].sum()
-                total_cofins_selecao = df_completo['ocr_valor_cofins'].sum()
-                total_csll_selecao = df_completo['ocr_valor_csll'].sum()
-                total_ir_selecao = df_completo['ocr_valor_irrf'].sum()
-                total_retido_selecao = total_iss_selecao + total_inss_selecao + total_pis_selecao + total_cofins_selecao + total_csll_selecao + total_ir_selecao
-
                 sum_col1, sum_col2, sum_col3 = st.columns(3)
-                sum_col1.metric("Soma Valor Total", f"R$ {total_servicos_selecao:,.2f}")
-                sum_col2.metric("Soma ISS", f"R$ {total_iss_selecao:,.2f}")
-                sum_col3.metric("Soma Total Retido", f"R$ {total_retido_selecao:,.2f}")
+                sum_col1.metric("Soma Valor Total", f"R$ {resumo_selecao['ocr_valor_total']:,.2f}")
+                sum_col2.metric("Soma ISS", f"R$ {resumo_selecao['ocr_valor_iss']:,.2f}")
+                sum_col3.metric("Soma Total Retido", f"R$ {resumo_selecao['total_retido']:,.2f}")
 
                 st.markdown("---")
-                st.metric("Total de Notas na Seleção", f"{len(df_completo)}")
+                st.metric("Total de Notas na Seleção", f"{total_notas_selecao}")
                 # Define a ordem das colunas para exibição (baseado em HEADERS_DB)
-                cols_display_consulta = [col for col in HEADERS_DB if col in df_completo.columns]
-                st.dataframe(df_completo[cols_display_consulta], use_container_width=True)
-                csv_export = df_completo[cols_display_consulta].to_csv(index=False).encode('utf-8')
-                st.download_button("📄 Baixar resultado da consulta (.csv)", csv_export, "consulta.csv", "text/csv")
-            elif df_completo is not None:
-                st.info("Nenhum registo encontrado para os critérios de pesquisa.")
+                cols_display_consulta = [col for col in HEADERS_DB if col in df_pagina.columns]
+                st.dataframe(df_pagina[cols_display_consulta], use_container_width=True)
+
+                pag_col1, pag_col2, pag_col3 = st.columns([1, 2, 1])
+                num_pagina = len(cursores_consulta)
+                total_paginas = max(1, -(-total_notas_selecao // tamanho_pagina))
+                pag_col2.caption(f"Página {num_pagina} de {total_paginas}")
+                if pag_col1.button("⬅️ Página anterior", disabled=num_pagina == 1, key="consulta_pagina_anterior"):
+                    cursores_consulta.pop()
+                    st.rerun()
+                if pag_col3.button("Página seguinte ➡️", disabled=proximo_cursor is None, key="consulta_pagina_seguinte"):
+                    cursores_consulta.append(proximo_cursor)
+                    st.rerun()
+
+                st.markdown("**Exportar a seleção completa:**")
+                botoes_exportacao(filtros_consulta, 'exportacao_consulta', 'consulta')
             else:
-                 st.error("Erro ao buscar dados no banco de dados.")
+                st.info("Nenhum registo encontrado para os critérios de pesquisa.")
 
         with tabs[2]: # ABA 3: DASHBOARD FINANCEIRO
             st.header("📊 Dashboard Financeiro")
-            # Chama sem 'conn'
-            df_dashboard = fetch_all_data_as_dataframe()
+            # Lê só os rollups mensais (mês x prestador x categoria), mantidos a cada gravação
+            df_dashboard = fetch_rollup_mensal_as_dataframe()
 
-            if df_dashboard is not None and not df_dashboard.empty and 'ocr_emissao_datahora' in df_dashboard.columns:
+            if df_dashboard is not None and not df_dashboard.empty:
                 try:
-                    numeric_cols_dash = [
-                        'ocr_valor_total', 'ocr_valor_iss', 'ocr_valor_base_calculo', 'ocr_valor_aliquota',
-                        'ocr_valor_pis_pasep', 'ocr_valor_cofins', 'ocr_valor_csll', 'ocr_valor_irrf', 'ocr_valor_inss'
-                    ]
-                    for col in numeric_cols_dash:
-                        if col in df_dashboard.columns:
-                            df_dashboard[col] = pd.to_numeric(df_dashboard[col], errors='coerce').fillna(0.0)
-                        else: df_dashboard[col] = 0.0
-
-                    df_dashboard['ocr_emissao_datahora'] = pd.to_datetime(df_dashboard['ocr_emissao_datahora'], errors='coerce')
-                    df_dashboard.dropna(subset=['ocr_emissao_datahora'], inplace=True)
-
-                    if 'ocr_valor_total' in df_dashboard.columns:
-                         df_dashboard = df_dashboard[df_dashboard['ocr_valor_total'].notna() & (df_dashboard['ocr_valor_total'] > 0)]
-
-                    if not df_dashboard.empty:
-                        df_dashboard['mes_ano'] = df_dashboard['ocr_emissao_datahora'].dt.to_period('M').astype(str)
-
-                        st.subheader("Indicadores Chave (Período Completo)")
-                        total_servicos = df_dashboard['ocr_valor_total'].sum()
-                        total_iss = df_dashboard['ocr_valor_iss'].sum()
-                        total_inss = df_dashboard['ocr_valor_inss'].sum()
-                        total_pis = df_dashboard['ocr_valor_pis_pasep'].sum()
-                        total_cofins = df_dashboard['ocr_valor_cofins'].sum()
-                        total_csll = df_dashboard['ocr_valor_csll'].sum()
-                        total_ir = df_dashboard['ocr_valor_irrf'].sum()
-                        total_retido = total_iss + total_inss + total_pis + total_cofins + total_csll + total_ir
-                        num_notas = len(df_dashboard)
-                        valor_medio_nota = total_servicos / num_notas if num_notas > 0 else 0
-                        carga_tributaria_retida = total_retido / total_servicos if total_servicos > 0 else 0
-
-                        kpi_cols = st.columns(4)
-                        kpi_cols[0].metric("Valor Total Serviços", f"R$ {total_servicos:,.2f}")
-                        kpi_cols[1].metric("Total Impostos Retidos", f"R$ {total_retido:,.2f}")
-                        kpi_cols[2].metric("Carga Tributária Média", f"{carga_tributaria_retida:.2%}", help="Percentagem do valor total que corresponde a impostos retidos.")
-                        kpi_cols[3].metric("Valor Médio por Nota", f"R$ {valor_medio_nota:,.2f}", help="Custo médio de cada serviço registado.")
-                        st.markdown("<hr/>", unsafe_allow_html=True)
-
-                        st.subheader("📈 Evolução Mensal")
-                        agg_dict_dash = {
-                            'ocr_valor_total': ('ocr_valor_total', 'sum'),
-                            'ocr_valor_iss': ('ocr_valor_iss', 'sum'),
-                            'ocr_valor_inss': ('ocr_valor_inss', 'sum'),
-                            'ocr_valor_pis_pasep': ('ocr_valor_pis_pasep', 'sum'),
-                            'ocr_valor_cofins': ('ocr_valor_cofins', 'sum'),
-                            'ocr_valor_csll': ('ocr_valor_csll', 'sum'),
-                            'ocr_valor_irrf': ('ocr_valor_irrf', 'sum'),
-                        }
-                        df_evolucao = df_dashboard.groupby('mes_ano').agg(**agg_dict_dash).reset_index()
+                    df_dashboard['mes_ano'] = df_dashboard['mes'].dt.to_period('M').astype(str)
+
+                    st.subheader("Indicadores Chave (Período Completo)")
+                    total_servicos = df_dashboard['ocr_valor_total'].sum()
+                    total_iss = df_dashboard['ocr_valor_iss'].sum()
+                    total_inss = df_dashboard['ocr_valor_inss'].sum()
+                    total_pis = df_dashboard['ocr_valor_pis_pasep'].sum()
+                    total_cofins = df_dashboard['ocr_valor_cofins'].sum()
+                    total_csll = df_dashboard['ocr_valor_csll'].sum()
+                    total_ir = df_dashboard['ocr_valor_irrf'].sum()
+                    total_retido = total_iss + total_inss + total_pis + total_cofins + total_csll + total_ir
+                    num_notas = int(df_dashboard['num_notas'].sum())
+                    valor_medio_nota = total_servicos / num_notas if num_notas > 0 else 0
+                    carga_tributaria_retida = total_retido / total_servicos if total_servicos > 0 else 0
+
+                    kpi_cols = st.columns(4)
+                    kpi_cols[0].metric("Valor Total Serviços", f"R$ {total_servicos:,.2f}")
+                    kpi_cols[1].metric("Total Impostos Retidos", f"R$ {total_retido:,.2f}")
+                    kpi_cols[2].metric("Carga Tributária Média", f"{carga_tributaria_retida:.2%}", help="Percentagem do valor total que corresponde a impostos retidos.")
+                    kpi_cols[3].metric("Valor Médio por Nota", f"R$ {valor_medio_nota:,.2f}", help="Custo médio de cada serviço registado.")
+                    st.markdown("<hr/>", unsafe_allow_html=True)
+
+                    st.subheader("📈 Evolução Mensal")
+                    cols_evolucao = ['ocr_valor_total', 'ocr_valor_iss', 'ocr_valor_inss', 'ocr_valor_pis_pasep',
+                                     'ocr_valor_cofins', 'ocr_valor_csll', 'ocr_valor_irrf']
+                    df_evolucao = df_dashboard.groupby('mes_ano')[cols_evolucao].sum().reset_index()
+
+                    if len(df_evolucao['mes_ano'].unique()) > 1:
+                        try:
+                            date_range_index = pd.period_range(start=df_evolucao['mes_ano'].min(), end=df_evolucao['mes_ano'].max(), freq='M').strftime('%Y-%m')
+                            df_evolucao = df_evolucao.set_index('mes_ano').reindex(date_range_index, fill_value=0).reset_index().rename(columns={'index': 'mes_ano'})
+                        except Exception as e:
+                            st.warning(f"Erro ao criar intervalo de datas contínuo: {e}")
+
+                    df_evolucao['total_retido'] = df_evolucao[['ocr_valor_iss', 'ocr_valor_inss', 'ocr_valor_pis_pasep', 'ocr_valor_cofins', 'ocr_valor_csll', 'ocr_valor_irrf']].sum(axis=1)
+                    df_evolucao = df_evolucao.sort_values('mes_ano')
+                    # Somas em Decimal (exatas); o gráfico recebe float
+                    df_evolucao = df_evolucao.astype({c: 'float64' for c in cols_evolucao + ['total_retido']})
+
+                    if not df_evolucao.empty and len(df_evolucao) > 0:
+                        fig_evolucao = px.bar(df_evolucao, x='mes_ano', y=['ocr_valor_total', 'total_retido'],
+                                              title="Valor Total vs. Impostos Retidos por Mês",
+                                              labels={'value': 'Valor (R$)', 'mes_ano': 'Mês', 'variable': 'Métrica'},
+                                              barmode='group',
+                                              color_discrete_map={'ocr_valor_total': '#58a6ff', 'total_retido': '#f778ba'}
+                                              )
+                        fig_evolucao.update_layout(legend_title_text='')
+                        st.plotly_chart(fig_evolucao, use_container_width=True, config={'displaylogo': False})
+                    else:
+                        st.info("Não há dados mensais suficientes ou válidos para o gráfico de evolução.")
+                    st.markdown("<hr/>", unsafe_allow_html=True)
 
-                        if len(df_evolucao['mes_ano'].unique()) > 1:
-                            try:
-                                df_evolucao['mes_ano_dt'] = pd.to_datetime(df_evolucao['mes_ano'])
-                                date_range_index = pd.period_range(start=df_evolucao['mes_ano_dt'].min().to_period('M'),
-                                                                  end=df_evolucao['mes_ano_dt'].max().to_period('M'),
-                                                                  freq='M').strftime('%Y-%m')
-                                df_evolucao = df_evolucao.set_index('mes_ano').reindex(date_range_index, fill_value=0).reset_index().rename(columns={'index': 'mes_ano'})
-                                df_evolucao.drop(columns=['mes_ano_dt'], inplace=True, errors='ignore')
-                            except Exception as e:
-                                st.warning(f"Erro ao criar intervalo de datas contínuo: {e}")
-
-                        df_evolucao['total_retido'] = df_evolucao[['ocr_valor_iss', 'ocr_valor_inss', 'ocr_valor_pis_pasep', 'ocr_valor_cofins', 'ocr_valor_csll', 'ocr_valor_irrf']].sum(axis=1)
-                        df_evolucao = df_evolucao.sort_values('mes_ano')
-
-                        if not df_evolucao.empty and len(df_evolucao) > 0:
-                            fig_evolucao = px.bar(df_evolucao, x='mes_ano', y=['ocr_valor_total', 'total_retido'],
-                                                  title="Valor Total vs. Impostos Retidos por Mês",
-                                                  labels={'value': 'Valor (R$)', 'mes_ano': 'Mês', 'variable': 'Métrica'},
-                                                  barmode='group',
-                                                  color_discrete_map={'ocr_valor_total': '#58a6ff', 'total_retido': '#f778ba'}
-                                                  )
-                            fig_evolucao.update_layout(legend_title_text='')
-                            st.plotly_chart(fig_evolucao, use_container_width=True, config={'displaylogo': False})
-                        else:
-                            st.info("Não há dados mensais suficientes ou válidos para o gráfico de evolução.")
-                        st.markdown("<hr/>", unsafe_allow_html=True)
-
-                        col1, col2 = st.columns(2)
-                        with col1:
-                            with st.container(border=True):
-                                st.subheader("👥 Análise de Prestadores")
-                                if 'ocr_prestador_nome' in df_dashboard.columns:
-                                    df_dashboard['prestador_display'] = df_dashboard['ocr_prestador_nome'].fillna('N/A').str.strip()
-                                    df_dashboard.loc[df_dashboard['prestador_display'] == '', 'prestador_display'] = 'N/A'
-
-                                    top_prestadores = df_dashboard.groupby('prestador_display')['ocr_valor_total'].sum().nlargest(5).reset_index()
-                                    if not top_prestadores.empty and not (len(top_prestadores)==1 and top_prestadores.iloc[0]['prestador_display']=='N/A'):
-                                        fig_prestadores = px.bar(top_prestadores, y='prestador_display', x='ocr_valor_total',
-                                                                 orientation='h', title="Top 5 Maiores Fornecedores")
-                                        fig_prestadores.update_layout(yaxis={'categoryorder':'total ascending'}, xaxis_title="Valor Total (R$)", yaxis_title="")
-                                        st.plotly_chart(fig_prestadores, use_container_width=True, config={'displaylogo': False})
-                                        percent_top5 = top_prestadores['ocr_valor_total'].sum() / total_servicos if total_servicos > 0 else 0
-                                        st.metric("Concentração nos Top 5", f"{percent_top5:.1%}",
-                                                  help="Percentual do valor total gasto com os 5 maiores fornecedores. Valores altos podem indicar dependência excessiva e risco. Considere diversificar.")
-                                    else:
-                                        st.info("Não há dados suficientes (ex: diferentes prestadores válidos) para o gráfico de Top Prestadores.")
-                                else:
-                                    st.warning("Coluna 'ocr_prestador_nome' não encontrada.")
-
-                        with col2:
-                            with st.container(border=True):
-                                st.subheader("🏷️ Análise por Categoria (Se disponível)")
-                                # Assumindo que 'categoria' é adicionada em clean_and_format_data ou pelo LLM
-                                if 'categoria' in df_dashboard.columns:
-                                    df_categoria = df_dashboard.dropna(subset=['categoria'])
-                                    df_categoria = df_categoria[df_categoria['categoria'].astype(str).str.strip().fillna('') != ''] # Converte para str antes
-                                    if not df_categoria.empty:
-                                        df_categoria_agg = df_categoria.groupby('categoria')['ocr_valor_total'].sum().reset_index().sort_values(by='ocr_valor_total', ascending=True)
-                                        if not df_categoria_agg.empty:
-                                            fig_categoria = px.bar(df_categoria_agg, x='ocr_valor_total', y='categoria',
-                                                                   orientation='h', title="Distribuição de Gastos por Categoria")
-                                            fig_categoria.update_layout(xaxis_title="Valor Total (R$)", yaxis_title="")
-                                            st.plotly_chart(fig_categoria, use_container_width=True, config={'displaylogo': False})
-                                            categoria_max = df_categoria_agg.iloc[-1]
-                                            st.metric(f"Principal Categoria: {categoria_max['categoria']}",
-                                                      f"R$ {categoria_max['ocr_valor_total']:,.2f}",
-                                                      help="Categoria com o maior valor total. Analise se os gastos nesta área estão alinhados com os objetivos.")
-                                        else: st.info("Não há categorias válidas após agregação.")
-                                    else: st.info("Não há notas categorizadas (ou categorias válidas) para exibir este gráfico.")
-                                else: st.info("Coluna 'categoria' não encontrada ou não preenchida nos dados para análise por categoria.")
-                        st.markdown("<hr/>", unsafe_allow_html=True)
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        with st.container(border=True):
+                            st.subheader("👥 Análise de Prestadores")
+                            top_prestadores = df_dashboard.groupby('prestador_nome')['ocr_valor_total'].sum().sort_values(ascending=False).head(5).reset_index()
+                            if not top_prestadores.empty and not (len(top_prestadores)==1 and top_prestadores.iloc[0]['prestador_nome']=='N/A'):
+                                fig_prestadores = px.bar(top_prestadores.astype({'ocr_valor_total': 'float64'}), y='prestador_nome', x='ocr_valor_total',
+                                                         orientation='h', title="Top 5 Maiores Fornecedores")
+                                fig_prestadores.update_layout(yaxis={'categoryorder':'total ascending'}, xaxis_title="Valor Total (R$)", yaxis_title="")
+                                st.plotly_chart(fig_prestadores, use_container_width=True, config={'displaylogo': False})
+                                percent_top5 = top_prestadores['ocr_valor_total'].sum() / total_servicos if total_servicos > 0 else 0
+                                st.metric("Concentração nos Top 5", f"{percent_top5:.1%}",
+                                          help="Percentual do valor total gasto com os 5 maiores fornecedores. Valores altos podem indicar dependência excessiva e risco. Considere diversificar.")
+                            else:
+                                st.info("Não há dados suficientes (ex: diferentes prestadores válidos) para o gráfico de Top Prestadores.")
 
+                    with col2:
                         with st.container(border=True):
-                            st.subheader("💸 Maiores Notas Fiscais Registadas (Top 5)")
-                            cols_maiores_notas = ['ocr_emissao_datahora', 'ocr_prestador_nome', 'ocr_discriminacao', 'ocr_valor_total']
-                            if 'categoria' in df_dashboard.columns: cols_maiores_notas.append('categoria')
-                            cols_presentes = [col for col in cols_maiores_notas if col in df_dashboard.columns]
-
-                            if 'ocr_valor_total' in df_dashboard.columns and 'ocr_emissao_datahora' in df_dashboard.columns:
-                                maiores_notas = df_dashboard.nlargest(5, 'ocr_valor_total')[cols_presentes]
-                                maiores_notas_display = maiores_notas.copy()
-                                maiores_notas_display['ocr_emissao_datahora'] = pd.to_datetime(maiores_notas_display['ocr_emissao_datahora']).dt.strftime('%d/%m/%Y')
-                                st.dataframe(maiores_notas_display, use_container_width=True, hide_index=True)
-                            else: st.warning("Faltam colunas essenciais ('ocr_valor_total', 'ocr_emissao_datahora') para exibir as maiores notas.")
-                    else: st.info("Não há dados válidos após a limpeza para gerar o dashboard.")
+                            st.subheader("🏷️ Análise por Categoria (Se disponível)")
+                            df_categoria = df_dashboard[df_dashboard['categoria'] != ''] # '' = nota sem categoria
+                            if not df_categoria.empty:
+                                df_categoria_agg = df_categoria.groupby('categoria')['ocr_valor_total'].sum().reset_index().sort_values(by='ocr_valor_total', ascending=True)
+                                fig_categoria = px.bar(df_categoria_agg.astype({'ocr_valor_total': 'float64'}), x='ocr_valor_total', y='categoria',
+                                                       orientation='h', title="Distribuição de Gastos por Categoria")
+                                fig_categoria.update_layout(xaxis_title="Valor Total (R$)", yaxis_title="")
+                                st.plotly_chart(fig_categoria, use_container_width=True, config={'displaylogo': False})
+                                categoria_max = df_categoria_agg.iloc[-1]
+                                st.metric(f"Principal Categoria: {categoria_max['categoria']}",
+                                          f"R$ {categoria_max['ocr_valor_total']:,.2f}",
+                                          help="Categoria com o maior valor total. Analise se os gastos nesta área estão alinhados com os objetivos.")
+                            else: st.info("Não há notas categorizadas (ou categorias válidas) para exibir este gráfico.")
+                    st.markdown("<hr/>", unsafe_allow_html=True)
+
+                    with st.container(border=True):
+                        st.subheader("💸 Maiores Notas Fiscais Registadas (Top 5)")
+                        # Consulta indexada (ORDER BY ocr_valor_total DESC LIMIT 5), não a tabela inteira
+                        cols_maiores_notas = ['ocr_emissao_datahora', 'ocr_prestador_nome', 'ocr_discriminacao', 'ocr_valor_total', 'categoria']
+                        maiores_notas, _ = consultar_notas_paginado(colunas=cols_maiores_notas, ordenar_por='ocr_valor_total', limite=5)
+                        if not maiores_notas.empty:
+                            maiores_notas['ocr_emissao_datahora'] = maiores_notas['ocr_emissao_datahora'].dt.strftime('%d/%m/%Y')
+                            st.dataframe(maiores_notas, use_container_width=True, hide_index=True)
+                        else: st.info("Não há notas para exibir.")
                 except Exception as e:
                     st.error(f"Erro ao gerar o dashboard: {e}")
                     traceback.print_exc()
@@ -827,12 +946,41 @@ if st.session_state["authentication_status"]:
             else:
                  st.error("Erro ao buscar dados do banco de dados para o dashboard.")
 
-        if is_admin(conn, st.session_state["username"]):
+            with st.expander("🦆 Análise por Dimensão (snapshot analítico)"):
+                if not ANALITICA_DISPONIVEL:
+                    st.info("Instale 'duckdb' e 'pyarrow' para ativar as análises sobre o snapshot Parquet.")
+                else:
+                    marca_snapshot = ler_marca_snapshot()
+                    a_col1, a_col2 = st.columns([3, 1])
+                    a_col1.caption(f"Snapshot atualizado até: {marca_snapshot.get('gravado_em', 'nunca')[:19] if marca_snapshot else 'nunca'}")
+                    if a_col2.button("🔄 Atualizar snapshot", key="atualizar_snapshot_btn"):
+                        with st.spinner("A copiar as notas novas para o snapshot Parquet..."):
+                            try:
+                                novas = atualizar_snapshot()
+                                st.success(f"{novas} notas novas copiadas para o snapshot.")
+                            except Exception as e:
+                                st.error(f"Erro ao atualizar o snapshot analítico: {e}")
+                    dimensao = st.selectbox("Agrupar por:", list(DIMENSOES_ANALISE.keys()),
+                                            format_func=DIMENSOES_ANALISE.get, key="analise_dimensao")
+                    try:
+                        df_dimensao = resumo_por_dimensao(dimensao)
+                        if not df_dimensao.empty:
+                            fig_dimensao = px.bar(df_dimensao, x='valor_total', y=dimensao, orientation='h',
+                                                  title=f"Valor Total por {DIMENSOES_ANALISE[dimensao]}")
+                            fig_dimensao.update_layout(yaxis={'categoryorder': 'total ascending'}, xaxis_title="Valor Total (R$)", yaxis_title="")
+                            st.plotly_chart(fig_dimensao, use_container_width=True, config={'displaylogo': False})
+                            st.dataframe(df_dimensao, use_container_width=True, hide_index=True)
+                        else: st.info("O snapshot está vazio. Clique em 'Atualizar snapshot'.")
+                    except Exception as e:
+                        st.error(f"Erro na consulta analítica: {e}")
+
+        if utilizador_admin:
             try:
                 with tabs[3]: # ABA 4: GERIR UTILIZADORES
                     st.header("⚙️ Painel de Gestão de Utilizadores")
                     st.subheader("Lista de Utilizadores")
-                    users_df = fetch_all_users_for_admin_view(conn)
+                    with conexao_emprestada() as conn:
+                        users_df = fetch_all_users_for_admin_view(conn)
                     if users_df is not None:
                         st.dataframe(users_df, use_container_width=True)
                         csv_users = users_df.to_csv(index=False).encode('utf-8')
@@ -855,21 +1003,42 @@ if st.session_state["authentication_status"]:
                                     # password_bytes = new_password.encode('utf-8')
                                     # salt = bcrypt.gensalt()
                                     # hashed_password = bcrypt.hashpw(password_bytes, salt).decode('utf-8')
-                                    if add_user(conn, new_username, new_email, new_name, hashed_password, is_admin_checkbox, force_change=True):
+                                    with conexao_emprestada() as conn:
+                                        criado = add_user(conn, new_username, new_email, new_name, hashed_password, is_admin_checkbox, force_change=True)
+                                    if criado:
                                         st.success(f"Utilizador '{new_username}' criado com sucesso! Terá de alterar a palavra-passe no primeiro login.")
                                         st.rerun()
                                     else: st.error("Erro ao criar utilizador. O nome de utilizador ou e-mail pode já existir.")
                                 else: st.warning("Por favor, preencha todos os campos.")
 
+                    with st.expander("📶 Métricas do Pool de Conexões"):
+                        metricas_pool = obter_metricas_pool()
+                        m_col1, m_col2, m_col3, m_col4 = st.columns(4)
+                        m_col1.metric("Emprestadas / Tamanho", f"{metricas_pool.get('emprestadas', 0)} / {metricas_pool.get('tamanho', 0)}")
+                        m_col2.metric("Checkouts", f"{metricas_pool['checkouts']}")
+                        m_col3.metric("Espera Média", f"{metricas_pool['espera_media_s'] * 1000:.1f} ms")
+                        m_col4.metric("Espera Máxima", f"{metricas_pool['espera_maxima_s'] * 1000:.1f} ms", help=f"Timeouts: {metricas_pool['timeouts']}")
+
+                    with st.expander("🗄️ Cache de Consultas"):
+                        metricas_cache = obter_metricas_cache()
+                        c_col1, c_col2, c_col3, c_col4 = st.columns(4)
+                        c_col1.metric("Taxa de Acerto", f"{metricas_cache['taxa_acerto']:.1%}", help=f"Hits: {metricas_cache['hits']} / Misses: {metricas_cache['misses']}")
+                        c_col2.metric("Entradas", f"{metricas_cache['entradas']}")
+                        c_col3.metric("Memória", f"{metricas_cache['bytes'] / 1024 / 1024:.1f} / {metricas_cache['max_bytes'] / 1024 / 1024:.0f} MiB")
+                        c_col4.metric("Expulsões / Invalidações", f"{metricas_cache['expulsoes']} / {metricas_cache['invalidacoes']}")
+
                     st.subheader("Gerir Utilizadores Existentes")
-                    all_usernames = get_all_usernames(conn)
+                    with conexao_emprestada() as conn:
+                        all_usernames = get_all_usernames(conn)
                     if all_usernames:
                         user_to_manage = st.selectbox("Selecione um utilizador para gerir:", options=[u for u in all_usernames if u != st.session_state["username"]], key="manage_user_select", index=None, placeholder="Escolha um utilizador...") # Impede auto-exclusão na seleção
                         if user_to_manage:
                             col_manage1, col_manage2 = st.columns(2)
                             with col_manage1:
                                 if st.button(f"Forçar alteração de palavra-passe para '{user_to_manage}'", key=f"force_pw_{user_to_manage}"):
-                                    if set_password_change_flag(conn, user_to_manage, True):
+                                    with conexao_emprestada() as conn:
+                                        sinalizado = set_password_change_flag(conn, user_to_manage, True)
+                                    if sinalizado:
                                         st.success(f"O utilizador '{user_to_manage}' terá de alterar a sua palavra-passe no próximo login.")
                                     else: st.error("Ocorreu um erro.")
                             with col_manage2:
@@ -883,7 +1052,9 @@ if st.session_state["authentication_status"]:
                                 st.warning(f"Tem a certeza que deseja excluir o utilizador '{user_to_manage}'? Esta ação é irreversível.")
                                 confirm_col1, confirm_col2 = st.columns(2)
                                 if confirm_col1.button("Sim, excluir", key=f"confirm_yes_{user_to_manage}"):
-                                    if delete_user(conn, user_to_manage):
+                                    with conexao_emprestada() as conn:
+                                        excluido = delete_user(conn, user_to_manage)
+                                    if excluido:
                                         st.success(f"Utilizador '{user_to_manage}' excluído com sucesso!")
                                         st.session_state[f'confirm_delete_{user_to_manage}'] = False # Reseta confirmação
                                         st.rerun() # Atualiza a lista
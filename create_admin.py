@@ -39,7 +39,8 @@ if DIRETORIO_ATUAL not in sys.path:
 
 # Importa as funções da base de dados com tratamento de erros
 try:
-    from Backend.database import create_connection, create_users_table_if_not_exists, add_user
+    from Backend.database import create_connection, add_user
+    from Backend.migracoes import aplicar_migracoes
 except ImportError:
     print("\n[ERRO FATAL] Não foi possível encontrar o módulo 'Backend.database'.")
     print("Certifique-se de que está a executar este script a partir da pasta raiz do projeto (H:\\projeto2).")
@@ -56,8 +57,10 @@ def setup_initial_admin():
         return
     print("[SUCESSO] Conexão com a base de dados estabelecida.")
 
-    print("\nPasso 2: A verificar/criar a tabela de utilizadores...")
-    create_users_table_if_not_exists(conn)
+    print("\nPasso 2: A aplicar as migrações do schema (inclui a tabela de utilizadores)...")
+    if not aplicar_migracoes(conn):
+        print("\n[FALHA] Não foi possível aplicar as migrações. Verifique a mensagem de erro acima.")
+        return
     print("[SUCESSO] Tabela de utilizadores pronta.")
 
     # Recolhe as informações do novo administrador
@@ -0,0 +1,203 @@
+"""
+Deduplicação por hash (Backend/deduplicacao.py) contra uma base de dados falsa em memória:
+consulta em blocos de 'WHERE hash IN (...)' nas duas tabelas de notas (TABELAS_NOTAS) e o
+filtro de Bloom, carregado uma vez e sincronizado pela coluna gravado_em com os hashes gravados
+por outros processos.
+
+Na raiz do projeto:
+    python -m pytest -q tests
+"""
+import contextlib
+import io
+import re
+from datetime import datetime, timedelta
+
+import mysql.connector
+import pytest
+
+from Backend import deduplicacao
+from Backend.deduplicacao import TABELAS_NOTAS, FiltroBloom, hashes_existentes
+
+INICIO = datetime(2024, 6, 15, 12, 0, 0)
+
+
+class BaseFalsa:
+    """As tabelas de notas ({tabela: {hash: gravado_em}}) e o relógio do 'MySQL'."""
+
+    def __init__(self, **tabelas):
+        self.tabelas = {t: dict(tabelas.get(t, {})) for t in TABELAS_NOTAS}
+        self.agora = INICIO
+        self.consultas = [] # (sql, params) de todas as execuções
+        self.falhar = False
+        self.sem_pool = False # conexao_emprestada sem conexão disponível
+
+    def gravar(self, tabela, hash_, gravado_em=None):
+        self.tabelas[tabela][hash_] = gravado_em or self.agora
+
+    def conexao(self):
+        return ConexaoFalsa(self)
+
+
+class ConexaoFalsa:
+    def __init__(self, base):
+        self.base = base
+
+    def is_connected(self):
+        return True
+
+    def cursor(self):
+        return CursorFalso(self.base)
+
+
+class CursorFalso:
+    """Só entende as consultas que Backend/deduplicacao.py faz."""
+
+    def __init__(self, base):
+        self.base = base
+        self._linhas = []
+
+    def execute(self, sql, params=()):
+        base = self.base
+        base.consultas.append((sql, params))
+        if base.falhar: raise mysql.connector.Error("ligação perdida")
+        if sql == "SELECT NOW(6)":
+            self._linhas = [(base.agora,)]
+        elif m := re.fullmatch(r"SELECT COUNT\(\*\) FROM (\w+)", sql):
+            self._linhas = [(len(base.tabelas[m[1]]),)]
+        elif m := re.fullmatch(r"SELECT hash FROM (\w+) WHERE hash > %s ORDER BY hash LIMIT (\d+)", sql):
+            self._linhas = [(h,) for h in sorted(base.tabelas[m[1]]) if h > params[0]][:int(m[2])]
+        elif m := re.fullmatch(r"SELECT hash FROM (\w+) WHERE gravado_em >= %s", sql):
+            self._linhas = [(h,) for h, gravado in base.tabelas[m[1]].items() if gravado >= params[0]]
+        elif 'WHERE hash IN' in sql:
+            partes = sql.split(" UNION ALL ")
+            por_parte = len(params) // len(partes)
+            self._linhas = []
+            for i, parte in enumerate(partes):
+                tabela = re.match(r"SELECT hash FROM (\w+) WHERE hash IN", parte)[1]
+                self._linhas += [(h,) for h in params[i * por_parte:(i + 1) * por_parte] if h in base.tabelas[tabela]]
+        else:
+            raise AssertionError(f"Consulta inesperada: {sql}")
+
+    def fetchone(self):
+        return self._linhas[0] if self._linhas else None
+
+    def fetchall(self):
+        return self._linhas
+
+
+def _consultas_in(base):
+    return [(sql, params) for sql, params in base.consultas if 'WHERE hash IN' in sql]
+
+
+# ==============================================================================
+# CONSULTA EM BLOCOS
+# ==============================================================================
+def test_consulta_em_blocos_nas_duas_tabelas():
+    base = BaseFalsa(notas_fiscais={'a': INICIO, 'd': INICIO}, notas_fiscais_arquivo={'b': INICIO, 'g': INICIO})
+    candidatos = ['a', 'b', 'c', 'a', '', None, 'd', 'e', 'f', 'g']
+    assert hashes_existentes(base.conexao(), candidatos, tamanho_lote=3) == {'a', 'b', 'd', 'g'}
+
+    consultas = _consultas_in(base)
+    blocos = [['a', 'b', 'c'], ['d', 'e', 'f'], ['g']] # Sem repetidos nem vazios, pela ordem de chegada
+    assert len(consultas) == len(blocos)
+    for (sql, params), bloco in zip(consultas, blocos):
+        assert [re.match(r"SELECT hash FROM (\w+)", p)[1] for p in sql.split(" UNION ALL ")] == TABELAS_NOTAS
+        assert params == tuple(bloco) * len(TABELAS_NOTAS)
+
+
+@pytest.mark.parametrize('conexao, candidatos', [(None, ['a']), ('falsa', []), ('falsa', ['', None])])
+def test_sem_conexao_ou_sem_candidatos_nao_consulta(conexao, candidatos):
+    base = BaseFalsa(notas_fiscais={'a': INICIO})
+    assert hashes_existentes(base.conexao() if conexao else None, candidatos) == set()
+    assert base.consultas == []
+
+
+def test_erro_devolve_parcial_ou_propaga():
+    base = BaseFalsa(notas_fiscais={'a': INICIO})
+    base.falhar = True
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert hashes_existentes(base.conexao(), ['a']) == set()
+    with pytest.raises(mysql.connector.Error):
+        hashes_existentes(base.conexao(), ['a'], propagar_erros=True)
+
+
+# ==============================================================================
+# FILTRO DE BLOOM
+# ==============================================================================
+def test_filtro_bloom_sem_falsos_negativos():
+    filtro = FiltroBloom(capacidade=2000)
+    valores = [f"hash-{i}" for i in range(2000)]
+    for v in valores: filtro.adicionar(v)
+    assert all(v in filtro for v in valores)
+    falsos_positivos = sum(f"outro-{i}" in filtro for i in range(10000))
+    assert falsos_positivos < 10000 * deduplicacao.BLOOM_TAXA_FALSOS_POSITIVOS * 3
+
+
+@pytest.fixture
+def bloom(monkeypatch):
+    """Bloom ligado, com o estado do processo limpo e conexao_emprestada a usar a base falsa."""
+    base = BaseFalsa(notas_fiscais={'a': INICIO - timedelta(days=1)}, notas_fiscais_arquivo={'b': INICIO - timedelta(days=400)})
+    emprestadas = []
+
+    @contextlib.contextmanager
+    def conexao_emprestada():
+        emprestadas.append(base)
+        yield None if base.sem_pool else base.conexao()
+
+    monkeypatch.setattr(deduplicacao, 'USAR_BLOOM', True)
+    monkeypatch.setattr(deduplicacao, 'BLOOM_SINCRONIZAR_SEGUNDOS', 0)
+    monkeypatch.setattr(deduplicacao, '_bloom', None)
+    monkeypatch.setattr(deduplicacao, '_bloom_marca', None)
+    monkeypatch.setattr(deduplicacao, '_bloom_sincronizado', 0.0)
+    monkeypatch.setattr(deduplicacao, 'conexao_emprestada', conexao_emprestada)
+    base.emprestadas = emprestadas
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield base
+
+
+def test_bloom_carrega_as_duas_tabelas_e_filtra_antes_do_mysql(bloom):
+    assert hashes_existentes(bloom.conexao(), ['a', 'b', 'x', 'y']) == {'a', 'b'}
+    assert deduplicacao._bloom_marca == INICIO
+    assert 'a' in deduplicacao._bloom and 'b' in deduplicacao._bloom
+    (_, params), = _consultas_in(bloom)
+    assert set(params) <= {'a', 'b'} | {h for h in ('x', 'y') if h in deduplicacao._bloom}
+
+
+def test_bloom_sincroniza_pela_coluna_gravado_em(bloom):
+    hashes_existentes(bloom.conexao(), ['a'])
+    # Outro processo grava depois da carga, e outro confirmou uma transação iniciada antes da marca
+    bloom.agora = INICIO + timedelta(minutes=5)
+    bloom.gravar('notas_fiscais', 'novo')
+    bloom.gravar('notas_fiscais_arquivo', 'atrasado', INICIO - timedelta(seconds=deduplicacao.BLOOM_MARGEM_SEGUNDOS // 2))
+    bloom.consultas.clear()
+
+    assert hashes_existentes(bloom.conexao(), ['novo', 'atrasado', 'x']) == {'novo', 'atrasado'}
+    sincronizacoes = [(sql, params) for sql, params in bloom.consultas if 'gravado_em >=' in sql]
+    assert [re.search(r"FROM (\w+)", sql)[1] for sql, _ in sincronizacoes] == TABELAS_NOTAS
+    assert all(params == (INICIO - timedelta(seconds=deduplicacao.BLOOM_MARGEM_SEGUNDOS),) for _, params in sincronizacoes)
+    assert deduplicacao._bloom_marca == bloom.agora
+    assert bloom.emprestadas # Sincroniza numa conexão própria do pool
+
+
+def test_bloom_sem_sincronizar_nao_e_usado(bloom):
+    hashes_existentes(bloom.conexao(), ['a'])
+    bloom.gravar('notas_fiscais', 'novo', INICIO + timedelta(minutes=1))
+    bloom.sem_pool = True # A sincronização falha
+    marca = deduplicacao._bloom_marca
+    assert 'novo' not in deduplicacao._bloom
+    assert hashes_existentes(bloom.conexao(), ['novo']) == {'novo'} # Vai ao MySQL sem passar pelo filtro
+    assert deduplicacao._bloom_marca == marca
+
+
+def test_bloom_respeita_o_intervalo_de_sincronizacao(bloom, monkeypatch):
+    hashes_existentes(bloom.conexao(), ['a'])
+    monkeypatch.setattr(deduplicacao, 'BLOOM_SINCRONIZAR_SEGUNDOS', 3600)
+    bloom.consultas.clear()
+    hashes_existentes(bloom.conexao(), ['a'])
+    assert not [sql for sql, _ in bloom.consultas if 'gravado_em' in sql]
+
+
+def test_insercoes_do_processo_entram_logo_no_filtro(bloom):
+    hashes_existentes(bloom.conexao(), ['a'])
+    deduplicacao._ao_inserir(['meu'])
+    assert 'meu' in deduplicacao._bloom
@@ -0,0 +1,61 @@
+"""
+Equivalência entre a limpeza vetorizada (clean_and_format_dataframe) e a limpeza por nota
+(clean_and_format_data): para qualquer lote, cada linha do DataFrame limpo tem de ser igual ao
+dict limpo da linha correspondente (mesmas chaves, pela mesma ordem, mesmos valores e tipos).
+
+Requer pytest e hypothesis (pip install -r requirements-dev.txt). Na raiz do projeto:
+    python -m pytest -q tests
+"""
+import math
+
+import pandas as pd
+from hypothesis import HealthCheck, given, settings, strategies as st
+
+from Backend.limpeza import CAMPOS_ESPERADOS, CAMPOS_MONETARIOS, clean_and_format_data, clean_and_format_dataframe
+
+_DIGITOS = st.text('0123456789', min_size=1, max_size=4)
+
+# Valores como o LLM os devolve: texto pt-BR/en, números, lixo, vazios e nulos
+_VALORES = st.one_of(
+    st.none(), st.floats(allow_nan=True), st.integers(), st.text(max_size=15),
+    st.text(alphabet='0123456789.,R$ %-', max_size=14),
+    st.builds(lambda a, b, c: f"R$ {a}.{b},{c}", _DIGITOS, _DIGITOS, _DIGITOS),
+    st.sampled_from(['...', '', '0,015', '2,015%', '0.025', '1.234', '²,5']),
+)
+_DATAS = st.one_of(
+    st.none(), st.floats(), st.text(max_size=25),
+    st.text(alphabet='0123456789/-: TZtz.', max_size=25),
+    st.builds(lambda d, m, a, h, mi, s, z, sep: f"{d}{sep}{m}{sep}{a} {h}:{mi}:{s}{z}",
+              _DIGITOS, _DIGITOS, _DIGITOS, _DIGITOS, _DIGITOS, _DIGITOS,
+              st.sampled_from(['', 'Z', 'z']), st.sampled_from(['/', '-', '.'])),
+    st.datetimes().map(lambda d: d.strftime('%d/%m/%Y %H:%M:%S')),
+    st.datetimes().map(lambda d: d.strftime('%Y-%m-%dT%H:%M:%SZ')),
+    st.dates().map(lambda d: d.strftime('%d/%m/%Y')),
+)
+_TEXTOS = st.one_of(st.none(), st.text(max_size=10), st.sampled_from(['...', ' ... ']), st.integers(), st.floats())
+
+_CAMPOS_NUMERICOS = CAMPOS_MONETARIOS + ['ocr_valor_aliquota', 'ocr_valor_tributos_fonte_percentual']
+_NOTA = st.fixed_dictionaries({}, optional={
+    **{campo: _TEXTOS for campo in CAMPOS_ESPERADOS},
+    **{campo: _VALORES for campo in _CAMPOS_NUMERICOS},
+    'ocr_emissao_datahora': _DATAS,
+})
+
+
+def _iguais(a, b) -> bool:
+    if isinstance(a, float) and isinstance(b, float): return (math.isnan(a) and math.isnan(b)) or a == b
+    return type(a) is type(b) and a == b and str(a) == str(b) # str: Decimal('1.0') == Decimal('1.00')
+
+
+@settings(max_examples=500, deadline=None, suppress_health_check=[HealthCheck.too_slow, HealthCheck.data_too_large])
+@given(st.lists(_NOTA, min_size=1, max_size=8), st.booleans())
+def test_dataframe_igual_a_limpeza_por_nota(notas, colunas_object):
+    df = pd.DataFrame(notas, dtype=object) if colunas_object else pd.DataFrame(notas)
+    # Linha a linha (to_dict('records') de um DataFrame sem colunas não tem linhas)
+    esperado = [clean_and_format_data({c: df.at[i, c] for c in df.columns}) for i in df.index]
+    obtido = clean_and_format_dataframe(df).to_dict('records')
+    assert len(obtido) == len(esperado)
+    for linha_esperada, linha_obtida in zip(esperado, obtido):
+        assert list(linha_obtida) == list(linha_esperada)
+        for campo, valor in linha_esperada.items():
+            assert _iguais(linha_obtida[campo], valor), (campo, valor, linha_obtida[campo])
@@ -0,0 +1,186 @@
+"""
+Paginação por chave de Backend/database.py (_condicao_cursor, _valor_cursor e _filtros_por_tabela):
+as condições geradas correm num SQLite em memória, que ordena os NULL como o MySQL (primeiro
+em ASC, por último em DESC), e as páginas lidas com o cursor de cada página têm de dar, juntas,
+exatamente a ordenação completa, sem linhas repetidas nem em falta, também com o arquivo
+(UNION ALL de notas_fiscais e notas_fiscais_arquivo).
+
+Na raiz do projeto:
+    python -m pytest -q tests
+"""
+import sqlite3
+from datetime import datetime
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Backend import database
+from Backend.database import TABELA_ARQUIVO, _condicao_cursor, _filtros_por_tabela, _valor_cursor, _where
+
+# (hash, ocr_valor_total, ocr_emissao_datahora): empates, NULL e valores com centavos
+NOTAS = [
+    ('h01', 10.10, '2024-01-05 10:00:00'), ('h02', 10.10, '2024-01-05 10:00:00'),
+    ('h03', None, None), ('h04', 1234.56, '2023-12-31 23:59:59'),
+    ('h05', 0.01, '2024-02-01 00:00:00'), ('h06', None, '2024-01-05 10:00:00'),
+    ('h07', 10.10, None), ('h08', 99999.99, '2022-06-15 08:30:00'),
+    ('h09', None, '2021-01-01 00:00:00'), ('h10', 0.30, '2024-01-05 10:00:00'),
+    ('h11', 0.1 + 0.2, '2024-03-01 12:00:00'), ('h12', 10.10, '2020-05-05 05:05:05'),
+]
+
+
+def _parametro_sqlite(valor):
+    if isinstance(valor, Decimal): return str(valor) # Comparado como número (afinidade REAL da coluna)
+    if isinstance(valor, datetime): return valor.strftime('%Y-%m-%d %H:%M:%S')
+    return valor
+
+
+def _criar_tabelas(tabelas_e_notas):
+    conn = sqlite3.connect(':memory:')
+    for tabela, notas in tabelas_e_notas.items():
+        conn.execute(f"CREATE TABLE {tabela} (hash TEXT PRIMARY KEY, ocr_valor_total REAL, ocr_emissao_datahora TEXT)")
+        conn.executemany(f"INSERT INTO {tabela} VALUES (?, ?, ?)", notas)
+    return conn
+
+
+def _ler(conn, query, params):
+    # Como o Pandas lê do MySQL: DECIMAL -> float (NULL -> NaN) e DATETIME -> Timestamp (NULL -> NaT)
+    return pd.read_sql(query, conn, params={k: _parametro_sqlite(v) for k, v in params.items()},
+                       parse_dates=['ocr_emissao_datahora'])
+
+
+def _ordenacao(coluna, descendente):
+    direcao = 'DESC' if descendente else 'ASC'
+    return f" ORDER BY `{coluna}` {direcao}, `hash` {direcao}"
+
+
+def _paginar(ler_pagina, limite):
+    """[(cursor usado, hashes da página)] até à última página, como consultar_notas_paginado."""
+    paginas, apos = [], None
+    while True:
+        df = ler_pagina(apos, limite + 1)
+        pagina = df.iloc[:limite]
+        paginas.append((apos, list(pagina['hash'])))
+        if len(df) <= limite: return paginas
+        apos = (_valor_cursor(pagina.iloc[-1][pagina.columns[0]]), pagina.iloc[-1]['hash'])
+
+
+# ==============================================================================
+# _valor_cursor
+# ==============================================================================
+@pytest.mark.parametrize('valor, esperado', [
+    (None, None),
+    (np.nan, None),
+    (float('nan'), None),
+    (pd.NaT, None),
+    (10.1, Decimal('10.1')),                      # DECIMAL lido como float: o decimal mais curto, exato
+    (np.float64(1234.56), Decimal('1234.56')),
+    (np.float64(0.1 + 0.2), Decimal('0.30000000000000004')),
+    (Decimal('10.10'), Decimal('10.10')),
+    (np.int64(42), 42),
+    (pd.Timestamp('2024-01-05 10:00:00'), datetime(2024, 1, 5, 10, 0, 0)),
+    ('Prestador', 'Prestador'),
+])
+def test_valor_cursor(valor, esperado):
+    resultado = _valor_cursor(valor)
+    assert resultado == esperado
+    assert type(resultado) is type(esperado)
+
+
+def test_valor_cursor_escalar_numpy_vira_tipo_python():
+    assert type(_valor_cursor(np.bool_(True))) is bool
+
+
+# ==============================================================================
+# _condicao_cursor
+# ==============================================================================
+@pytest.mark.parametrize('descendente', [True, False])
+def test_condicao_cursor_com_null_so_usa_hash(descendente):
+    params = {}
+    condicao = _condicao_cursor('ocr_valor_total', descendente, (None, 'h05'), params)
+    assert params == {'cursor_hash': 'h05'}
+    assert ':cursor_valor' not in condicao
+
+
+@pytest.mark.parametrize('descendente', [True, False])
+def test_condicao_cursor_com_valor(descendente):
+    params = {}
+    condicao = _condicao_cursor('ocr_valor_total', descendente, (Decimal('10.1'), 'h05'), params)
+    assert params == {'cursor_hash': 'h05', 'cursor_valor': Decimal('10.1')}
+    assert ('IS NULL' in condicao) is descendente # Em DESC os NULL vêm depois de todos os valores
+
+
+@pytest.mark.parametrize('coluna', ['ocr_valor_total', 'ocr_emissao_datahora'])
+@pytest.mark.parametrize('descendente', [True, False])
+@pytest.mark.parametrize('limite', [1, 2, 3, 5, 20])
+def test_paginas_juntas_dao_a_ordenacao_completa(coluna, descendente, limite):
+    conn = _criar_tabelas({'notas_fiscais': NOTAS})
+    ordenacao = _ordenacao(coluna, descendente)
+
+    def ler_pagina(apos, n):
+        params = {'limite': n}
+        condicoes = [] if apos is None else [_condicao_cursor(coluna, descendente, apos, params)]
+        query = f"SELECT `{coluna}`, `hash` FROM notas_fiscais{_where(condicoes)}{ordenacao} LIMIT :limite"
+        return _ler(conn, query, params)
+
+    completa = list(ler_pagina(None, len(NOTAS) + 1)['hash'])
+    paginas = _paginar(ler_pagina, limite)
+    assert [h for _, pagina in paginas for h in pagina] == completa
+
+    # Voltar atrás: cada página relida com o seu cursor (guardado ao avançar) tem as mesmas linhas
+    for apos, pagina in reversed(paginas):
+        assert list(ler_pagina(apos, limite)['hash']) == pagina
+
+
+# ==============================================================================
+# _filtros_por_tabela COM O ARQUIVO
+# ==============================================================================
+@pytest.fixture
+def com_arquivo(monkeypatch):
+    estado = {'particionada': False, 'fulltext': {}, 'arquivo_emissao_max': datetime(2022, 12, 31)}
+    monkeypatch.setattr(database, 'estado_tabelas', lambda *args, **kwargs: estado)
+    return estado
+
+
+def test_filtros_por_tabela_sufixa_parametros_do_arquivo(com_arquivo):
+    partes, params = _filtros_por_tabela({'categoria': 'Serviços'}, (Decimal('10.1'), 'h05'), 'ocr_valor_total', True)
+    assert [tabela for tabela, _ in partes] == ['notas_fiscais', TABELA_ARQUIVO]
+    assert params == {'categoria': 'Serviços', 'cursor_hash': 'h05', 'cursor_valor': Decimal('10.1'),
+                      'categoria_1': 'Serviços', 'cursor_hash_1': 'h05', 'cursor_valor_1': Decimal('10.1')}
+    condicoes_arquivo = " AND ".join(partes[1][1])
+    assert ':cursor_valor_1' in condicoes_arquivo and ':cursor_hash_1' in condicoes_arquivo
+    assert ':cursor_valor ' not in condicoes_arquivo and ':cursor_hash)' not in condicoes_arquivo
+
+
+def test_filtros_por_tabela_sem_arquivo_no_intervalo(com_arquivo):
+    partes, params = _filtros_por_tabela({'emissao_de': '2023-01-01'}, (None, 'h05'), 'ocr_valor_total', False)
+    assert [tabela for tabela, _ in partes] == ['notas_fiscais']
+    assert 'cursor_hash_1' not in params
+
+
+@pytest.mark.parametrize('coluna', ['ocr_valor_total', 'ocr_emissao_datahora'])
+@pytest.mark.parametrize('descendente', [True, False])
+@pytest.mark.parametrize('limite', [1, 2, 4, 20])
+def test_paginas_com_arquivo_dao_a_ordenacao_completa(com_arquivo, coluna, descendente, limite):
+    arquivadas = {'h03', 'h04', 'h08', 'h09', 'h12'}
+    conn = _criar_tabelas({'notas_fiscais': [n for n in NOTAS if n[0] not in arquivadas],
+                           TABELA_ARQUIVO: [n for n in NOTAS if n[0] in arquivadas]})
+    ordenacao = _ordenacao(coluna, descendente)
+
+    def ler_pagina(apos, n):
+        partes, params = _filtros_por_tabela(None, apos, coluna, descendente)
+        params['limite'] = n
+        # Como consultar_notas_paginado: cada tabela ordena e limita, e o resultado junto outra vez
+        # (o SQLite não aceita '(SELECT ... LIMIT) UNION ALL (...)', daí as subconsultas)
+        consultas = [f"SELECT * FROM (SELECT `{coluna}`, `hash` FROM {tabela}{_where(condicoes)}{ordenacao} LIMIT :limite)"
+                     for tabela, condicoes in partes]
+        return _ler(conn, " UNION ALL ".join(consultas) + ordenacao + " LIMIT :limite", params)
+
+    completa = list(_criar_tabelas({'notas_fiscais': NOTAS}).execute(
+        f"SELECT `hash` FROM notas_fiscais{ordenacao}").fetchall())
+    paginas = _paginar(ler_pagina, limite)
+    assert [h for _, pagina in paginas for h in pagina] == [h for (h,) in completa]
+
+    for apos, pagina in reversed(paginas):
+        assert list(ler_pagina(apos, limite)['hash']) == pagina
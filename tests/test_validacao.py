@@ -0,0 +1,187 @@
+"""
+Regras de validação cruzada de Backend/validacao.py, em tabela: dígitos verificadores do
+CPF/CNPJ, ISS ≈ base × alíquota, valor total vs. retenções, data de emissão, UF e a pontuação
+que decide a aprovação automática.
+
+Na raiz do projeto:
+    python -m pytest -q tests
+"""
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from Backend import validacao
+from Backend.validacao import PESOS, TOLERANCIA_ISS, cnpj_valido, cpf_valido, documento_valido, validar_nota
+
+AGORA = datetime(2024, 6, 15, 12, 0, 0)
+
+# Nota sem nenhum sinal; cada caso altera só os campos que testa
+NOTA_VALIDA = {
+    'ocr_prestador_cpf_cnpj': '11.222.333/0001-81', 'ocr_tomador_cpf_cnpj': '529.982.247-25',
+    'ocr_intermediario_cpf_cnpj': '',
+    'ocr_valor_total': Decimal('1000.00'), 'ocr_valor_base_calculo': Decimal('1000.00'),
+    'ocr_valor_aliquota': Decimal('0.05'), 'ocr_valor_iss': Decimal('50.00'),
+    'ocr_emissao_datahora': '2024-06-01 10:00:00',
+    'ocr_prestador_uf': 'SP', 'ocr_tomador_uf': 'RJ',
+}
+
+
+def _sinais(**alteracoes):
+    return validar_nota({**NOTA_VALIDA, **alteracoes}, AGORA)['sinais']
+
+
+# ==============================================================================
+# CPF / CNPJ
+# ==============================================================================
+@pytest.mark.parametrize('documento, esperado', [
+    ('529.982.247-25', True),
+    ('52998224725', True),
+    ('529.982.247-24', False),   # Segundo dígito errado
+    ('529.982.247-15', False),   # Primeiro dígito errado
+    ('111.111.111-11', False),   # Dígitos todos iguais passam na conta, mas não são válidos
+    ('5299822472', False),       # Dígitos a menos
+    ('', False),
+    (None, False),
+])
+def test_cpf_valido(documento, esperado):
+    assert cpf_valido(documento) is esperado
+
+
+@pytest.mark.parametrize('documento, esperado', [
+    ('11.222.333/0001-81', True),
+    ('11222333000181', True),
+    ('11.222.333/0001-82', False),
+    ('11.222.333/0001-91', False),
+    ('00.000.000/0000-00', False),
+    ('1122233300018', False),
+    (None, False),
+])
+def test_cnpj_valido(documento, esperado):
+    assert cnpj_valido(documento) is esperado
+
+
+@pytest.mark.parametrize('documento, esperado', [
+    ('529.982.247-25', True),       # 11 dígitos: CPF
+    ('11.222.333/0001-81', True),   # 14 dígitos: CNPJ
+    ('CNPJ 11 222 333 0001 81', True),
+    ('1122233300018', False),       # Nem 11 nem 14 dígitos
+    ('52998224725000', False),      # 14 dígitos, mas não é um CNPJ válido
+    ('', False),
+])
+def test_documento_valido(documento, esperado):
+    assert documento_valido(documento) is esperado
+
+
+@pytest.mark.parametrize('campo, valor, motivo', [
+    ('ocr_prestador_cpf_cnpj', '', "CPF/CNPJ em falta"),
+    ('ocr_prestador_cpf_cnpj', '11.222.333/0001-82', "CPF/CNPJ com dígitos verificadores inválidos"),
+    ('ocr_tomador_cpf_cnpj', '', None),  # Opcional
+    ('ocr_tomador_cpf_cnpj', '529.982.247-24', "CPF/CNPJ com dígitos verificadores inválidos"),
+    ('ocr_intermediario_cpf_cnpj', None, None),
+    ('ocr_intermediario_cpf_cnpj', '123', "CPF/CNPJ com dígitos verificadores inválidos"),
+])
+def test_sinais_documentos(campo, valor, motivo):
+    assert _sinais(**{campo: valor}).get(campo) == motivo
+
+
+# ==============================================================================
+# ISS ≈ BASE × ALÍQUOTA
+# ==============================================================================
+@pytest.mark.parametrize('alteracoes, com_sinal', [
+    ({}, False),
+    ({'ocr_valor_iss': Decimal('50.00') + TOLERANCIA_ISS}, False),          # No limite da tolerância
+    ({'ocr_valor_iss': Decimal('50.00') - TOLERANCIA_ISS}, False),
+    ({'ocr_valor_iss': Decimal('50.00') + TOLERANCIA_ISS + Decimal('0.01')}, True),
+    ({'ocr_valor_iss': Decimal('40.00')}, True),
+    ({'ocr_valor_aliquota': '5%'}, False),                                  # Percentagem em texto
+    ({'ocr_valor_aliquota': '5,00'}, False),
+    ({'ocr_valor_iss': '50,00'}, False),
+    ({'ocr_valor_iss': Decimal('0'), 'ocr_valor_aliquota': Decimal('0')}, False),  # Isento: sem verificação
+    ({'ocr_valor_iss': Decimal('0')}, True),                                # Alíquota sem ISS
+    ({'ocr_valor_aliquota': Decimal('0')}, True),                           # ISS sem alíquota
+    # Sem base de cálculo usa total - deduções
+    ({'ocr_valor_base_calculo': None, 'ocr_valor_deducoes': Decimal('200.00'), 'ocr_valor_iss': Decimal('40.00')}, False),
+    ({'ocr_valor_base_calculo': None, 'ocr_valor_deducoes': Decimal('200.00')}, True),
+    ({'ocr_valor_base_calculo': Decimal('0')}, False),                      # Base 0 também cai para o total
+])
+def test_sinal_iss(alteracoes, com_sinal):
+    assert ('ocr_valor_iss' in _sinais(**alteracoes)) is com_sinal
+
+
+# ==============================================================================
+# VALOR TOTAL E RETENÇÕES
+# ==============================================================================
+@pytest.mark.parametrize('alteracoes, motivo', [
+    ({}, None),
+    ({'ocr_valor_total': None}, "Valor total em falta"),
+    ({'ocr_valor_total': Decimal('0')}, "Valor total em falta"),
+    ({'ocr_valor_total': Decimal('-10')}, "Valor total em falta"),
+    ({'ocr_valor_inss': Decimal('110.00'), 'ocr_valor_irrf': Decimal('15.00')}, None),
+    # Retenções iguais ao total ainda passam; acima do total não
+    ({'ocr_valor_inss': Decimal('600.00'), 'ocr_valor_irrf': Decimal('400.00')}, None),
+    ({'ocr_valor_inss': Decimal('600.00'), 'ocr_valor_irrf': Decimal('400.01')}, "Valor total menor do que as retenções (1000.01)"),
+    ({'ocr_valor_pis_pasep': '500,00', 'ocr_valor_cofins': '500,00', 'ocr_valor_csll': '0,01'},
+     "Valor total menor do que as retenções (1000.01)"),
+])
+def test_sinal_total_e_retencoes(alteracoes, motivo):
+    assert _sinais(**alteracoes).get('ocr_valor_total') == motivo
+
+
+# ==============================================================================
+# DATA DE EMISSÃO E UF
+# ==============================================================================
+@pytest.mark.parametrize('emissao, motivo', [
+    ('2024-06-15 12:00:00', None),
+    ('2024-06-16 12:00:00', None),                       # Até um dia de folga (fusos horários)
+    ('2024-06-16 12:00:01', "Data de emissão no futuro"),
+    ('', "Data de emissão não reconhecida"),
+    (None, "Data de emissão não reconhecida"),
+    ('15/06/2024', "Data de emissão não reconhecida"),   # A nota tem de vir já limpa
+])
+def test_sinal_emissao(emissao, motivo):
+    assert _sinais(ocr_emissao_datahora=emissao).get('ocr_emissao_datahora') == motivo
+
+
+@pytest.mark.parametrize('campo, uf, motivo', [
+    ('ocr_prestador_uf', 'sp', None),
+    ('ocr_prestador_uf', ' MG ', None),
+    ('ocr_prestador_uf', '', "UF em falta"),
+    ('ocr_prestador_uf', 'XX', "UF inválida"),
+    ('ocr_tomador_uf', '', None),
+    ('ocr_tomador_uf', None, None),
+    ('ocr_tomador_uf', 'São Paulo', "UF inválida"),
+])
+def test_sinal_uf(campo, uf, motivo):
+    assert _sinais(**{campo: uf}).get(campo) == motivo
+
+
+# ==============================================================================
+# PONTUAÇÃO E APROVAÇÃO AUTOMÁTICA
+# ==============================================================================
+_TOTAL_PESOS = sum(PESOS.values())
+
+
+@pytest.mark.parametrize('alteracoes, pontuacao', [
+    ({}, 1.0),
+    ({'ocr_prestador_uf': ''}, 1 - PESOS['ocr_prestador_uf'] / _TOTAL_PESOS),
+    ({'ocr_prestador_cpf_cnpj': ''}, 1 - PESOS['ocr_prestador_cpf_cnpj'] / _TOTAL_PESOS),
+    ({'ocr_prestador_cpf_cnpj': '', 'ocr_valor_total': None, 'ocr_valor_iss': Decimal('0'), 'ocr_valor_aliquota': Decimal('0')},
+     1 - (PESOS['ocr_prestador_cpf_cnpj'] + PESOS['ocr_valor_total']) / _TOTAL_PESOS),
+    ({campo: 'x' for campo in PESOS}, 0.0),
+])
+def test_pontuacao(alteracoes, pontuacao):
+    assert validar_nota({**NOTA_VALIDA, **alteracoes}, AGORA)['pontuacao'] == pytest.approx(pontuacao)
+
+
+@pytest.mark.parametrize('limiar, alteracoes, aprovada', [
+    (1.0, {}, True),
+    (1.0, {'ocr_tomador_uf': 'XX'}, False),      # Por omissão qualquer sinal manda para revisão
+    (0.9, {'ocr_tomador_uf': 'XX'}, True),
+    (0.9, {'ocr_prestador_cpf_cnpj': ''}, False),
+    (1.01, {}, False),                           # Limiar acima de 1 desliga a aprovação automática
+    (0.0, {campo: 'x' for campo in PESOS}, True),
+])
+def test_aprovacao(monkeypatch, limiar, alteracoes, aprovada):
+    monkeypatch.setattr(validacao, 'LIMIAR_APROVACAO', limiar)
+    assert validar_nota({**NOTA_VALIDA, **alteracoes}, AGORA)['aprovada'] is aprovada
@@ -0,0 +1,152 @@
+"""
+Interpretação de valores monetários e percentuais (Backend/valores.py): um caso por regra de
+separadores e por tipo de entrada (texto, Decimal, int/float, escalares numpy, None e NaN).
+
+Na raiz do projeto:
+    python -m pytest -q tests
+"""
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from Backend.valores import interpretar_numero, interpretar_percentual, interpretar_valor, interpretar_valores
+
+
+# ==============================================================================
+# SEPARADORES
+# ==============================================================================
+@pytest.mark.parametrize('texto, esperado', [
+    # '.' e ',' no mesmo valor: o último é o decimal
+    ('1.234,56', '1234.56'),
+    ('1,234.56', '1234.56'),
+    ('1.234.567,8', '1234567.8'),
+    ('1,234,567.8', '1234567.8'),
+    ('1.234,5,6', '0'),           # Dois separadores decimais: não é número
+    # Um só tipo de separador, repetido: milhares
+    ('1.234.567', '1234567'),
+    ('1,234,567', '1234567'),
+    # Separador único seguido de 3 dígitos: milhares
+    ('1,234', '1234'),
+    ('1.234', '1234'),
+    # ... exceto com parte inteira 0
+    ('0,015', '0.015'),
+    ('0.015', '0.015'),
+    (',015', '0.015'),
+    # Nos outros casos é decimal
+    ('1234,5', '1234.5'),
+    ('12.50', '12.50'),
+    ('12,5', '12.5'),
+    ('1,2345', '1.2345'),
+    # Sem separador
+    ('1234', '1234'),
+    ('007', '7'),
+])
+def test_separadores(texto, esperado):
+    assert interpretar_numero(texto) == Decimal(esperado)
+
+
+@pytest.mark.parametrize('texto, esperado', [
+    ('R$ 1.234,56', '1234.56'),
+    ('R$1.234,56', '1234.56'),
+    ('  1 234,56 ', '1234.56'),   # Espaço como separador de milhares
+    ('US$ 1,234.56', '1234.56'),
+    ('2,5%', '2.5'),
+    ('-1.234,56', '1234.56'),     # O sinal é descartado (o OCR não distingue o hífen de um traço)
+    ('(1.234,56)', '1234.56'),
+])
+def test_texto_a_volta_do_numero_ignorado(texto, esperado):
+    assert interpretar_numero(texto) == Decimal(esperado)
+
+
+@pytest.mark.parametrize('texto', ['', '...', '.', ',', 'R$', 'isento', '—'])
+def test_texto_sem_numero_vale_zero(texto):
+    assert interpretar_numero(texto) == 0
+    assert interpretar_valor(texto) == Decimal('0.00')
+
+
+# ==============================================================================
+# TIPOS DE ENTRADA
+# ==============================================================================
+@pytest.mark.parametrize('valor, esperado', [
+    (None, '0'),
+    (True, '0'),                  # bool é Integral, mas não é um valor
+    (False, '0'),
+    (1234, '1234'),
+    (-5, '-5'),                   # Números (não texto) mantêm o sinal
+    (12.5, '12.5'),
+    (0.1, '0.1'),                 # O decimal mais curto, não 0.1000000000000000055...
+    (Decimal('1234.567'), '1234.567'),
+    (Decimal('-3.5'), '-3.5'),
+    (np.int64(1234), '1234'),
+    (np.int32(-7), '-7'),
+    (np.float64(0.1), '0.1'),
+    (np.float32(2.5), '2.5'),
+])
+def test_tipos_numericos(valor, esperado):
+    numero = interpretar_numero(valor)
+    assert isinstance(numero, Decimal)
+    assert numero == Decimal(esperado)
+
+
+@pytest.mark.parametrize('valor', [
+    float('nan'), float('inf'), float('-inf'), np.nan, np.float64('nan'),
+    Decimal('NaN'), Decimal('Infinity'), 'nan', 'inf',
+])
+def test_nao_finitos_valem_zero(valor):
+    assert interpretar_numero(valor) == 0
+
+
+# ==============================================================================
+# PERCENTUAIS
+# ==============================================================================
+@pytest.mark.parametrize('texto, esperado', [
+    ('2,015', '2.015'),           # Com 'percentual' o separador único é sempre decimal
+    ('0.025', '0.025'),
+    ('1.234,5', '1234.5'),        # Com os dois separadores segue a regra geral
+])
+def test_numero_percentual(texto, esperado):
+    assert interpretar_numero(texto, percentual=True) == Decimal(esperado)
+
+
+@pytest.mark.parametrize('valor, esperado', [
+    ('5%', '0.0500'),
+    ('5', '0.0500'),
+    ('0,05', '0.0500'),
+    ('2,015%', '0.0202'),         # 2.015 % -> 0.02015, arredondado a 4 casas (ROUND_HALF_UP)
+    ('0,015', '0.0150'),
+    ('1', '0.0100'),              # >= 1 é percentagem
+    ('0,99', '0.9900'),           # < 1 já é fração
+    (5, '0.0500'),
+    (0.05, '0.0500'),
+    (None, '0.0000'),
+    ('', '0.0000'),
+])
+def test_interpretar_percentual(valor, esperado):
+    resultado = interpretar_percentual(valor)
+    assert resultado == Decimal(esperado)
+    assert str(resultado) == esperado
+
+
+# ==============================================================================
+# ARREDONDAMENTO E LOTE
+# ==============================================================================
+@pytest.mark.parametrize('valor, esperado', [
+    ('R$ 1.234,56', '1234.56'),
+    ('0,005', '0.01'),            # ROUND_HALF_UP, como o MySQL
+    ('0,004', '0.00'),
+    ('1234,5', '1234.50'),
+    (2.675, '2.68'),              # Via str(float): sem o erro binário de 2.67499999...
+    (None, '0.00'),
+    (float('nan'), '0.00'),
+    ('9' * 40, '0.00'),           # Não cabe na precisão do contexto
+])
+def test_interpretar_valor(valor, esperado):
+    resultado = interpretar_valor(valor)
+    assert str(resultado) == esperado
+
+
+def test_interpretar_valores_igual_a_um_a_um():
+    valores = ['1.234,56', '1.234,56', None, 12.5, np.int64(3), '', '0,015', '1.234,56']
+    assert interpretar_valores(valores) == [interpretar_valor(v) for v in valores]
+    assert interpretar_valores(valores, percentual=True) == [interpretar_percentual(v) for v in valores]